@@ -1,26 +1,61 @@
 import os
+import pstats
 import random
+import re
 import shutil
+import socket
 import sqlite3
+import stat
+import struct
+import sys
 from datetime import datetime
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import asyncio
 import base64
+import cProfile
+import queue
+import tempfile
+import hashlib
+import hmac
+import io
+import bisect
+import itertools
+import logging
+import math
+import mimetypes
+import mmap
+import secrets
+import zlib
+from collections import OrderedDict
+from urllib.parse import quote, urlparse
+from contextlib import contextmanager
 
-from flask import Flask, jsonify, render_template, send_from_directory, request, redirect, url_for, flash, session, g
+from flask import Flask, Request, jsonify, render_template, request, redirect, url_for, flash, session, g, has_request_context, send_file
 import requests
 import json
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+
+# Pillow is only needed for perceptual hashing and image variants; without it both are off
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 app = Flask(__name__)
 
 # Thread pool for background tasks
 thread_pool = ThreadPoolExecutor(max_workers=4)
 
-# Cache for source information results
-source_cache = {}
+# Thread pool for work a request fans out and waits on
+request_pool = ThreadPoolExecutor(max_workers=8)
+
+# Thread pool for the file moves and hashing of bulk moderation, so they never queue behind
+# SauceNao lookups on the request pool (or hold them up)
+moderation_pool = ThreadPoolExecutor(max_workers=4)
 
 # Secret key for session management
 app.config['SECRET_KEY'] = 'super_secret_key_for_app'
@@ -28,32 +63,2873 @@ app.config['SECRET_KEY'] = 'super_secret_key_for_app'
 # Replace with your actual SauceNao API key
 SAUCENAO_API_KEY = os.environ.get('SAUCENAO_API_KEY', 'APIKEYHERE')
 
-# SauceNao API URL
-SAUCENAO_API_URL = 'https://saucenao.com/search.php'
+# SauceNao API URL
+SAUCENAO_API_URL = os.environ.get('SAUCENAO_API_URL', 'https://saucenao.com/search.php')
+
+# SauceNao HTTP client configuration
+SAUCENAO_CONNECT_TIMEOUT = float(os.environ.get('SAUCENAO_CONNECT_TIMEOUT', '3'))
+SAUCENAO_READ_TIMEOUT = float(os.environ.get('SAUCENAO_READ_TIMEOUT', '15'))
+SAUCENAO_MAX_RETRIES = int(os.environ.get('SAUCENAO_MAX_RETRIES', '2'))
+SAUCENAO_POOL_SIZE = int(os.environ.get('SAUCENAO_POOL_SIZE', '8'))
+SAUCENAO_BREAKER_THRESHOLD = int(os.environ.get('SAUCENAO_BREAKER_THRESHOLD', '5'))  # Consecutive failures before failing fast
+SAUCENAO_BREAKER_COOLDOWN = float(os.environ.get('SAUCENAO_BREAKER_COOLDOWN', '60'))  # Seconds to fail fast before trying again
+
+# Data directory paths
+DATA_DIR = 'data'
+IMAGES_FOLDER_INTERNAL = os.path.join(DATA_DIR, 'images')
+IMAGE_STORE_FOLDER = os.path.join(DATA_DIR, 'store')
+PENDING_UPLOADS_FOLDER = os.path.join(DATA_DIR, 'pending_images')
+DATABASE_PATH = os.path.join(DATA_DIR, 'sqlite', 'site.db')
+MOTD_PATH = os.path.join(DATA_DIR, 'motd.txt')
+
+# File upload configuration
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 Megabytes limit for file uploads
+
+# Extensions served from the images folder
+MEDIA_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webm', '.mp4')
+VIDEO_EXTENSIONS = ('.webm', '.mp4')
+
+# Cache tier shared by SauceNao results, catalog snapshots and the MOTD: 'local' keeps entries in
+# each worker, 'shared' in memory-backed files every worker on the host maps, 'redis' in a Redis server
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'local')
+CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get('CACHE_LOCAL_MAX_ENTRIES', '4096'))  # Entries kept per worker by the local backend
+CACHE_LOCAL_MAX_BYTES = int(os.environ.get('CACHE_LOCAL_MAX_BYTES', str(64 * 1024 * 1024)))  # Approximate memory they may take
+CACHE_SHARED_DIR = os.environ.get('CACHE_SHARED_DIR', '/dev/shm/random-image-cache' if os.path.isdir('/dev/shm') else os.path.join(DATA_DIR, 'cache'))
+CACHE_SHARED_MAX_ENTRIES = int(os.environ.get('CACHE_SHARED_MAX_ENTRIES', '16384'))  # Entry files kept by the shared backend
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+CACHE_REDIS_TIMEOUT = float(os.environ.get('CACHE_REDIS_TIMEOUT', '0.5'))  # Seconds before a Redis call counts as a miss
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'ri:')
+CATALOG_SNAPSHOT_TTL = 3600  # Seconds a folder or store listing stays in the cache tier
+
+# Minimum number of seconds between checks of the images folder for changes
+CATALOG_REFRESH_INTERVAL = float(os.environ.get('CATALOG_REFRESH_INTERVAL', '2'))
+
+# SauceNao result cache configuration
+SOURCE_CACHE_TTL = int(os.environ.get('SOURCE_CACHE_TTL', str(30 * 24 * 3600)))  # Seconds to keep found sources
+SOURCE_CACHE_NEGATIVE_TTL = int(os.environ.get('SOURCE_CACHE_NEGATIVE_TTL', str(24 * 3600)))  # Seconds to keep "no results"
+SOURCE_CACHE_MAX_ROWS = int(os.environ.get('SOURCE_CACHE_MAX_ROWS', '200000'))  # Entries kept in SQLite
+
+# Background SauceNao lookups; when enabled, /image-source only reads the cache
+SOURCE_PREFETCH_ENABLED = os.environ.get('SOURCE_PREFETCH_ENABLED', '1') == '1'
+SAUCENAO_SHORT_LIMIT = int(os.environ.get('SAUCENAO_SHORT_LIMIT', '4'))  # Lookups allowed per 30 seconds
+SAUCENAO_LONG_LIMIT = int(os.environ.get('SAUCENAO_LONG_LIMIT', '100'))  # Lookups allowed per day
+SOURCE_PREFETCH_MAX_ATTEMPTS = 5
+SOURCE_LOOKUP_CLAIM_TIMEOUT = 600  # Seconds without a heartbeat before a 'running' job is taken over
+SOURCE_TOKEN_POLL_INTERVAL = 30  # Longest sleep between attempts to take a SauceNao token
+
+# Concurrent lookups for the same image share one SauceNao request; across workers through a lease row
+SOURCE_LEASE_TTL = float(os.environ.get('SOURCE_LEASE_TTL', '60'))  # Seconds before another worker may take over a lookup
+SOURCE_LEASE_POLL_INTERVAL = float(os.environ.get('SOURCE_LEASE_POLL_INTERVAL', '0.2'))  # Seconds between checks of another worker's lease
+
+# SQLite connection pool and tuning
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))  # Idle connections kept per worker
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', '10'))  # Seconds to wait on a locked database
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', '16384'))  # Page cache per connection
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))  # Bytes of the database file to memory-map
+DB_STATEMENT_CACHE = 128  # Prepared statements kept per connection
+
+# Milliseconds between checks of the MOTD file and version stamp for changes
+MOTD_REVALIDATE_MS = int(os.environ.get('MOTD_REVALIDATE_MS', '1000'))
+MOTD_CACHE_TTL = 24 * 3600  # Seconds a MOTD text stays in the cache tier
+
+# Largest perceptual hash Hamming distance (out of 64 bits) treated as a near-duplicate
+PHASH_MATCH_THRESHOLD = int(os.environ.get('PHASH_MATCH_THRESHOLD', '10'))
+
+# Random selection: 'shuffle' walks a per-session shuffle bag (every image gets its weight in
+# turns per pass on average, so weight 1 means no repeats until every image was shown),
+# 'weighted' draws independently in proportion to the image weights
+RANDOM_SELECTION_MODE = os.environ.get('RANDOM_SELECTION_MODE', 'shuffle')
+NEW_IMAGE_BOOST = float(os.environ.get('NEW_IMAGE_BOOST', '3'))  # Weight multiplier for new approvals
+NEW_IMAGE_BOOST_DAYS = float(os.environ.get('NEW_IMAGE_BOOST_DAYS', '7'))  # How long new approvals stay boosted
+REPORT_DEMOTION = 0.5  # Weight multiplier per visitor report
+MAX_REPORT_DEMOTIONS = 4  # Reports beyond this don't demote further; an admin resets them
+REPORT_RATE_LIMIT = int(os.environ.get('REPORT_RATE_LIMIT', '20'))  # Reports one client address may file per hour
+# Reverse proxies in front of the app that append to X-Forwarded-For (1 behind the bundled nginx);
+# with 0 the peer address is the client, so clients can't pick their own address
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', '0'))
+
+# Widths of the downscaled copies generated for still images (requested with ?w=)
+IMAGE_VARIANT_WIDTHS = tuple(sorted(int(w) for w in os.environ.get('IMAGE_VARIANT_WIDTHS', '320,640,1280').split(',')))
+IMAGE_VARIANT_SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')  # GIFs keep their animation, videos are served as-is
+THUMBNAIL_WIDTH = IMAGE_VARIANT_WIDTHS[0]
+
+# Seconds browsers and CDNs may keep media fetched through a versioned (?v=) URL
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Media byte transfer: '' streams files from the worker (zero-copy sendfile under gunicorn),
+# 'x-accel' hands them to nginx with X-Accel-Redirect, 'x-sendfile' to Apache/lighttpd with X-Sendfile
+MEDIA_OFFLOAD = os.environ.get('MEDIA_OFFLOAD', '')
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/_media/')  # nginx internal location aliased to the data directory
+
+# Range requests: files at least this large are read through shared memory maps
+MEDIA_MMAP_MIN_SIZE = int(os.environ.get('MEDIA_MMAP_MIN_SIZE', str(1024 * 1024)))
+MEDIA_MMAP_CACHE_SIZE = int(os.environ.get('MEDIA_MMAP_CACHE_SIZE', '32'))  # Files kept mapped per worker
+CONTENT_HASH_CACHE_SIZE = int(os.environ.get('CONTENT_HASH_CACHE_SIZE', '65536'))  # File digests kept per worker
+MEDIA_MAX_RANGES = 16  # More ranges than this in one request get the whole file
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+# Photo requests shown per dashboard page
+DASHBOARD_PAGE_SIZE = int(os.environ.get('DASHBOARD_PAGE_SIZE', '25'))
+
+# Count SQL statements per request and report them in an X-SQL-Statement-Count header
+SQL_STATEMENT_COUNTER = os.environ.get('SQL_STATEMENT_COUNTER', '0') == '1'
+
+# Most images /random-images returns in one response
+RANDOM_BATCH_MAX = 20
+
+# Seconds /random-image-with-source waits for source information before answering without it
+SOURCE_LOOKUP_DEADLINE = float(os.environ.get('SOURCE_LOOKUP_DEADLINE', '2'))
+
+# Logging: LOG_LEVEL filters records, LOG_FORMAT is 'text' or 'json', and records marked as
+# sampled (e.g. full SauceNao responses at DEBUG) are kept at LOG_SAMPLE_RATE
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
+# Prometheus metrics: each worker writes a snapshot to METRICS_DIR and /metrics sums them.
+# With METRICS_TOKEN set, /metrics requires "Authorization: Bearer <token>"
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(DATA_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Request profiling: requests with the X-Profile header from an admin session (or carrying
+# PROFILE_TOKEN), plus PROFILE_SAMPLE_RATE of all requests, are run under cProfile.
+# PROFILE_STACK_INTERVAL_MS > 0 also samples the stacks of busy threads for flamegraphs
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(DATA_DIR, 'profiles'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_HEADER_ENVIRON = 'HTTP_X_PROFILE'
+PROFILE_STACK_INTERVAL_MS = float(os.environ.get('PROFILE_STACK_INTERVAL_MS', '0'))
+PROFILE_STACK_FLUSH_SECONDS = float(os.environ.get('PROFILE_STACK_FLUSH_SECONDS', '60'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '200'))  # Oldest captures are deleted beyond this
+PROFILE_EXTENSIONS = ('.prof', '.folded')
+
+# Largest number of photo requests one bulk approve/reject/delete may touch
+BULK_MAX_IDS = int(os.environ.get('BULK_MAX_IDS', '500'))
+
+# Ensure data directories exist
+os.makedirs(IMAGES_FOLDER_INTERNAL, exist_ok=True)
+os.makedirs(IMAGE_STORE_FOLDER, exist_ok=True)
+os.makedirs(PENDING_UPLOADS_FOLDER, exist_ok=True)
+os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+
+# --- Logging and Metrics ---
+class LogFormatter(logging.Formatter):
+    """One line per record: readable text, or a JSON object with LOG_FORMAT=json.
+
+    Structured fields are passed as extra={'fields': {...}}.
+    """
+
+    def __init__(self, style=LOG_FORMAT):
+        super().__init__()
+        self.style = style
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        if self.style == 'json':
+            entry = {'ts': round(record.created, 3), 'level': record.levelname.lower(), 'pid': record.process,
+                     'msg': record.getMessage()}
+            entry.update(fields)
+            if record.exc_info:
+                entry['exc'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = f"{self.formatTime(record)} {record.levelname} [{record.process}] {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+class SampledFilter(logging.Filter):
+    """Let through LOG_SAMPLE_RATE of the records logged with extra=SAMPLED."""
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, 'sampled', False) or random.random() < self.rate
+
+# extra= for high-volume records, e.g. whole upstream responses
+SAMPLED = {'sampled': True}
+
+logger = logging.getLogger('random_image')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(LogFormatter())
+    _log_handler.addFilter(SampledFilter())
+    logger.addHandler(_log_handler)
+
+class MetricsRegistry:
+    """Counters and histograms for this worker, merged with the other workers' on /metrics.
+
+    Each worker writes its snapshot to METRICS_DIR every METRICS_FLUSH_INTERVAL
+    seconds, and right before it answers /metrics; the endpoint sums the
+    snapshots of every worker that ran since the server started, so counts
+    from workers that have since exited are kept. Components that already
+    keep statistics (the SauceNao client, the caches) are read through
+    collectors when a snapshot is taken rather than counted twice.
+    """
+
+    def __init__(self, folder=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.folder = folder
+        self.flush_interval = flush_interval
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Counts inherited across a fork belong to the parent's snapshot
+        self._pid = os.getpid()
+        self._counters = {}
+        self._histograms = {}
+        self._path = os.path.join(self.folder, f'{self._pid}-{int(time.time() * 1000)}.json')
+        self._flusher_started = False
+
+    def inc(self, name, labels=(), amount=1):
+        """Add to a counter; labels is a tuple of (name, value) pairs."""
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds, buckets=None):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram(buckets)
+            histogram.observe(seconds)
+
+    def add_collector(self, collect):
+        """collect() returns (counters, histograms) as lists of [name, labels, value or histogram snapshot]."""
+        self._collectors.append(collect)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), h.snapshot()] for (name, labels), h in self._histograms.items()]
+        for collect in self._collectors:
+            try:
+                extra_counters, extra_histograms = collect()
+            except Exception:
+                logger.exception('Metrics collector failed')
+                continue
+            counters.extend(extra_counters)
+            histograms.extend(extra_histograms)
+        return {'counters': counters, 'histograms': histograms}
+
+    def ensure_worker(self):
+        """Start this process's flusher thread once; call from anywhere on the request path."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        if not self._flusher_started:
+            with self._lock:
+                if self._flusher_started:
+                    return
+                self._flusher_started = True
+            threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error writing metrics snapshot')
+
+    def flush(self):
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path = f'{self._path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, self._path)
+
+    def clear(self):
+        """Forget every worker's snapshot; the gunicorn master calls this at startup."""
+        if os.path.isdir(self.folder):
+            for name in os.listdir(self.folder):
+                os.remove(os.path.join(self.folder, name))
+
+    def aggregate(self):
+        """Sum the snapshots of every worker into {(name, labels): value} and {(name, labels): histogram}."""
+        self.flush()
+        counters, histograms = {}, {}
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric, labels, value in snapshot['counters']:
+                key = (metric, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for metric, labels, value in snapshot['histograms']:
+                key = (metric, tuple(tuple(pair) for pair in labels))
+                total = histograms.setdefault(key, {'buckets': {}, 'count': 0, 'sum': 0.0})
+                for bound, count in value['buckets'].items():
+                    total['buckets'][bound] = total['buckets'].get(bound, 0) + count
+                total['count'] += value['count']
+                total['sum'] += value['sum']
+        return counters, histograms
+
+# Counters and histograms exported on /metrics; see METRIC_HELP for the names
+metrics = MetricsRegistry()
+
+# --- Content-Addressed Image Store ---
+class ImageStore:
+    """Approved media stored once per content hash.
+
+    Blobs live at <folder>/<hash[:2]>/<hash[2:4]>/<hash><ext>. The image_files
+    table maps public filenames to blobs, and image_blobs counts how many
+    names point at each blob, so identical images are only stored once.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def blob_path(self, content_hash, extension):
+        return os.path.join(self.folder, content_hash[:2], content_hash[2:4], f"{content_hash}{extension}")
+
+    def resolve(self, filename):
+        """Return the blob path for a public filename, or None if it isn't in the store."""
+        with db_pool.connection() as db:
+            row = db.execute(
+                'SELECT b.content_hash, b.extension FROM image_files f JOIN image_blobs b ON b.content_hash = f.content_hash '
+                'WHERE f.filename = ?', (filename,)
+            ).fetchone()
+        return self.blob_path(row[0], row[1]) if row else None
+
+    def version(self):
+        return get_app_state('image_store_version')
+
+    def public_names(self):
+        """One public filename per blob, so duplicates aren't weighted up in the random rotation."""
+        with db_pool.connection() as db:
+            return tuple(row[0] for row in db.execute('SELECT MIN(filename) FROM image_files GROUP BY content_hash'))
+
+    def variant_path(self, content_hash, width, extension):
+        """Downscaled copies are keyed by content hash and sit next to the blob."""
+        return os.path.join(self.folder, content_hash[:2], content_hash[2:4], f"{content_hash}_w{width}{extension}")
+
+    def is_blob(self, path):
+        return os.path.dirname(os.path.dirname(os.path.dirname(path))) == self.folder
+
+    def content_hash_for(self, path):
+        """The content hash of a stored blob is its name; other files are hashed."""
+        if self.is_blob(path):
+            return os.path.splitext(os.path.basename(path))[0]
+        return file_content_hash(path)
+
+    def name_taken(self, filename, source_path=None):
+        legacy_path = os.path.join(IMAGES_FOLDER_INTERNAL, filename)
+        if os.path.exists(legacy_path) and (source_path is None or not os.path.samefile(legacy_path, source_path)):
+            return True
+        with db_pool.connection() as db:
+            return db.execute('SELECT 1 FROM image_files WHERE filename = ?', (filename,)).fetchone() is not None
+
+    def add(self, source_path, filename, content_hash, notify=True):
+        """Move a file into the store under a public filename.
+
+        If the name is taken, the start of the hash is appended to it. If the
+        blob already exists, the source file is deleted instead of stored again.
+        Returns (public filename, blob path, whether the blob already existed).
+        """
+        stem, extension = os.path.splitext(filename)
+        extension = extension.lower()
+        if self.name_taken(filename, source_path):
+            filename = f"{stem}_{content_hash[:8]}{extension}"
+
+        existed = False
+        blob_path = None
+        with db_pool.connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT extension FROM image_blobs WHERE content_hash = ?', (content_hash,)).fetchone()
+                existed = row is not None
+                if existed:
+                    blob_path = self.blob_path(content_hash, row[0])
+                else:
+                    blob_path = self.blob_path(content_hash, extension)
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    shutil.move(source_path, blob_path)
+                    content_hashes.discard(source_path)
+                    db.execute('INSERT INTO image_blobs (content_hash, extension, size, ref_count, created_at) VALUES (?, ?, ?, 0, ?)',
+                               (content_hash, extension, os.path.getsize(blob_path), time.time()))
+                db.execute('INSERT INTO image_files (filename, content_hash, created_at) VALUES (?, ?, ?)',
+                           (filename, content_hash, time.time()))
+                db.execute('UPDATE image_blobs SET ref_count = ref_count + 1 WHERE content_hash = ?', (content_hash,))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                if not existed and blob_path is not None and os.path.exists(blob_path) and not os.path.exists(source_path):
+                    shutil.move(blob_path, source_path)
+                raise
+        if existed:
+            os.remove(source_path)
+            content_hashes.discard(source_path)
+        if notify:
+            bump_app_state('image_store_version')
+        return filename, blob_path, existed
+
+image_store = ImageStore(IMAGE_STORE_FOLDER)
+
+def resolve_image_path(filename, must_exist=True):
+    """Return the file behind a public image filename (store first, then the legacy folder), or None.
+
+    With must_exist=False the legacy path is returned without checking it, for
+    callers that stat the file anyway.
+    """
+    blob_path = image_store.resolve(filename)
+    if blob_path is not None:
+        return blob_path
+    legacy_path = os.path.join(IMAGES_FOLDER_INTERNAL, filename)
+    return legacy_path if not must_exist or os.path.isfile(legacy_path) else None
+
+def _hash_library_file(path):
+    return path, file_content_hash(path)
+
+def migrate_library_to_store(workers=None):
+    """Hash the files in IMAGES_FOLDER_INTERNAL on all cores and move them into the image store.
+
+    Files whose content is already stored are deleted and their name pointed at
+    the existing blob. Returns (files moved, duplicates collapsed).
+    """
+    paths = [os.path.join(IMAGES_FOLDER_INTERNAL, f) for f in image_catalog._scan()]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashed = list(pool.map(_hash_library_file, paths, chunksize=64))
+
+    moved = duplicates = 0
+    for path, content_hash in hashed:
+        filename = os.path.basename(path)
+        public_name, blob_path, existed = image_store.add(path, filename, content_hash, notify=False)
+        with db_pool.connection() as db:
+            db.execute('UPDATE photo_requests SET approved_path = ?, filename = ? WHERE approved_path = ?',
+                       (blob_path, public_name, path))
+        duplicates += existed
+        moved += not existed
+    bump_app_state('image_store_version')
+    return moved, duplicates
+
+@app.cli.command('migrate-image-store')
+def migrate_image_store_command():
+    """Move the existing image library into the content-addressed store."""
+    init_app()
+    moved, duplicates = migrate_library_to_store()
+    print(f"Moved {moved} images into the store and collapsed {duplicates} duplicates.", flush=True)
+
+# --- Shared Cache Tier ---
+def _approximate_size(value):
+    """Bytes taken by a cached value and what it contains, as far as JSON-like values go."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_approximate_size(k) + _approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_approximate_size(item) for item in value)
+    return size
+
+class LocalCacheBackend:
+    """LRU cache in this worker's memory. Values are kept as-is, not serialized.
+
+    Bounded by entry count and by the approximate size of the values; a value
+    larger than the whole budget is not cached.
+    """
+
+    name = 'local'
+
+    def __init__(self, max_entries=CACHE_LOCAL_MAX_ENTRIES, max_bytes=CACHE_LOCAL_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        size = _approximate_size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def info(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes}
+
+class SharedMemoryCacheBackend:
+    """Cache shared by every worker on the host through memory-backed files.
+
+    Each entry is one file in CACHE_SHARED_DIR (under /dev/shm, where POSIX
+    shared memory lives, when the host has it): an 8-byte expiry followed by
+    the JSON value. Readers map the file; writers replace it atomically, so no
+    lock is shared between processes and a reader never sees a partial entry.
+    """
+
+    name = 'shared'
+    HEADER = 8
+
+    def __init__(self, folder=CACHE_SHARED_DIR, max_entries=CACHE_SHARED_MAX_ENTRIES):
+        self.folder = folder
+        self.max_entries = max_entries
+        self._writes = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    expires_at = struct.unpack('<d', mapped[:self.HEADER])[0]
+                    if expires_at and expires_at <= time.time():
+                        return None
+                    return json.loads(mapped[self.HEADER:])
+        except (FileNotFoundError, ValueError, struct.error):
+            # ValueError and struct.error: an empty or truncated file
+            return None
+
+    def set(self, key, value, ttl=None):
+        payload = struct.pack('<d', time.time() + ttl if ttl else 0.0) + json.dumps(value).encode('utf-8')
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix='.entry-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._writes += 1
+        if self._writes % 256 == 0:
+            self._trim()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _trim(self):
+        """Remove expired entries, then the least recently written beyond max_entries."""
+        entries = []
+        now = time.time()
+        with os.scandir(self.folder) as scan:
+            for entry in scan:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    with open(entry.path, 'rb') as f:
+                        expires_at = struct.unpack('<d', f.read(self.HEADER))[0]
+                    if expires_at and expires_at <= now:
+                        os.remove(entry.path)
+                    else:
+                        entries.append((entry.stat().st_mtime_ns, entry.path))
+                except (OSError, struct.error):
+                    continue
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def info(self):
+        with os.scandir(self.folder) as scan:
+            return {'entries': sum(1 for entry in scan if not entry.name.startswith('.')), 'folder': self.folder}
+
+class RedisError(Exception):
+    pass
+
+class RedisCacheBackend:
+    """Cache in a Redis server (or anything speaking its protocol), shared by every worker and host.
+
+    A small RESP client over pooled sockets; only GET, SET with PX, DEL and
+    DBSIZE are used. Values are stored as JSON. After a failed connection
+    attempt the server is left alone for RECONNECT_DELAY seconds, so an
+    unreachable server doesn't add a connect timeout to every request.
+    """
+
+    name = 'redis'
+    RECONNECT_DELAY = 5.0
+
+    def __init__(self, url=CACHE_REDIS_URL, timeout=CACHE_REDIS_TIMEOUT, pool_size=8):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._down_until = 0.0
+
+    def _connect(self):
+        if time.monotonic() < self._down_until:
+            raise ConnectionError('Redis server unavailable; waiting before reconnecting')
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError:
+            self._down_until = time.monotonic() + self.RECONNECT_DELAY
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile('rb'))
+        try:
+            if self.password:
+                self._call(conn, 'AUTH', self.password)
+            if self.db:
+                self._call(conn, 'SELECT', self.db)
+        except Exception:
+            self._close(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        conn[1].close()
+        conn[0].close()
+
+    @staticmethod
+    def _encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by the Redis server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError('Connection closed by the Redis server')
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self._read_reply(reader) for _ in range(length)]
+        # The rest of the reply can't be told apart from the next one, so the connection is done for
+        raise ConnectionError(f'Unexpected reply from the Redis server: {line!r}')
+
+    def _call(self, conn, *args):
+        conn[0].sendall(self._encode(args))
+        return self._read_reply(conn[1])
+
+    def command(self, *args):
+        """Send one command on a pooled connection and return its reply."""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        reusable = False
+        try:
+            reply = self._call(conn, *args)
+            reusable = True
+            return reply
+        except RedisError:
+            # An error reply is read in full, so the connection can serve the next command
+            reusable = True
+            raise
+        finally:
+            if reusable:
+                try:
+                    self._pool.put_nowait(conn)
+                except queue.Full:
+                    self._close(conn)
+            else:
+                self._close(conn)
+
+    def get(self, key):
+        data = self.command('GET', key)
+        return None if data is None else json.loads(data)
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.command('SET', key, json.dumps(value), 'PX', int(ttl * 1000))
+        else:
+            self.command('SET', key, json.dumps(value))
+
+    def delete(self, key):
+        self.command('DEL', key)
+
+    def info(self):
+        return {'entries': self.command('DBSIZE'), 'server': f'{self.host}:{self.port}/{self.db}'}
+
+CACHE_BACKENDS = {
+    'local': LocalCacheBackend,
+    'shared': SharedMemoryCacheBackend,
+    'redis': RedisCacheBackend,
+}
+
+class CacheTier:
+    """Namespaced front to the configured cache backend, with hit rates per namespace.
+
+    Backend failures (Redis down, shared memory full) are logged and count as
+    misses, so the cache tier can make the site slower but never break it.
+    Values must be JSON-serializable; tuples come back as lists from the
+    shared and Redis backends.
+    """
+
+    def __init__(self, backend, prefix=CACHE_KEY_PREFIX):
+        self.backend = backend
+        self.prefix = prefix
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._last_error_logged = 0.0
+
+    def _count(self, namespace, name):
+        with self._lock:
+            stats = self._stats.setdefault(namespace, {'hits': 0, 'misses': 0, 'sets': 0, 'errors': 0})
+            stats[name] += 1
+
+    def _error(self, namespace, operation, e):
+        self._count(namespace, 'errors')
+        # One log line a minute is enough to notice a broken backend
+        now = time.monotonic()
+        if now - self._last_error_logged > 60:
+            self._last_error_logged = now
+            logger.warning('Cache tier %s failed on the %s backend: %s', operation, self.backend.name, e)
+
+    def get(self, namespace, key):
+        try:
+            value = self.backend.get(f'{self.prefix}{namespace}:{key}')
+        except Exception as e:
+            self._error(namespace, 'get', e)
+            value = None
+        self._count(namespace, 'misses' if value is None else 'hits')
+        return value
+
+    def set(self, namespace, key, value, ttl=None):
+        try:
+            self.backend.set(f'{self.prefix}{namespace}:{key}', value, ttl)
+            self._count(namespace, 'sets')
+        except Exception as e:
+            self._error(namespace, 'set', e)
+
+    def delete(self, namespace, key):
+        try:
+            self.backend.delete(f'{self.prefix}{namespace}:{key}')
+        except Exception as e:
+            self._error(namespace, 'delete', e)
+
+    def stats(self):
+        with self._lock:
+            namespaces = {namespace: dict(stats) for namespace, stats in self._stats.items()}
+        for stats in namespaces.values():
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        try:
+            backend = self.backend.info()
+        except Exception as e:
+            backend = {'error': str(e)}
+        backend['name'] = self.backend.name
+        return {'backend': backend, 'namespaces': namespaces}
+
+def make_cache_backend(name=CACHE_BACKEND):
+    if name not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown CACHE_BACKEND {name!r}; expected one of {', '.join(CACHE_BACKENDS)}")
+    return CACHE_BACKENDS[name]()
+
+# Cache tier for SauceNao results, catalog snapshots and the MOTD
+cache_tier = CacheTier(make_cache_backend())
+
+# --- Image Catalog ---
+class ImageCatalog:
+    """In-memory list of the media files that can be served.
+
+    That is the files in a folder plus, when a store is given, one public name
+    per blob in the content-addressed image store. The folder is only rescanned
+    when its mtime changes and the store only re-read when its version stamp
+    changes; both are checked at most once every `refresh_interval` seconds, so
+    picking a random file and counting files don't depend on the library size.
+
+    Listings are snapshotted in the cache tier ('catalog' namespace) under
+    the mtime or version they were taken at, so after a change only the first
+    worker to notice scans the folder or queries the store. Moving to a new
+    snapshot deletes the previous one, so each listing is cached only once.
+    """
+
+    def __init__(self, folder, store=None, refresh_interval=CATALOG_REFRESH_INTERVAL, tier=None):
+        self.folder = folder
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.tier = tier or cache_tier
+        self._files = ()
+        self._folder_files = ()
+        self._store_files = ()
+        self._mtime_ns = None
+        self._store_version = None
+        self._snapshot_keys = {}  # 'folder' or 'store' -> key of the snapshot in use
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        metrics.inc('directory_scans_total', (('folder', os.path.basename(self.folder)),))
+        with os.scandir(self.folder) as entries:
+            return tuple(
+                entry.name for entry in entries
+                if entry.name.lower().endswith(MEDIA_EXTENSIONS) and entry.is_file()
+            )
+
+    def _snapshot(self, kind, key, load, force=False):
+        """Return the listing cached under key, or load it and cache it; force always loads."""
+        files = None if force else self.tier.get('catalog', key)
+        if files is None:
+            files = load()
+            self.tier.set('catalog', key, files, CATALOG_SNAPSHOT_TTL)
+        previous_key = self._snapshot_keys.get(kind)
+        if previous_key is not None and previous_key != key:
+            self.tier.delete('catalog', previous_key)
+        self._snapshot_keys[kind] = key
+        return tuple(files)
+
+    def refresh(self, force=False):
+        """Rescan the folder and the store if they changed since the last scan."""
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        with self._lock:
+            if not force and now < self._next_check:
+                return
+            changed = False
+            mtime_ns = os.stat(self.folder).st_mtime_ns
+            if force or mtime_ns != self._mtime_ns:
+                self._folder_files = self._snapshot('folder', f'folder:{self.folder}:{mtime_ns}', self._scan, force)
+                self._mtime_ns = mtime_ns
+                changed = True
+            if self.store is not None:
+                store_version = self.store.version()
+                if force or store_version != self._store_version:
+                    self._store_files = self._snapshot('store', f'store:{store_version}', self.store.public_names, force)
+                    self._store_version = store_version
+                    changed = True
+            if changed:
+                store_names = set(self._store_files)
+                self._files = self._store_files + tuple(f for f in self._folder_files if f not in store_names)
+            self._next_check = now + self.refresh_interval
+
+    def invalidate(self):
+        """Force a rescan on the next access."""
+        self._next_check = 0.0
+        self._mtime_ns = None
+        self._store_version = None
+
+    def add(self, filename):
+        """Make a file that was just approved visible immediately."""
+        if not filename.lower().endswith(MEDIA_EXTENSIONS):
+            return
+        with self._lock:
+            if filename not in self._files:
+                self._files = self._files + (filename,)
+
+    def files(self):
+        self.refresh()
+        return self._files
+
+    def folder_files(self):
+        """The media files in the folder itself, without the store's public names."""
+        self.refresh()
+        return self._folder_files
+
+    def count(self):
+        return len(self.files())
+
+    def random_choice(self):
+        """Return a random filename, or None if there is no media."""
+        files = self.files()
+        return random.choice(files) if files else None
+
+image_catalog = ImageCatalog(IMAGES_FOLDER_INTERNAL, image_store)
+
+class LegacyContentIndex:
+    """Finds files in the catalog's folder by content, for the duplicate check on uploads.
+
+    Files are grouped by size whenever the folder listing changes, and only the
+    ones the size of the upload are hashed; file_content_hash remembers each
+    digest while the file's size and mtime stay the same. Once the library has
+    been moved into the image store the folder is empty and this costs nothing.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._files = None
+        self._by_size = {}
+        self._lock = threading.Lock()
+
+    def find(self, content_hash, size):
+        """Return the name of a file with this content, or None."""
+        files = self.catalog.folder_files()
+        with self._lock:
+            if files is not self._files:
+                by_size = {}
+                for filename in files:
+                    try:
+                        by_size.setdefault(os.path.getsize(os.path.join(self.catalog.folder, filename)), []).append(filename)
+                    except OSError:
+                        continue
+                self._files, self._by_size = files, by_size
+            candidates = self._by_size.get(size, ())
+        for filename in candidates:
+            try:
+                if file_content_hash(os.path.join(self.catalog.folder, filename)) == content_hash:
+                    return filename
+            except OSError:
+                continue
+        return None
+
+legacy_content_index = LegacyContentIndex(image_catalog)
+
+def library_has_content(content_hash, size):
+    """Whether an image with this content is already in the library, in the store or the legacy folder."""
+    with db_pool.connection() as db:
+        if db.execute('SELECT 1 FROM image_blobs WHERE content_hash = ?', (content_hash,)).fetchone():
+            return True
+    return legacy_content_index.find(content_hash, size) is not None
+
+# --- Random Selection ---
+class AliasSampler:
+    """Weighted random choice in O(1) with Vose's alias method.
+
+    Changing a weight doesn't rebuild the table. Added weight goes into a small
+    overflow list that is sampled separately, and removed weight is rejected at
+    sampling time. The table is only rebuilt once the overflow list or the
+    rejected share grows past a fixed bound, so the cost of a draw doesn't
+    depend on the number of items.
+    """
+
+    MAX_OVERFLOW = 256
+    MAX_DEAD_SHARE = 0.25
+
+    def __init__(self):
+        self._items = []
+        self._built = []  # Weight of each item when the table was built
+        self._prob = []
+        self._alias = []
+        self._table_total = 0.0
+        self._table_weights = {}
+        self._current = {}
+        self._overflow = {}
+        self._overflow_total = 0.0
+        self._dead = 0.0
+
+    def build(self, weights):
+        """Rebuild the table from {item: weight}."""
+        items = [item for item, weight in weights.items() if weight > 0]
+        built = [float(weights[item]) for item in items]
+        n = len(items)
+        total = sum(built)
+        prob, alias = [0.0] * n, [0] * n
+        if n:
+            scaled = [weight * n / total for weight in built]
+            small = [i for i, p in enumerate(scaled) if p < 1.0]
+            large = [i for i, p in enumerate(scaled) if p >= 1.0]
+            while small and large:
+                s, l = small.pop(), large.pop()
+                prob[s], alias[s] = scaled[s], l
+                scaled[l] -= 1.0 - scaled[s]
+                (small if scaled[l] < 1.0 else large).append(l)
+            for i in small + large:
+                prob[i] = 1.0
+        self._items, self._built, self._prob, self._alias = items, built, prob, alias
+        self._table_total = total
+        self._table_weights = dict(zip(items, built))
+        self._current = dict(zip(items, built))
+        self._overflow = {}
+        self._overflow_total = 0.0
+        self._dead = 0.0
+
+    def set(self, item, weight):
+        """Change one item's weight; a weight of 0 removes it."""
+        built = self._table_weights.get(item, 0.0)
+        old = self._current.get(item, 0.0)
+        self._overflow_total += max(0.0, weight - built) - max(0.0, old - built)
+        self._dead += max(0.0, built - weight) - max(0.0, built - old)
+        if weight > built:
+            self._overflow[item] = weight - built
+        else:
+            self._overflow.pop(item, None)
+        if weight > 0:
+            self._current[item] = weight
+        else:
+            self._current.pop(item, None)
+        if len(self._overflow) > self.MAX_OVERFLOW or self._dead > self.MAX_DEAD_SHARE * self._table_total:
+            self.build(self._current)
+
+    def sample(self):
+        """Return an item with probability proportional to its weight, or None if there are none."""
+        while True:
+            total = self._table_total + self._overflow_total
+            if not self._current or total <= 0:
+                return None
+            r = random.random() * total
+            if r < self._table_total:
+                i = int(random.random() * len(self._items))
+                if random.random() >= self._prob[i]:
+                    i = self._alias[i]
+                item, built = self._items[i], self._built[i]
+                current = self._current.get(item, 0.0)
+                # Items whose weight dropped since the build are kept with probability current / built
+                if current >= built or random.random() * built < current:
+                    return item
+            else:
+                r -= self._table_total
+                for item, extra in self._overflow.items():
+                    r -= extra
+                    if r < 0:
+                        return item
+                if self._overflow:
+                    return item
+
+    def __len__(self):
+        return len(self._current)
+
+def _permute(index, n, seed):
+    """Keyed bijection on range(n): a 4-round Feistel network, cycle-walked back into range."""
+    bits = max(2, (n - 1).bit_length())
+    bits += bits & 1
+    half = bits // 2
+    mask = (1 << half) - 1
+    x = index
+    while True:
+        left, right = x >> half, x & mask
+        for round_number in range(4):
+            left, right = right, left ^ (hash((seed, round_number, right)) & mask)
+        x = (left << half) | right
+        if x < n:
+            return x
+
+class SelectionEngine:
+    """Picks images from the catalog, honouring per-image weights.
+
+    An image's weight is its admin-set base weight from image_weights, halved
+    per visitor report (up to MAX_REPORT_DEMOTIONS times) and multiplied by
+    NEW_IMAGE_BOOST for NEW_IMAGE_BOOST_DAYS after approval; images without a
+    row weigh 1. Independent draws use an AliasSampler that is updated in place
+    when the catalog or the weights change.
+
+    Shuffle-bag picks walk a keyed permutation of the bag's slots, so a session
+    only needs to keep (seed, cursor, size, bag fingerprint) to get every slot
+    exactly once per pass. An image of weight w has ceil(w) slots, each shown
+    with probability w / ceil(w): a weight of 2.5 comes up 2.5 times per pass
+    on average and a weight of 0.25 once every four passes. Every turn,
+    boosted ones included, is a slot of the permutation, so an image of
+    weight 1 never comes up twice in a pass.
+    """
+
+    def __init__(self, catalog, refresh_interval=CATALOG_REFRESH_INTERVAL):
+        self.catalog = catalog
+        self.refresh_interval = refresh_interval
+        self.sampler = AliasSampler()
+        self._files = None
+        self._present = frozenset()
+        self._ordered = ()
+        self._fingerprint = 0
+        self._slot_ends = None  # Cumulative slot counts in _ordered, or None while every image has one slot
+        self._weights = {}  # filename -> weight, only for images that don't weigh 1
+        self._weights_version = None
+        self._next_check = 0.0
+        self._next_expiry = float('inf')
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Pick up catalog and weight changes; weights are checked at most every refresh_interval."""
+        files = self.catalog.files()
+        now = time.monotonic()
+        if files is self._files and now < self._next_check and time.time() < self._next_expiry:
+            return
+        with self._lock:
+            if files is not self._files:
+                self._sync_files(files)
+            if now >= self._next_check or time.time() >= self._next_expiry:
+                version = get_app_state('image_weights_version')
+                if version != self._weights_version or time.time() >= self._next_expiry:
+                    self._load_weights()
+                    self._weights_version = version
+                self._next_check = now + self.refresh_interval
+
+    def _sync_files(self, files):
+        present = frozenset(files)
+        if self._files is None:
+            self.sampler.build({f: self._weights.get(f, 1.0) for f in files})
+        else:
+            for filename in present - self._present:
+                self.sampler.set(filename, self._weights.get(filename, 1.0))
+            for filename in self._present - present:
+                self.sampler.set(filename, 0.0)
+        self._files = files
+        self._present = present
+        self._ordered = tuple(sorted(files))
+        self._build_bag()
+
+    def _build_bag(self):
+        """Lay out the shuffle bag's slots; the fingerprint changes whenever they do."""
+        slot_ends = None
+        if any(weight > 1.0 for weight in self._weights.values()):
+            slot_ends = list(itertools.accumulate(
+                max(1, math.ceil(self._weights.get(filename, 1.0))) for filename in self._ordered))
+        fingerprint = zlib.crc32('\n'.join(self._ordered).encode('utf-8'))
+        if slot_ends is not None:
+            fingerprint = zlib.crc32(struct.pack(f'<{len(slot_ends)}Q', *slot_ends), fingerprint)
+        self._slot_ends = slot_ends
+        self._fingerprint = fingerprint
+
+    def _load_weights(self):
+        with db_pool.connection() as db:
+            rows = db.execute('SELECT filename, weight, reports, boost_until FROM image_weights').fetchall()
+        wall_clock = time.time()
+        weights, next_expiry = {}, float('inf')
+        for filename, base_weight, reports, boost_until in rows:
+            weight = base_weight * REPORT_DEMOTION ** min(reports, MAX_REPORT_DEMOTIONS)
+            if boost_until and boost_until > wall_clock:
+                weight *= NEW_IMAGE_BOOST
+                next_expiry = min(next_expiry, boost_until)
+            if weight != 1.0:
+                weights[filename] = weight
+        for filename in set(self._weights) | set(weights):
+            if filename in self._present and self._weights.get(filename, 1.0) != weights.get(filename, 1.0):
+                self.sampler.set(filename, weights.get(filename, 1.0))
+        changed = weights != self._weights
+        self._weights = weights
+        self._next_expiry = next_expiry
+        if changed:
+            self._build_bag()
+
+    def contains(self, filename):
+        self.refresh()
+        return filename in self._present
+
+    def weight(self, filename):
+        return self._weights.get(filename, 1.0)
+
+    def choice(self):
+        """Independent weighted draw, or None if there is no media."""
+        self.refresh()
+        with self._lock:
+            return self.sampler.sample()
+
+    def next_for_session(self, state):
+        """Return (filename, new state) from a session's shuffle bag; filename is None if there is no media."""
+        self.refresh()
+        with self._lock:
+            ordered, fingerprint, slot_ends, weights = self._ordered, self._fingerprint, self._slot_ends, self._weights
+        if not ordered:
+            return None, state
+        n = slot_ends[-1] if slot_ends else len(ordered)
+        try:
+            seed, cursor, size, bag_fingerprint = state
+        except (TypeError, ValueError):
+            seed, cursor, size, bag_fingerprint = random.getrandbits(32), 0, n, fingerprint
+        if size != n or bag_fingerprint != fingerprint:
+            # The catalog changed, so the old permutation no longer lines up with it
+            seed, cursor, size, bag_fingerprint = random.getrandbits(32), 0, n, fingerprint
+
+        filename = None
+        for _ in range(2 * n + 16):
+            if cursor >= n:
+                # Every slot had its turn; start a new permutation
+                seed, cursor = random.getrandbits(32), 0
+            slot = _permute(cursor, n, seed)
+            filename = ordered[bisect.bisect_right(slot_ends, slot) if slot_ends else slot]
+            cursor += 1
+            weight = weights.get(filename, 1.0)
+            if weight == 1.0 or random.random() * math.ceil(weight) < weight:
+                break
+        return filename, [seed, cursor, size, bag_fingerprint]
+
+selection_engine = SelectionEngine(image_catalog)
+
+IMAGE_BOOST_SQL = ('INSERT INTO image_weights (filename, boost_until, boosted_at) VALUES (?, ?, ?) '
+                   'ON CONFLICT(filename) DO UPDATE SET boost_until = excluded.boost_until, boosted_at = excluded.boosted_at')
+
+def image_boost_args(filename, now):
+    return (filename, now + NEW_IMAGE_BOOST_DAYS * 24 * 3600, now)
+
+def boost_new_image(filename):
+    """Give a newly approved image NEW_IMAGE_BOOST times its weight for NEW_IMAGE_BOOST_DAYS."""
+    with db_pool.connection() as db:
+        db.execute(IMAGE_BOOST_SQL, image_boost_args(filename, time.time()))
+    bump_app_state('image_weights_version')
+
+def report_image(filename, client):
+    """Count a report of an image from a client address, once per address.
+
+    Returns 'reported', 'duplicate' if the address already reported the
+    image, or 'rate_limited' if it filed REPORT_RATE_LIMIT reports in the
+    last hour.
+    """
+    now = time.time()
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            recent = db.execute('SELECT COUNT(*) FROM image_reports WHERE client = ? AND reported_at > ?',
+                                (client, now - 3600)).fetchone()[0]
+            if recent >= REPORT_RATE_LIMIT:
+                outcome = 'rate_limited'
+            elif db.execute('INSERT OR IGNORE INTO image_reports (filename, client, reported_at) VALUES (?, ?, ?)',
+                            (filename, client, now)).rowcount:
+                db.execute('INSERT INTO image_weights (filename, reports) VALUES (?, 1) '
+                           'ON CONFLICT(filename) DO UPDATE SET reports = reports + 1', (filename,))
+                db.execute(APP_STATE_BUMP_SQL, ('image_weights_version',))
+                outcome = 'reported'
+            else:
+                outcome = 'duplicate'
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    return outcome
+
+def set_image_weight(filename, weight):
+    """Set an image's base weight and clear its reports, so it can be reported again."""
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT INTO image_weights (filename, weight) VALUES (?, ?) '
+                       'ON CONFLICT(filename) DO UPDATE SET weight = excluded.weight, reports = 0', (filename, weight))
+            db.execute('DELETE FROM image_reports WHERE filename = ?', (filename,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    bump_app_state('image_weights_version')
+
+def get_image_weights(filenames):
+    """Return {filename: row} for the image_weights rows of the given filenames."""
+    weights = {}
+    if filenames:
+        placeholders = ', '.join('?' * len(filenames))
+        for row in query_db(f'SELECT filename, weight, reports, boost_until FROM image_weights WHERE filename IN ({placeholders})', filenames):
+            weights[row['filename']] = row
+    return weights
+
+# --- SauceNao HTTP Client ---
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling SauceNao while the circuit breaker is open."""
+
+class LatencyHistogram:
+    """Cumulative latency histogram with fixed bucket bounds in seconds."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'buckets': buckets, 'count': self.count, 'sum': self.total}
+
+class SauceNaoClient:
+    """Shared keep-alive session for SauceNao with timeouts, retries and a circuit breaker."""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, url, connect_timeout=SAUCENAO_CONNECT_TIMEOUT, read_timeout=SAUCENAO_READ_TIMEOUT,
+                 max_retries=SAUCENAO_MAX_RETRIES, pool_size=SAUCENAO_POOL_SIZE,
+                 breaker_threshold=SAUCENAO_BREAKER_THRESHOLD, breaker_cooldown=SAUCENAO_BREAKER_COOLDOWN):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._histograms = {}
+
+    def _observe(self, outcome, seconds):
+        with self._lock:
+            self._histograms.setdefault(outcome, LatencyHistogram()).observe(seconds)
+
+    def _record_result(self, ok):
+        with self._lock:
+            if ok:
+                self._consecutive_failures = 0
+                self._open_until = 0.0
+            else:
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= self.breaker_threshold:
+                    self._open_until = time.monotonic() + self.breaker_cooldown
+
+    def _allow_request(self):
+        with self._lock:
+            if self._open_until and time.monotonic() < self._open_until:
+                return False
+            if self._open_until:
+                # Half-open: let one request through and keep failing fast until it finishes
+                self._open_until = time.monotonic() + self.breaker_cooldown
+            return True
+
+    def _backoff(self, attempt, response):
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), 30.0)
+        return random.uniform(0, min(8.0, 0.5 * 2 ** attempt))
+
+    def post(self, data, files):
+        """POST to SauceNao, retrying transient failures. Raises for the final failure."""
+        if not self._allow_request():
+            self._observe('circuit_open', 0.0)
+            raise CircuitOpenError('SauceNao circuit breaker is open; skipping lookup.')
+
+        for attempt in range(self.max_retries + 1):
+            response = None
+            start = time.monotonic()
+            try:
+                response = self.session.post(self.url, data=data, files=files, timeout=self.timeout)
+            except requests.exceptions.Timeout:
+                outcome = 'timeout'
+            except requests.exceptions.ConnectionError:
+                outcome = 'connection_error'
+            else:
+                if response.status_code == 429:
+                    outcome = 'rate_limited'
+                elif response.status_code >= 400:
+                    outcome = 'http_error'
+                else:
+                    outcome = 'success'
+            self._observe(outcome, time.monotonic() - start)
+
+            if outcome == 'success':
+                self._record_result(True)
+                return response
+            retryable = response is None or response.status_code in self.RETRY_STATUSES
+            if not retryable or attempt == self.max_retries:
+                break
+            time.sleep(self._backoff(attempt, response))
+
+        # Client errors other than 429 say nothing about SauceNao's health
+        self._record_result(response is not None and response.status_code < 500 and response.status_code != 429)
+        if response is None:
+            raise requests.exceptions.ConnectionError(f'SauceNao request failed ({outcome}).')
+        response.raise_for_status()
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'circuit_open': bool(self._open_until) and time.monotonic() < self._open_until,
+                'consecutive_failures': self._consecutive_failures,
+                'latency': {outcome: h.snapshot() for outcome, h in self._histograms.items()},
+            }
+
+saucenao_client = SauceNaoClient(SAUCENAO_API_URL)
+
+# --- SauceNao Source Cache ---
+class ContentHashCache:
+    """SHA-256 digests of files by path, reused while a file's size and mtime are unchanged.
+
+    The least recently used digests beyond `size` are dropped, and moderation
+    drops the digest of a file it moves or deletes.
+    """
+
+    def __init__(self, size=CONTENT_HASH_CACHE_SIZE):
+        self.size = size
+        self._digests = OrderedDict()  # path -> ((mtime_ns, size), digest)
+        self._hashing = set()  # Paths warm() handed to an executor that haven't finished
+        self._lock = threading.Lock()
+
+    def peek(self, path, st=None):
+        """The cached digest of a file if it is still current, else None; never reads the file."""
+        with self._lock:
+            entry = self._digests.get(path)
+        if entry is None:
+            return None
+        st = st or os.stat(path)
+        if entry[0] != (st.st_mtime_ns, st.st_size):
+            return None
+        with self._lock:
+            if path in self._digests:
+                self._digests.move_to_end(path)
+        return entry[1]
+
+    def get(self, path):
+        st = os.stat(path)
+        content_hash = self.peek(path, st)
+        if content_hash is not None:
+            return content_hash
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        with self._lock:
+            self._digests[path] = ((st.st_mtime_ns, st.st_size), content_hash)
+            self._digests.move_to_end(path)
+            while len(self._digests) > self.size:
+                self._digests.popitem(last=False)
+        return content_hash
+
+    def warm(self, path, executor):
+        """Hash a file on the executor, unless it is being hashed already."""
+        with self._lock:
+            if path in self._hashing:
+                return
+            self._hashing.add(path)
+
+        def run():
+            try:
+                self.get(path)
+            except OSError:
+                pass
+            finally:
+                with self._lock:
+                    self._hashing.discard(path)
+
+        executor.submit(run)
+
+    def discard(self, path):
+        with self._lock:
+            self._digests.pop(path, None)
+
+content_hashes = ContentHashCache()
+
+def file_content_hash(path):
+    """Return the SHA-256 of a file, reusing the last digest while size and mtime are unchanged."""
+    return content_hashes.get(path)
+
+class SourceCache:
+    """SauceNao results keyed by image content hash.
+
+    The cache tier ('source' namespace) sits in front of the `source_cache`
+    SQLite table, so results survive restarts and are shared between workers.
+    Empty result lists are cached too, with a shorter TTL.
+    """
+
+    def __init__(self, tier=None, max_rows=SOURCE_CACHE_MAX_ROWS,
+                 ttl=SOURCE_CACHE_TTL, negative_ttl=SOURCE_CACHE_NEGATIVE_TTL):
+        self.tier = tier or cache_tier
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._stats = {'tier_hits': 0, 'db_hits': 0, 'misses': 0, 'expired': 0, 'db_evictions': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _remember(self, content_hash, results, expires_at):
+        self.tier.set('source', content_hash, results, expires_at - time.time())
+
+    def get(self, content_hash, count=True):
+        """Return cached results for a hash, or None if there is no fresh entry.
+
+        count=False leaves the hit and miss statistics alone, for re-checks that
+        are not a visitor's lookup.
+        """
+        results = self.tier.get('source', content_hash)
+        if results is not None:
+            if count:
+                self._count('tier_hits')
+            return results
+
+        now = time.time()
+        try:
+            with db_pool.connection() as db:
+                row = db.execute('SELECT results, expires_at FROM source_cache WHERE content_hash = ?',
+                                 (content_hash,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error('Error reading source cache: %s', e)
+            row = None
+
+        if row is None:
+            if count:
+                self._count('misses')
+            return None
+        if row[1] <= now:
+            if count:
+                self._count('expired')
+                self._count('misses')
+            return None
+
+        results = json.loads(row[0])
+        self._remember(content_hash, results, row[1])
+        if count:
+            self._count('db_hits')
+        return results
+
+    def put(self, content_hash, results, wait=False):
+        """Cache results in the cache tier now and write them to SQLite on the thread pool.
+
+        wait=True writes to SQLite before returning, so other workers can read
+        the results as soon as this call is done.
+        """
+        expires_at = time.time() + (self.ttl if results else self.negative_ttl)
+        self._remember(content_hash, results, expires_at)
+        if wait:
+            self._persist(content_hash, json.dumps(results), expires_at)
+        else:
+            thread_pool.submit(self._persist, content_hash, json.dumps(results), expires_at)
+
+    def _persist(self, content_hash, results_json, expires_at):
+        try:
+            with db_pool.connection() as db:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute('INSERT OR REPLACE INTO source_cache (content_hash, results, expires_at, created_at) VALUES (?, ?, ?, ?)',
+                           (content_hash, results_json, expires_at, time.time()))
+                # Drop expired rows, then the oldest rows beyond the size bound
+                evicted = db.execute('DELETE FROM source_cache WHERE expires_at <= ?', (time.time(),)).rowcount
+                evicted += db.execute(
+                    'DELETE FROM source_cache WHERE content_hash IN ('
+                    'SELECT content_hash FROM source_cache ORDER BY created_at '
+                    'LIMIT MAX(0, (SELECT COUNT(*) FROM source_cache) - ?))',
+                    (self.max_rows,)
+                ).rowcount
+                db.execute('COMMIT')
+            if evicted:
+                self._count('db_evictions', evicted)
+        except sqlite3.Error as e:
+            logger.error('Error writing source cache: %s', e)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['tier_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['tier_hits'] + stats['db_hits']) / lookups if lookups else 0.0
+        return stats
+
+# Cache for source information results
+source_cache = SourceCache()
+
+class SourceLookupFlight:
+    """Single-flight SauceNao lookups: concurrent lookups of one image share a request.
+
+    Within a worker, the first thread to ask for a content hash leads and the
+    others wait on its Future. Across workers, the leader holds a row in
+    source_leases while it calls SauceNao; a leader in another worker that
+    finds the row waits for it to go away and then reads the source cache.
+    A lease that outlives SOURCE_LEASE_TTL is taken over.
+
+    The lookup callable returns results or None on failure; failures are
+    shared with every waiter too, rather than retried by each of them.
+    """
+
+    def __init__(self, lease_ttl=SOURCE_LEASE_TTL, poll_interval=SOURCE_LEASE_POLL_INTERVAL):
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'lookups': 0, 'coalesced_local': 0, 'coalesced_remote': 0,
+                       'cache_rechecks': 0, 'lease_takeovers': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _begin(self, content_hash):
+        with self._lock:
+            future = self._inflight.get(content_hash)
+            if future is not None:
+                self._stats['coalesced_local'] += 1
+                return future, False
+            future = Future()
+            self._inflight[content_hash] = future
+            return future, True
+
+    def _complete(self, content_hash, future, lookup):
+        try:
+            future.set_result(self._lead(content_hash, lookup))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._inflight[content_hash]
+
+    def run(self, content_hash, lookup):
+        """Return lookup()'s results for a hash, sharing them with concurrent callers."""
+        future, leader = self._begin(content_hash)
+        if leader:
+            self._complete(content_hash, future, lookup)
+        return future.result()
+
+    def submit(self, content_hash, lookup, executor):
+        """Like run(), but return a Future; a new lookup runs on the executor."""
+        future, leader = self._begin(content_hash)
+        if leader:
+            executor.submit(self._complete, content_hash, future, lookup)
+        return future
+
+    def _try_lease(self, content_hash, owner):
+        """Take the lease for a hash; returns True if this caller now holds it."""
+        now = time.time()
+        with db_pool.connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT expires_at FROM source_leases WHERE content_hash = ?',
+                                 (content_hash,)).fetchone()
+                acquired = row is None or row[0] <= now
+                if acquired:
+                    db.execute('INSERT OR REPLACE INTO source_leases (content_hash, owner, expires_at) VALUES (?, ?, ?)',
+                               (content_hash, owner, now + self.lease_ttl))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        if acquired and row is not None:
+            self._count('lease_takeovers')
+        return acquired
+
+    def _lease_held(self, content_hash):
+        with db_pool.connection() as db:
+            row = db.execute('SELECT 1 FROM source_leases WHERE content_hash = ? AND expires_at > ?',
+                             (content_hash, time.time())).fetchone()
+        return row is not None
+
+    def _release(self, content_hash, owner):
+        with db_pool.connection() as db:
+            db.execute('DELETE FROM source_leases WHERE content_hash = ? AND owner = ?', (content_hash, owner))
+
+    def _lead(self, content_hash, lookup):
+        owner = f'{os.getpid()}:{threading.get_ident()}'
+        waited = False
+        while not self._try_lease(content_hash, owner):
+            if not waited:
+                self._count('coalesced_remote')
+                waited = True
+            time.sleep(self.poll_interval)
+            if not self._lease_held(content_hash):
+                # The other worker finished; None here means its lookup failed
+                return source_cache.get(content_hash, count=False)
+
+        try:
+            # A lookup that finished between the caller's cache check and this lease is not repeated
+            results = source_cache.get(content_hash, count=False)
+            if results is not None:
+                self._count('cache_rechecks')
+                return results
+            self._count('lookups')
+            results = lookup()
+            if results is not None:
+                source_cache.put(content_hash, results, wait=True)
+            return results
+        finally:
+            self._release(content_hash, owner)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._inflight)
+        return stats
+
+# Coalesces concurrent SauceNao lookups by content hash
+source_lookups = SourceLookupFlight()
+
+# --- Source Lookup Prefetch ---
+# Token buckets shared by every worker through the rate_limits table: (capacity, refill period in seconds)
+SAUCENAO_RATE_LIMITS = {
+    'saucenao_short': (SAUCENAO_SHORT_LIMIT, 30),
+    'saucenao_long': (SAUCENAO_LONG_LIMIT, 24 * 3600),
+}
+
+_prefetch_wakeup = threading.Event()
+_prefetch_started = False
+_prefetch_start_lock = threading.Lock()
+
+def acquire_saucenao_token():
+    """Take one token from every SauceNao bucket.
+
+    Returns 0 on success, otherwise the number of seconds until a token is
+    available. Nothing is taken unless all buckets have a token.
+    """
+    now = time.time()
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            buckets = {}
+            wait = 0.0
+            for name, (capacity, period) in SAUCENAO_RATE_LIMITS.items():
+                row = db.execute('SELECT tokens, updated_at FROM rate_limits WHERE name = ?', (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * capacity / period)
+                buckets[name] = tokens
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) * period / capacity)
+            if wait == 0.0:
+                for name in buckets:
+                    buckets[name] -= 1
+            for name, tokens in buckets.items():
+                db.execute('INSERT OR REPLACE INTO rate_limits (name, tokens, updated_at) VALUES (?, ?, ?)',
+                           (name, tokens, now))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    return wait
+
+SOURCE_LOOKUP_ENQUEUE_SQL = (
+    'INSERT INTO source_lookup_jobs (filename, priority) VALUES (?, ?) '
+    'ON CONFLICT(filename) DO UPDATE SET priority = MAX(priority, excluded.priority), '
+    'status = CASE WHEN status = \'running\' THEN status ELSE \'queued\' END, '
+    'attempts = CASE WHEN status IN (\'done\', \'failed\') THEN 0 ELSE attempts END, '
+    'next_attempt_at = CASE WHEN status IN (\'done\', \'failed\') THEN 0 ELSE next_attempt_at END'
+)
+
+def enqueue_source_lookup(filename, priority=0):
+    """Queue a background SauceNao lookup for an image in the library."""
+    with db_pool.connection() as db:
+        db.execute(SOURCE_LOOKUP_ENQUEUE_SQL, (filename, priority))
+    _prefetch_wakeup.set()
+
+def enqueue_library_backfill():
+    """Queue lookups for library images that have never been queued."""
+    with db_pool.connection() as db:
+        db.execute('BEGIN')
+        db.executemany('INSERT OR IGNORE INTO source_lookup_jobs (filename) VALUES (?)',
+                       ((f,) for f in image_catalog.files()))
+        db.execute('COMMIT')
+
+def _claim_source_lookup():
+    now = time.time()
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        # Jobs whose claim wasn't renewed for SOURCE_LOOKUP_CLAIM_TIMEOUT belong to a worker that died
+        row = db.execute(
+            'SELECT filename, attempts FROM source_lookup_jobs '
+            'WHERE (status = \'queued\' AND next_attempt_at <= ?) OR (status = \'running\' AND claimed_at < ?) '
+            'ORDER BY priority DESC, next_attempt_at LIMIT 1',
+            (now, now - SOURCE_LOOKUP_CLAIM_TIMEOUT)
+        ).fetchone()
+        if row is not None:
+            db.execute('UPDATE source_lookup_jobs SET status = \'running\', claimed_at = ? WHERE filename = ?',
+                       (now, row[0]))
+        db.execute('COMMIT')
+    return row
+
+def _renew_source_lookup_claim(filename):
+    """Keep a job that is waiting for a SauceNao token from looking abandoned."""
+    with db_pool.connection() as db:
+        db.execute('UPDATE source_lookup_jobs SET claimed_at = ? WHERE filename = ? AND status = \'running\'',
+                   (time.time(), filename))
+
+def _finish_source_lookup(filename, attempts, error=None):
+    with db_pool.connection() as db:
+        if error is None:
+            db.execute('UPDATE source_lookup_jobs SET status = \'done\', last_error = NULL WHERE filename = ?', (filename,))
+        else:
+            attempts += 1
+            status = 'failed' if attempts >= SOURCE_PREFETCH_MAX_ATTEMPTS else 'queued'
+            db.execute('UPDATE source_lookup_jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE filename = ?',
+                       (status, attempts, time.time() + 60 * 2 ** attempts, error, filename))
+
+def process_source_lookup(filename, attempts):
+    """Run one queued lookup and store the result in the source cache."""
+    image_full_path = resolve_image_path(filename)
+    if image_full_path is None:
+        with db_pool.connection() as db:
+            db.execute('DELETE FROM source_lookup_jobs WHERE filename = ?', (filename,))
+        return
+
+    content_hash = file_content_hash(image_full_path)
+    count = True
+    while True:
+        # Another worker or a visitor may have looked the image up while this job waited for a token
+        if source_cache.get(content_hash, count=count) is not None:
+            _finish_source_lookup(filename, attempts)
+            return
+        count = False
+        wait = acquire_saucenao_token()
+        if not wait:
+            break
+        _renew_source_lookup_claim(filename)
+        time.sleep(min(wait, SOURCE_TOKEN_POLL_INTERVAL))
+
+    saucenao_results = source_lookups.run(content_hash, lambda: fetch_saucenao_results(image_full_path, filename))
+    if saucenao_results is None:
+        _finish_source_lookup(filename, attempts, error='SauceNao lookup failed')
+    else:
+        _finish_source_lookup(filename, attempts)
+
+def _source_prefetch_loop():
+    try:
+        enqueue_library_backfill()
+    except Exception as e:
+        logger.error('Error queueing source lookups for the library: %s', e)
+
+    while True:
+        try:
+            job = _claim_source_lookup()
+            if job is None:
+                _prefetch_wakeup.wait(10)
+                _prefetch_wakeup.clear()
+                continue
+            process_source_lookup(job[0], job[1])
+        except Exception as e:
+            logger.exception('Error in source prefetch worker: %s', e)
+            time.sleep(5)
+
+def start_source_prefetcher():
+    """Start this process's background lookup thread once."""
+    global _prefetch_started
+    if not SOURCE_PREFETCH_ENABLED or _prefetch_started:
+        return
+    with _prefetch_start_lock:
+        if not _prefetch_started:
+            threading.Thread(target=_source_prefetch_loop, name='source-prefetch', daemon=True).start()
+            _prefetch_started = True
+
+# --- Upload Ingestion ---
+class HashingUploadFile:
+    """Temporary file in the pending folder that hashes an upload while Werkzeug streams it in.
+
+    commit() renames it into place atomically; uploads that are never
+    committed are removed when the request ends.
+    """
+
+    def __init__(self, folder):
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix='.upload-', suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def commit(self, destination_path):
+        self._file.close()
+        os.replace(self.path, destination_path)
+        self.committed = True
+
+    def discard(self):
+        self._file.close()
+        if not self.committed:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+class IngestRequest(Request):
+    """Request that streams uploaded files to disk through HashingUploadFile."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = HashingUploadFile(PENDING_UPLOADS_FOLDER)
+        g.setdefault('_uploads', []).append(upload)
+        return upload
+
+app.request_class = IngestRequest
+
+@app.teardown_request
+def discard_uploads(exception):
+    for upload in g.pop('_uploads', []):
+        upload.discard()
+
+# --- Perceptual Hashing ---
+def perceptual_hash(path):
+    """64-bit difference hash (dHash) of an image, or None for videos and unreadable files."""
+    if Image is None or path.lower().endswith(VIDEO_EXTENSIONS):
+        return None
+    try:
+        with Image.open(path) as img:
+            # Let JPEG decode at reduced size; the hash only needs 9x8 pixels
+            img.draft('L', (64, 64))
+            pixels = list(img.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    except Exception as e:
+        logger.warning('Error computing perceptual hash for %s: %s', path, e)
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def _to_sqlite_int(phash):
+    # SQLite integers are signed 64-bit
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+def _from_sqlite_int(value):
+    return value & 0xFFFFFFFFFFFFFFFF
+
+class PerceptualIndex:
+    """Multi-index hash table for Hamming-distance search over library perceptual hashes.
+
+    The 64-bit hash is split into four 16-bit chunks with a table per chunk. Two
+    hashes within distance d share at least one chunk within d // 4, so a query
+    only probes chunk values that close to its own and verifies those candidates.
+    New rows in image_phashes are picked up incrementally by rowid.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self, threshold=PHASH_MATCH_THRESHOLD):
+        self.threshold = threshold
+        self._tables = [{} for _ in range(self.CHUNKS)]
+        self._entries = {}  # content_hash -> (phash, filename)
+        self._last_rowid = 0
+        self._lock = threading.Lock()
+        radius = threshold // self.CHUNKS
+        self._probe_masks = [m for m in range(1 << self.CHUNK_BITS) if bin(m).count('1') <= radius]
+
+    def _chunks(self, phash):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(phash >> (i * self.CHUNK_BITS)) & mask for i in range(self.CHUNKS)]
+
+    def _insert(self, content_hash, phash, filename):
+        if content_hash in self._entries:
+            return
+        self._entries[content_hash] = (phash, filename)
+        for table, chunk in zip(self._tables, self._chunks(phash)):
+            table.setdefault(chunk, []).append(content_hash)
+
+    def sync(self):
+        """Load rows added to image_phashes since the last sync."""
+        with self._lock:
+            with db_pool.connection() as db:
+                rows = db.execute('SELECT rowid, content_hash, phash, filename FROM image_phashes WHERE rowid > ? ORDER BY rowid',
+                                  (self._last_rowid,)).fetchall()
+            for rowid, content_hash, phash, filename in rows:
+                self._insert(content_hash, _from_sqlite_int(phash), filename)
+                self._last_rowid = rowid
+
+    def discard(self, content_hashes):
+        """Forget images deleted from the library. Other workers keep them until they restart."""
+        with self._lock:
+            for content_hash in content_hashes:
+                entry = self._entries.pop(content_hash, None)
+                if entry is None:
+                    continue
+                for table, chunk in zip(self._tables, self._chunks(entry[0])):
+                    bucket = table.get(chunk, [])
+                    if content_hash in bucket:
+                        bucket.remove(content_hash)
+
+    def nearest(self, phash, limit=5):
+        """Return up to `limit` (distance, filename) pairs within the threshold, closest first."""
+        self.sync()
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(phash)):
+            for flip in self._probe_masks:
+                candidates.update(table.get(chunk ^ flip, ()))
+        matches = []
+        for content_hash in candidates:
+            other, filename = self._entries[content_hash]
+            distance = bin(phash ^ other).count('1')
+            if distance <= self.threshold:
+                matches.append((distance, filename))
+        matches.sort()
+        return matches[:limit]
+
+phash_index = PerceptualIndex()
+
+def record_library_phash(content_hash, filename, phash):
+    with db_pool.connection() as db:
+        db.execute('INSERT OR IGNORE INTO image_phashes (content_hash, phash, filename) VALUES (?, ?, ?)',
+                   (content_hash, _to_sqlite_int(phash), filename))
+
+def flag_near_duplicates(request_id, phash):
+    """Store the library images closest to a pending upload for the moderation dashboard."""
+    matches = phash_index.nearest(phash)
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('DELETE FROM photo_request_matches WHERE request_id = ?', (request_id,))
+        db.executemany('INSERT INTO photo_request_matches (request_id, filename, distance) VALUES (?, ?, ?)',
+                       [(request_id, filename, distance) for distance, filename in matches])
+        db.execute('COMMIT')
+    return matches
+
+def check_upload_for_near_duplicates(request_id, path):
+    """Hash a new upload and flag its near-duplicates; runs on the thread pool after submission."""
+    try:
+        phash = perceptual_hash(path)
+        if phash is None:
+            return
+        with db_pool.connection() as db:
+            db.execute('UPDATE photo_requests SET phash = ? WHERE id = ?', (_to_sqlite_int(phash), request_id))
+        flag_near_duplicates(request_id, phash)
+    except Exception as e:
+        logger.error('Error checking upload %s for near-duplicates: %s', request_id, e)
+
+def index_library_image(content_hash, filename, path, phash=None):
+    """Add a newly approved image to the perceptual hash table; runs on the thread pool."""
+    try:
+        if phash is None:
+            phash = perceptual_hash(path)
+        if phash is not None:
+            record_library_phash(content_hash, filename, phash)
+    except Exception as e:
+        logger.error('Error indexing perceptual hash for %s: %s', filename, e)
+
+def get_near_duplicate_matches(request_ids):
+    """Return {request id: [match rows]} for the given pending requests."""
+    matches = {}
+    if request_ids:
+        placeholders = ', '.join('?' * len(request_ids))
+        for row in query_db(f'SELECT request_id, filename, distance FROM photo_request_matches '
+                            f'WHERE request_id IN ({placeholders}) ORDER BY distance', request_ids):
+            matches.setdefault(row['request_id'], []).append(row)
+    return matches
+
+def _phash_library_file(path):
+    return path, file_content_hash(path), perceptual_hash(path)
+
+def backfill_phashes(workers=None):
+    """Hash every library image not yet in image_phashes on a process pool, then re-flag pending uploads."""
+    with db_pool.connection() as db:
+        known = {row[0] for row in db.execute('SELECT filename FROM image_phashes')}
+    names = {}
+    for filename in image_catalog.files():
+        path = resolve_image_path(filename) if filename not in known else None
+        if path:
+            names[path] = filename
+
+    added = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, content_hash, phash in pool.map(_phash_library_file, list(names), chunksize=32):
+            if phash is not None:
+                record_library_phash(content_hash, names[path], phash)
+                added += 1
+
+    with db_pool.connection() as db:
+        pending = db.execute("SELECT id, phash FROM photo_requests WHERE status = 'pending' AND phash IS NOT NULL").fetchall()
+    for request_id, phash in pending:
+        flag_near_duplicates(request_id, _from_sqlite_int(phash))
+    return added, len(pending)
+
+@app.cli.command('backfill-phashes')
+def backfill_phashes_command():
+    """Compute perceptual hashes for the existing library and flag pending near-duplicates."""
+    init_app()
+    added, flagged = backfill_phashes()
+    print(f"Hashed {added} library images and re-checked {flagged} pending requests.", flush=True)
+
+# --- Image Variants ---
+# (format, file extension, mimetype); WebP is sent to clients that accept it, JPEG to the rest
+IMAGE_VARIANT_FORMATS = (('WEBP', '.webp', 'image/webp'), ('JPEG', '.jpg', 'image/jpeg'))
+
+def render_image_variants(path, content_hash):
+    """Write the WebP and JPEG copies of an image for every configured width narrower than it.
+
+    Each file is written under a temporary name and renamed into place, so an
+    interrupted run never leaves a partial variant behind. Returns
+    (content hash, original width, original height, widths written).
+    """
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        width, height = img.size
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+
+    widths = [w for w in IMAGE_VARIANT_WIDTHS if w < width]
+    # Largest first, so each copy is scaled down from the previous one instead of the original
+    current = img
+    for target in reversed(widths):
+        current = current.resize((target, max(1, round(height * target / width))), Image.LANCZOS)
+        flat = current
+        if has_alpha:
+            flat = Image.new('RGB', current.size, (255, 255, 255))
+            flat.paste(current, mask=current.getchannel('A'))
+        for image_format, extension, _ in IMAGE_VARIANT_FORMATS:
+            variant_path = image_store.variant_path(content_hash, target, extension)
+            os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(variant_path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    if image_format == 'WEBP':
+                        current.save(f, 'WEBP', quality=80, method=4)
+                    else:
+                        flat.save(f, 'JPEG', quality=82, optimize=True, progressive=True)
+                os.replace(tmp_path, variant_path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+    return content_hash, width, height, widths
+
+def record_image_variants(content_hash, width, height, widths):
+    with db_pool.connection() as db:
+        db.execute('INSERT OR REPLACE INTO image_variants (content_hash, width, height, widths, created_at) VALUES (?, ?, ?, ?, ?)',
+                   (content_hash, width, height, ','.join(str(w) for w in widths), time.time()))
+
+_variants_in_flight = set()
+_variants_in_flight_lock = threading.Lock()
+
+def generate_image_variants(path, content_hash):
+    """Render and record the variants of one image; runs on the thread pool."""
+    try:
+        with db_pool.connection() as db:
+            if db.execute('SELECT 1 FROM image_variants WHERE content_hash = ?', (content_hash,)).fetchone():
+                return
+        record_image_variants(*render_image_variants(path, content_hash))
+    except Exception as e:
+        logger.error('Error generating variants for %s: %s', path, e)
+    finally:
+        with _variants_in_flight_lock:
+            _variants_in_flight.discard(content_hash)
+
+def schedule_image_variants(path, content_hash):
+    """Queue variant generation for a still image unless it is already queued."""
+    if Image is None or not path.lower().endswith(IMAGE_VARIANT_SOURCE_EXTENSIONS):
+        return
+    with _variants_in_flight_lock:
+        if content_hash in _variants_in_flight:
+            return
+        _variants_in_flight.add(content_hash)
+    thread_pool.submit(generate_image_variants, path, content_hash)
+
+def remove_image_variants(content_hash):
+    """Delete the variants of an image that is no longer stored, e.g. a rejected upload."""
+    with db_pool.connection() as db:
+        if db.execute('SELECT 1 FROM image_blobs WHERE content_hash = ?', (content_hash,)).fetchone():
+            return
+        db.execute('DELETE FROM image_variants WHERE content_hash = ?', (content_hash,))
+    for width in IMAGE_VARIANT_WIDTHS:
+        for _, extension, _ in IMAGE_VARIANT_FORMATS:
+            try:
+                os.remove(image_store.variant_path(content_hash, width, extension))
+            except FileNotFoundError:
+                pass
+
+def _variants_for_library_file(item):
+    path, content_hash = item
+    return render_image_variants(path, content_hash)
+
+def backfill_image_variants(workers=None):
+    """Generate variants for every library image that has none, on a process pool.
+
+    Each image is recorded as soon as its variants are written, so an
+    interrupted backfill picks up where it stopped when run again.
+    """
+    with db_pool.connection() as db:
+        done = {row[0] for row in db.execute('SELECT content_hash FROM image_variants')}
+    paths = [p for p in (resolve_image_path(f) for f in image_catalog.files())
+             if p and p.lower().endswith(IMAGE_VARIANT_SOURCE_EXTENSIONS)]
+
+    generated = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashed = pool.map(_hash_library_file, [p for p in paths if not p.startswith(IMAGE_STORE_FOLDER)], chunksize=64)
+        items = {}
+        for path, content_hash in hashed:
+            items.setdefault(content_hash, path)
+        for path in paths:
+            if path.startswith(IMAGE_STORE_FOLDER):
+                items.setdefault(image_store.content_hash_for(path), path)
+        todo = [(path, content_hash) for content_hash, path in items.items() if content_hash not in done]
+
+        futures = [pool.submit(_variants_for_library_file, item) for item in todo]
+        for future, (path, _) in zip(futures, todo):
+            try:
+                record_image_variants(*future.result())
+                generated += 1
+            except Exception as e:
+                logger.error('Error generating variants for %s: %s', path, e)
+                failed += 1
+    return generated, failed, len(items) - len(todo)
+
+@app.cli.command('backfill-variants')
+def backfill_variants_command():
+    """Generate thumbnails and downscaled variants for the existing library."""
+    init_app()
+    if Image is None:
+        print("Pillow is not installed; no variants generated.", flush=True)
+        return
+    generated, failed, skipped = backfill_image_variants()
+    print(f"Generated variants for {generated} images ({failed} failed, {skipped} already done).", flush=True)
+
+# --- Media Serving ---
+mimetypes.add_type('video/webm', '.webm')
+mimetypes.add_type('video/mp4', '.mp4')
+mimetypes.add_type('image/webp', '.webp')
+
+class MappedFileCache:
+    """Read-only memory maps of large media files, shared by the requests that read them.
+
+    A player seeking through a video sends many Range requests for the same
+    file; with the map kept open each one is just a slice of the page cache,
+    with no open, seek or read calls. A map is replaced when the file's inode,
+    size or mtime changes. Evicted maps close once the last response using
+    them is done with them.
+    """
+
+    def __init__(self, size=MEDIA_MMAP_CACHE_SIZE):
+        self.size = size
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, st):
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._maps.get(path)
+            if entry and entry[0] == key:
+                self._maps.move_to_end(path)
+                return entry[1]
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self._lock:
+            self._maps[path] = (key, mapped)
+            self._maps.move_to_end(path)
+            while len(self._maps) > self.size:
+                self._maps.popitem(last=False)
+        return mapped
+
+mapped_files = MappedFileCache()
+
+def _byte_spans(ranges, length):
+    """Turn parsed Range header ranges into sorted, merged (start, stop) spans within the file."""
+    spans = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            spans.append((start, stop))
+    spans.sort()
+    merged = []
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def _if_range_matches(etag, st):
+    """False when an If-Range header names a different version of the file than this one."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == int(st.st_mtime)
+    return True
+
+def _read_spans(path, st, parts):
+    """Yield the bytes of each (prefix, start, stop) part, with memory maps for large files."""
+    if st.st_size >= MEDIA_MMAP_MIN_SIZE:
+        source = mapped_files.get(path, st)
+        for prefix, start, stop in parts:
+            if prefix:
+                yield prefix
+            for offset in range(start, stop, MEDIA_CHUNK_SIZE):
+                yield source[offset:min(offset + MEDIA_CHUNK_SIZE, stop)]
+        return
+    with open(path, 'rb') as f:
+        for prefix, start, stop in parts:
+            if prefix:
+                yield prefix
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(MEDIA_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+def media_version(path, st=None):
+    """Short token that changes whenever a media file's content does.
+
+    Stored blobs are named by their content hash, so their version is the start
+    of it; files still in the legacy folder use their mtime and size.
+    """
+    if image_store.is_blob(path):
+        return image_store.content_hash_for(path)[:16]
+    st = st or os.stat(path)
+    return f"{st.st_mtime_ns:x}{st.st_size:x}"
+
+def media_url(filename, path):
+    """Immutable URL for a media file: it changes whenever the file's content does."""
+    return f"/images/{filename}?v={media_version(path)}"
+
+def media_response(path, st, mimetype=None, etag=None, max_age=None):
+    """Build the response for a media file from a single stat of it.
+
+    Answers conditional requests with 304, byte ranges with 206 (several ranges
+    as multipart/byteranges) and anything else with the whole file. Unless
+    MEDIA_OFFLOAD hands the transfer to the front-end server, whole files go
+    through the server's file wrapper, so gunicorn can use sendfile().
+    """
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    etag = etag or f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    response = app.response_class(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = int(st.st_mtime)
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    response.make_conditional(request.environ)
+    if response.status_code == 304:
+        return response
+
+    if MEDIA_OFFLOAD in ('x-accel', 'x-sendfile'):
+        # The front-end server sends the bytes, including any Range request, and sets the length
+        if MEDIA_OFFLOAD == 'x-accel':
+            relative_path = os.path.relpath(path, DATA_DIR).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = MEDIA_ACCEL_PREFIX + quote(relative_path)
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        response.content_length = 0
+        return response
+
+    response.accept_ranges = 'bytes'
+    length = st.st_size
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' or not _if_range_matches(etag, st):
+        response.response = wrap_file(request.environ, open(path, 'rb'), MEDIA_CHUNK_SIZE)
+        response.content_length = length
+        return response
+
+    spans = _byte_spans(byte_range.ranges, length)
+    if not spans:
+        response = app.response_class(status=416)
+        response.headers['Content-Range'] = f"bytes */{length}"
+        return response
+    if len(spans) > MEDIA_MAX_RANGES:
+        # Too many pieces to be worth it; RFC 7233 lets us send the whole file instead
+        response.response = wrap_file(request.environ, open(path, 'rb'), MEDIA_CHUNK_SIZE)
+        response.content_length = length
+        return response
+
+    response.status_code = 206
+    if len(spans) == 1:
+        start, stop = spans[0]
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{length}"
+        response.content_length = stop - start
+        response.response = _read_spans(path, st, [(b'', start, stop)])
+        return response
+
+    boundary = os.urandom(12).hex()
+    parts = [
+        (f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n".encode('ascii'), start, stop)
+        for start, stop in spans
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode('ascii')
+    response.mimetype = 'multipart/byteranges'
+    response.mimetype_params['boundary'] = boundary
+    response.content_length = sum(len(prefix) + stop - start for prefix, start, stop in parts) + len(closing)
+    response.response = itertools.chain(_read_spans(path, st, parts), (closing,))
+    return response
+
+def send_media(path):
+    """Send a media file, or for ?w=<pixels> the smallest variant at least that wide.
+
+    A URL whose ?v= matches the file's current version never changes content,
+    so it is sent as immutable for a year. Anything else is sent as no-cache and
+    revalidated against its ETag or Last-Modified, which costs a 304 and no body.
+    Stored blobs and variants get strong ETags derived from the content hash.
+    If the variants haven't been generated yet, the original is sent as no-cache
+    and generation is queued, so caches pick up the variant once it exists.
+    Raises FileNotFoundError if the file is gone.
+    """
+    st = os.stat(path)
+    if not stat.S_ISREG(st.st_mode):
+        raise FileNotFoundError(path)
+    version = request.args.get('v')
+    max_age = MEDIA_IMMUTABLE_MAX_AGE if version and version == media_version(path, st) else None
+    sent_path, sent_st, mimetype = path, st, None
+    etag = image_store.content_hash_for(path) if image_store.is_blob(path) else None
+
+    width = request.args.get('w', type=int)
+    negotiated = width and Image is not None and path.lower().endswith(IMAGE_VARIANT_SOURCE_EXTENSIONS)
+    if negotiated:
+        content_hash = image_store.content_hash_for(path)
+        with db_pool.connection() as db:
+            row = db.execute('SELECT widths FROM image_variants WHERE content_hash = ?', (content_hash,)).fetchone()
+        if row is None:
+            # A stand-in for the variant that will exist soon; it must not be cached under this URL
+            max_age = None
+            schedule_image_variants(path, content_hash)
+        else:
+            widths = [int(w) for w in row[0].split(',') if w]
+            # No target means the original is narrower than anything that would fit the request
+            target = next((w for w in widths if w >= width), None)
+            if target is not None:
+                _, extension, variant_mimetype = IMAGE_VARIANT_FORMATS[0 if request.accept_mimetypes['image/webp'] else 1]
+                variant_path = image_store.variant_path(content_hash, target, extension)
+                try:
+                    sent_st = os.stat(variant_path)
+                    sent_path, mimetype, etag = variant_path, variant_mimetype, f"{content_hash}-w{target}{extension}"
+                except FileNotFoundError:
+                    max_age = None
+
+    response = media_response(sent_path, sent_st, mimetype, etag, max_age)
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+# --- Bulk Moderation ---
+def _parallel_moves(moves):
+    """Move (source, destination) pairs on the moderation pool; returns {index: error} for the moves that failed."""
+    def move(pair):
+        source, destination = pair
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.move(source, destination)
+        content_hashes.discard(source)
+
+    futures = [moderation_pool.submit(move, pair) for pair in moves]
+    return {i: future.exception() for i, future in enumerate(futures) if future.exception() is not None}
+
+def _parallel_unlink(paths):
+    def unlink(path):
+        content_hashes.discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error('Error deleting %s: %s', path, e)
+
+    for future in [moderation_pool.submit(unlink, path) for path in paths]:
+        future.result()
+
+def _restore_moves(moves):
+    """Move files back after a failed batch, the compensation for _parallel_moves."""
+    errors = _parallel_moves([(destination, source) for source, destination in moves])
+    for i, error in errors.items():
+        logger.error('Could not move %s back to %s: %s', moves[i][1], moves[i][0], error)
+
+def _trash_path(path):
+    # Staged deletions keep their folder (so the rename is atomic) but lose their media extension
+    return f'{path}.trash-{os.getpid()}-{threading.get_ident()}'
+
+def _in_clause(values):
+    return ', '.join('?' * len(values))
+
+def get_photo_requests_by_ids(ids):
+    """Return {id: row} for the requests that exist, from a single query."""
+    if not ids:
+        return {}
+    rows = query_db(f'SELECT {PHOTO_REQUEST_COLUMNS} FROM photo_requests WHERE id IN ({_in_clause(ids)})', list(ids))
+    return {row['id']: row for row in rows}
+
+class BulkResult:
+    """Outcome of a bulk action: ids done, ids skipped (wrong status or missing) and {id: error} for failures."""
+
+    def __init__(self):
+        self.done = []
+        self.skipped = []
+        self.failed = {}
+
+    def summary(self, verb):
+        parts = [f'{len(self.done)} {verb}']
+        if self.skipped:
+            parts.append(f'{len(self.skipped)} skipped (already moderated or missing)')
+        if self.failed:
+            parts.append(f'{len(self.failed)} failed ({", ".join(f"{id}: {e}" for id, e in sorted(self.failed.items()))})')
+        return '; '.join(parts)
+
+def _check_updated(cursor, expected):
+    if cursor.rowcount != expected:
+        raise RuntimeError('some of the requests were moderated by someone else meanwhile; nothing was changed')
+
+def bulk_approve(ids):
+    """Approve pending requests in one transaction.
+
+    Uploads are hashed and moved into the image store in parallel. Requests whose
+    file can't be moved are reported as failed and left pending; if the
+    transaction fails, every moved file is put back. The catalog, weights and
+    store version are bumped once for the whole batch.
+    """
+    result = BulkResult()
+    rows = get_photo_requests_by_ids(ids)
+    candidates = []
+    for id in ids:
+        row = rows.get(id)
+        if row is None or row['status'] != 'pending' or not row['pending_path']:
+            result.skipped.append(id)
+        else:
+            candidates.append(row)
+    if not candidates:
+        return result
+
+    def prepare(row):
+        os.stat(row['pending_path'])
+        content_hash = row['content_hash'] or file_content_hash(row['pending_path'])
+        return content_hash, os.path.exists(os.path.join(IMAGES_FOLDER_INTERNAL, row['filename']))
+
+    items = []
+    futures = [moderation_pool.submit(prepare, row) for row in candidates]
+    for row, future in zip(candidates, futures):
+        try:
+            items.append((row,) + future.result())
+        except OSError as e:
+            result.failed[row['id']] = e.strerror or str(e)
+    if not items:
+        return result
+
+    hashes = list({content_hash for _, content_hash, _ in items})
+    names = list({row['filename'] for row, _, _ in items})
+    with db_pool.connection() as db:
+        stored = dict(db.execute(f'SELECT content_hash, extension FROM image_blobs WHERE content_hash IN ({_in_clause(hashes)})', hashes))
+        taken = {r[0] for r in db.execute(f'SELECT filename FROM image_files WHERE filename IN ({_in_clause(names)})', names)}
+
+    # Work out each request's public name and blob; only the first upload of a new hash is moved
+    plans, moves, claimed = [], [], {}
+    for row, content_hash, legacy_taken in items:
+        stem, extension = os.path.splitext(row['filename'])
+        extension = extension.lower()
+        filename = row['filename']
+        if legacy_taken or filename in taken:
+            filename = f"{stem}_{content_hash[:8]}{extension}"
+        if filename in taken:
+            result.failed[row['id']] = f'{filename} is already used by another image in this batch'
+            continue
+        taken.add(filename)
+        if content_hash in stored:
+            blob_path, new_blob = image_store.blob_path(content_hash, stored[content_hash]), False
+        elif content_hash in claimed:
+            blob_path, new_blob = claimed[content_hash], False
+        else:
+            blob_path, new_blob = image_store.blob_path(content_hash, extension), True
+            claimed[content_hash] = blob_path
+            moves.append((row['pending_path'], blob_path))
+        plans.append({'row': row, 'hash': content_hash, 'filename': filename, 'blob_path': blob_path, 'new': new_blob})
+
+    move_errors = _parallel_moves(moves)
+    failed_blobs = {moves[i][1]: error for i, error in move_errors.items()}
+    moves = [move for i, move in enumerate(moves) if i not in move_errors]
+    for plan in plans:
+        error = failed_blobs.get(plan['blob_path'])
+        if error is not None:
+            result.failed[plan['row']['id']] = error.strerror or str(error)
+    plans = [plan for plan in plans if plan['blob_path'] not in failed_blobs]
+    if not plans:
+        return result
+
+    new_plans = [plan for plan in plans if plan['new']]
+    now = time.time()
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # OR IGNORE: another worker may have stored the same content since it was looked up
+            db.executemany('INSERT OR IGNORE INTO image_blobs (content_hash, extension, size, ref_count, created_at) VALUES (?, ?, ?, 0, ?)',
+                           [(p['hash'], os.path.splitext(p['blob_path'])[1], os.path.getsize(p['blob_path']), now) for p in new_plans])
+            db.executemany('INSERT INTO image_files (filename, content_hash, created_at) VALUES (?, ?, ?)',
+                           [(p['filename'], p['hash'], now) for p in plans])
+            db.executemany('UPDATE image_blobs SET ref_count = ref_count + 1 WHERE content_hash = ?', [(p['hash'],) for p in plans])
+            _check_updated(db.executemany(
+                "UPDATE photo_requests SET status = 'approved', approved_path = ?, filename = ?, approval_date = CURRENT_TIMESTAMP "
+                "WHERE id = ? AND status = 'pending'",
+                [(p['blob_path'], p['filename'], p['row']['id']) for p in plans]
+            ), len(plans))
+            db.executemany(IMAGE_BOOST_SQL, [image_boost_args(p['filename'], now) for p in new_plans])
+            if SOURCE_PREFETCH_ENABLED:
+                db.executemany(SOURCE_LOOKUP_ENQUEUE_SQL, [(p['filename'], 1) for p in new_plans])
+            db.execute(APP_STATE_BUMP_SQL, ('image_store_version',))
+            if new_plans:
+                db.execute(APP_STATE_BUMP_SQL, ('image_weights_version',))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            _restore_moves(moves)
+            raise
+
+    # Uploads whose content was already stored are dropped, as in ImageStore.add
+    _parallel_unlink([p['row']['pending_path'] for p in plans if not p['new']])
+    image_catalog.invalidate()
+    for plan in new_plans:
+        phash = _from_sqlite_int(plan['row']['phash']) if plan['row']['phash'] is not None else None
+        thread_pool.submit(index_library_image, plan['hash'], plan['filename'], plan['blob_path'], phash)
+        schedule_image_variants(plan['blob_path'], plan['hash'])
+    if SOURCE_PREFETCH_ENABLED and new_plans:
+        _prefetch_wakeup.set()
+    result.done = [plan['row']['id'] for plan in plans]
+    return result
+
+def bulk_reject(ids):
+    """Reject pending requests in one transaction.
+
+    Pending files are renamed aside in parallel first and only deleted once the
+    transaction commits; if it fails they are renamed back.
+    """
+    result = BulkResult()
+    rows = get_photo_requests_by_ids(ids)
+    candidates = []
+    for id in ids:
+        row = rows.get(id)
+        if row is None or row['status'] != 'pending':
+            result.skipped.append(id)
+        else:
+            candidates.append(row)
+
+    staged, rejected = _stage_request_files(candidates, lambda row: row['pending_path'], result)
+    if not rejected:
+        return result
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            _check_updated(db.executemany(
+                "UPDATE photo_requests SET status = 'rejected', pending_path = NULL, approval_date = CURRENT_TIMESTAMP "
+                "WHERE id = ? AND status = 'pending'",
+                [(row['id'],) for row in rejected]
+            ), len(rejected))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            _restore_moves(staged)
+            raise
+
+    _parallel_unlink([trash for _, trash in staged])
+    for row in rejected:
+        if row['content_hash']:
+            thread_pool.submit(remove_image_variants, row['content_hash'])
+    result.done = [row['id'] for row in rejected]
+    return result
+
+def _stage_request_files(rows, path_for, result):
+    """Rename each row's file aside in parallel. Returns (staged moves, rows that can go ahead).
+
+    Rows without a file on disk go ahead; rows whose file couldn't be moved are failed.
+    """
+    moves, owners = [], []
+    for row in rows:
+        path = path_for(row)
+        if path and os.path.lexists(path):
+            moves.append((path, _trash_path(path)))
+            owners.append(row['id'])
+    errors = _parallel_moves(moves)
+    for i, error in errors.items():
+        result.failed[owners[i]] = error.strerror or str(error)
+    failed_ids = {owners[i] for i in errors}
+    return [move for i, move in enumerate(moves) if i not in errors], [row for row in rows if row['id'] not in failed_ids]
+
+def bulk_delete(ids):
+    """Delete requests of any status, and the library images of approved ones, in one transaction.
+
+    An approved image's public name is removed and its blob's ref_count lowered;
+    blobs no longer referenced are deleted with their variants. Files are renamed
+    aside in parallel before the transaction and deleted after it commits, or
+    renamed back if it fails.
+    """
+    result = BulkResult()
+    rows = get_photo_requests_by_ids(ids)
+    result.skipped = [id for id in ids if id not in rows]
+    rows = [rows[id] for id in ids if id in rows]
+    if not rows:
+        return result
+
+    approved_names = [row['filename'] for row in rows if row['status'] == 'approved' and row['filename']]
+    with db_pool.connection() as db:
+        name_hashes = dict(db.execute(f'SELECT filename, content_hash FROM image_files WHERE filename IN ({_in_clause(approved_names)})',
+                                      approved_names)) if approved_names else {}
+        released = {}
+        for row in rows:
+            if row['status'] == 'approved' and row['filename'] in name_hashes:
+                content_hash = name_hashes[row['filename']]
+                released[content_hash] = released.get(content_hash, 0) + 1
+        hashes = list(released)
+        blobs = db.execute(f'SELECT content_hash, extension, ref_count FROM image_blobs WHERE content_hash IN ({_in_clause(hashes)})',
+                           hashes).fetchall() if hashes else []
+    orphaned = {content_hash: image_store.blob_path(content_hash, extension)
+                for content_hash, extension, ref_count in blobs if ref_count <= released[content_hash]}
+
+    def file_for(row):
+        # Pending uploads, approved images outside the store, and blobs losing their last name
+        if row['status'] == 'pending':
+            return row['pending_path']
+        if row['status'] == 'approved':
+            if row['filename'] in name_hashes:
+                return orphaned.get(name_hashes[row['filename']])
+            # Never a blob here: those are only deleted through their ref_count
+            if row['approved_path'] and not image_store.is_blob(row['approved_path']):
+                return row['approved_path']
+        return None
+
+    # Several requests can share an orphaned blob; stage it once and fail them together
+    by_path = {}
+    for row in rows:
+        path = file_for(row)
+        if path:
+            by_path.setdefault(path, []).append(row)
+    leaders = [group[0] for group in by_path.values()]
+    staged, staged_rows = _stage_request_files(leaders, file_for, result)
+    for path, group in by_path.items():
+        if group[0]['id'] in result.failed:
+            for row in group[1:]:
+                result.failed[row['id']] = result.failed[group[0]['id']]
+    deleted = [row for row in rows if row['id'] not in result.failed]
+    if not deleted:
+        return result
+
+    store_names = [row['filename'] for row in deleted if row['status'] == 'approved' and row['filename'] in name_hashes]
+    library_names = [row['filename'] for row in deleted if row['status'] == 'approved' and row['filename']]
+    removed_hashes = [content_hash for content_hash in {name_hashes[name] for name in store_names} if content_hash in orphaned]
+    with db_pool.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('DELETE FROM image_files WHERE filename = ?', [(name,) for name in store_names])
+            db.executemany('UPDATE image_blobs SET ref_count = ref_count - 1 WHERE content_hash = ?',
+                           [(name_hashes[name],) for name in store_names])
+            if removed_hashes:
+                # A blob staged for deletion must really have lost its last name, or another approval raced us
+                unreferenced = {r[0] for r in db.execute(
+                    f'SELECT content_hash FROM image_blobs WHERE content_hash IN ({_in_clause(removed_hashes)}) AND ref_count <= 0',
+                    removed_hashes)}
+                if unreferenced != set(removed_hashes):
+                    raise RuntimeError('an image being deleted was approved again meanwhile; nothing was changed')
+                db.executemany('DELETE FROM image_blobs WHERE content_hash = ?', [(h,) for h in removed_hashes])
+                db.executemany('DELETE FROM image_phashes WHERE content_hash = ?', [(h,) for h in removed_hashes])
+            db.executemany('DELETE FROM image_weights WHERE filename = ?', [(name,) for name in library_names])
+            db.executemany('DELETE FROM image_reports WHERE filename = ?', [(name,) for name in library_names])
+            db.executemany('DELETE FROM source_lookup_jobs WHERE filename = ?', [(name,) for name in library_names])
+            db.executemany('DELETE FROM photo_request_matches WHERE filename = ?', [(name,) for name in library_names])
+            db.executemany('DELETE FROM photo_request_matches WHERE request_id = ?', [(row['id'],) for row in deleted])
+            db.executemany('DELETE FROM photo_requests WHERE id = ?', [(row['id'],) for row in deleted])
+            if store_names:
+                db.execute(APP_STATE_BUMP_SQL, ('image_store_version',))
+            if library_names:
+                db.execute(APP_STATE_BUMP_SQL, ('image_weights_version',))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            _restore_moves(staged)
+            raise
+
+    _parallel_unlink([trash for _, trash in staged])
+    phash_index.discard(removed_hashes)
+    for content_hash in set(removed_hashes) | {row['content_hash'] for row in deleted if row['status'] == 'pending' and row['content_hash']}:
+        thread_pool.submit(remove_image_variants, content_hash)
+    if library_names:
+        image_catalog.invalidate()
+    result.done = [row['id'] for row in deleted]
+    return result
+
+BULK_ACTIONS = {
+    'approve': (bulk_approve, 'approved'),
+    'reject': (bulk_reject, 'rejected'),
+    'delete': (bulk_delete, 'deleted'),
+}
+
+# --- Database Helper Functions ---
+class ConnectionPool:
+    """Per-process pool of tuned SQLite connections.
+
+    Connections are opened in autocommit mode (isolation_level=None), so
+    multi-statement work needs an explicit BEGIN. Reusing connections also
+    reuses each connection's prepared statement cache for the hot queries.
+    """
+
+    def __init__(self, database_path, size=DB_POOL_SIZE):
+        self.database_path = database_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def _open(self):
+        db = sqlite3.connect(self.database_path, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                             check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+        db.row_factory = sqlite3.Row
+        # WAL is stored in the database file; switching needs an exclusive lock, so only do it once
+        if db.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+            db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+        db.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        db.execute('PRAGMA temp_store = MEMORY')
+        db.execute(f'PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}')
+        db.set_trace_callback(_count_sql_statement)
+        return db
+
+    def acquire(self):
+        if os.getpid() != self._pid:
+            # Connections opened before a fork belong to the parent; start over in the child
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
 
-# Data directory paths
-DATA_DIR = 'data'
-IMAGES_FOLDER_INTERNAL = os.path.join(DATA_DIR, 'images')
-PENDING_UPLOADS_FOLDER = os.path.join(DATA_DIR, 'pending_images')
-DATABASE_PATH = os.path.join(DATA_DIR, 'sqlite', 'site.db')
-MOTD_PATH = os.path.join(DATA_DIR, 'motd.txt')
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(db)
+        else:
+            db.close()
 
-# File upload configuration
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 Megabytes limit for file uploads
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
 
-# Ensure data directories exist
-os.makedirs(IMAGES_FOLDER_INTERNAL, exist_ok=True)
-os.makedirs(PENDING_UPLOADS_FOLDER, exist_ok=True)
-os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+db_pool = ConnectionPool(DATABASE_PATH)
 
-# --- Database Helper Functions ---
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE_PATH)
-        db.row_factory = sqlite3.Row
+        db = g._database = db_pool.acquire()
     return db
 
+def _count_sql_statement(statement):
+    metrics.inc('sqlite_statements_total', (('statement', statement.split(None, 1)[0].upper()),))
+    if SQL_STATEMENT_COUNTER and has_request_context():
+        g.sql_statement_count = g.get('sql_statement_count', 0) + 1
+
 def query_db(query, args=(), one=False):
     cur = get_db().execute(query, args)
     rv = cur.fetchall()
@@ -63,86 +2939,350 @@ def query_db(query, args=(), one=False):
 def insert_db(query, args=()):
     db = get_db()
     cur = db.execute(query, args)
-    db.commit()
     last_id = cur.lastrowid
     cur.close()
     return last_id
 
 def update_db(query, args=()):
-    db = get_db()
-    db.execute(query, args)
-    db.commit()
+    get_db().execute(query, args)
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        db_pool.release(db)
 
 # --- Database Schema ---
-def create_tables():
-    db = get_db()
-    
-    # Create users table
-    db.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL
-    )
-    ''')
-    
-    # Create announcements table
-    db.execute('''
-    CREATE TABLE IF NOT EXISTS announcements (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        text TEXT NOT NULL,
-        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create photo_requests table
-    db.execute('''
-    CREATE TABLE IF NOT EXISTS photo_requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_name TEXT NOT NULL,
-        description TEXT,
-        filename TEXT NOT NULL,
-        pending_path TEXT,
-        approved_path TEXT,
-        status TEXT DEFAULT 'pending' NOT NULL,
-        submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        approval_date TIMESTAMP
-    )
-    ''')
-    
-    db.commit()
+# Forward-only migrations as (version, statements). Each version runs once, in
+# order, and is recorded in schema_version. Add new versions at the end.
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # Create users table
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL
+        )
+        ''',
+        # Create announcements table
+        '''
+        CREATE TABLE IF NOT EXISTS announcements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Create photo_requests table
+        '''
+        CREATE TABLE IF NOT EXISTS photo_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_name TEXT NOT NULL,
+            description TEXT,
+            filename TEXT NOT NULL,
+            pending_path TEXT,
+            approved_path TEXT,
+            status TEXT DEFAULT 'pending' NOT NULL,
+            submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            approval_date TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, [
+        # Create source_cache table for SauceNao results
+        '''
+        CREATE TABLE IF NOT EXISTS source_cache (
+            content_hash TEXT PRIMARY KEY,
+            results TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_source_cache_created_at ON source_cache (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_source_cache_expires_at ON source_cache (expires_at)',
+    ]),
+    (3, [
+        # Create source_lookup_jobs table for the background SauceNao queue
+        '''
+        CREATE TABLE IF NOT EXISTS source_lookup_jobs (
+            filename TEXT PRIMARY KEY,
+            status TEXT DEFAULT 'queued' NOT NULL,
+            priority INTEGER DEFAULT 0 NOT NULL,
+            attempts INTEGER DEFAULT 0 NOT NULL,
+            next_attempt_at REAL DEFAULT 0 NOT NULL,
+            claimed_at REAL,
+            last_error TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_source_lookup_jobs_ready ON source_lookup_jobs (status, priority, next_attempt_at)',
+        # Create rate_limits table for token buckets shared between workers
+        '''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+    ]),
+    (4, [
+        # Indexes for the moderation dashboard's per-status, newest-first pages
+        'CREATE INDEX IF NOT EXISTS idx_photo_requests_status_submission ON photo_requests (status, submission_date)',
+        'CREATE INDEX IF NOT EXISTS idx_photo_requests_status_approval ON photo_requests (status, approval_date)',
+    ]),
+    (5, [
+        # Create app_state table for counters shared between workers (e.g. the MOTD version)
+        '''
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        ''',
+    ]),
+    (6, [
+        # Content hash of each upload, unique among requests that are still pending or approved
+        'ALTER TABLE photo_requests ADD COLUMN content_hash TEXT',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_photo_requests_live_hash ON photo_requests (content_hash) WHERE status IN ('pending', 'approved')",
+    ]),
+    (7, [
+        # Content-addressed image store: one row per stored blob and one per public filename
+        '''
+        CREATE TABLE IF NOT EXISTS image_blobs (
+            content_hash TEXT PRIMARY KEY,
+            extension TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            ref_count INTEGER DEFAULT 0 NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS image_files (
+            filename TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL REFERENCES image_blobs (content_hash),
+            created_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_image_files_content_hash ON image_files (content_hash)',
+    ]),
+    (8, [
+        # Perceptual hashes of library images, keyed by content hash
+        '''
+        CREATE TABLE IF NOT EXISTS image_phashes (
+            content_hash TEXT PRIMARY KEY,
+            phash INTEGER NOT NULL,
+            filename TEXT NOT NULL
+        )
+        ''',
+        'ALTER TABLE photo_requests ADD COLUMN phash INTEGER',
+        # Library images that look like a pending upload
+        '''
+        CREATE TABLE IF NOT EXISTS photo_request_matches (
+            request_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            distance INTEGER NOT NULL,
+            PRIMARY KEY (request_id, filename)
+        )
+        ''',
+    ]),
+    (9, [
+        # Dimensions of still images and the variant widths generated for them
+        '''
+        CREATE TABLE IF NOT EXISTS image_variants (
+            content_hash TEXT PRIMARY KEY,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            widths TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''',
+    ]),
+    (10, [
+        # Selection weights; images without a row weigh 1
+        '''
+        CREATE TABLE IF NOT EXISTS image_weights (
+            filename TEXT PRIMARY KEY,
+            weight REAL NOT NULL DEFAULT 1,
+            reports INTEGER NOT NULL DEFAULT 0,
+            boost_until REAL,
+            boosted_at REAL
+        )
+        ''',
+    ]),
+    (11, [
+        # One row per SauceNao lookup in progress, held by the worker making it
+        '''
+        CREATE TABLE IF NOT EXISTS source_leases (
+            content_hash TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+    ]),
+    (12, [
+        # Visitor reports, one per image and client address
+        '''
+        CREATE TABLE IF NOT EXISTS image_reports (
+            filename TEXT NOT NULL,
+            client TEXT NOT NULL,
+            reported_at REAL NOT NULL,
+            PRIMARY KEY (filename, client)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_image_reports_client ON image_reports (client, reported_at)',
+    ]),
+]
+
+def migrate_db():
+    """Apply pending schema migrations. Safe to run from several processes at once."""
+    with db_pool.connection() as db:
+        db.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)')
+        # The write lock makes other processes wait here until the migrations are done
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            current = db.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+            for version, statements in SCHEMA_MIGRATIONS:
+                if version <= current:
+                    continue
+                for statement in statements:
+                    db.execute(statement)
+                db.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+                logger.info('Applied database migration %d.', version)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
 
 # --- Helper Functions ---
 def is_logged_in():
     return session.get('logged_in', False)
 
-def get_motd():
+def client_address():
+    """The visitor's address: the peer, or what the TRUSTED_PROXIES nearest proxies saw."""
+    if TRUSTED_PROXIES:
+        forwarded = [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',') if a.strip()]
+        if len(forwarded) >= TRUSTED_PROXIES:
+            return forwarded[-TRUSTED_PROXIES]
+    return request.remote_addr or ''
+
+def csrf_token():
+    """This session's token for visitor POST requests, created on first use."""
+    token = session.get('csrf_token')
+    if token is None:
+        token = session['csrf_token'] = secrets.token_urlsafe(32)
+    return token
+
+def csrf_token_valid():
+    """Whether the request's X-CSRF-Token header matches the session's token."""
+    token = session.get('csrf_token')
+    return token is not None and hmac.compare_digest(token, request.headers.get('X-CSRF-Token', ''))
+
+def get_app_state(key):
+    """Read a shared integer from the app_state table (0 if unset)."""
+    with db_pool.connection() as db:
+        row = db.execute('SELECT value FROM app_state WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else 0
+
+APP_STATE_BUMP_SQL = 'INSERT INTO app_state (key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1'
+
+def bump_app_state(key):
+    """Increment a shared integer so other workers notice a change."""
+    with db_pool.connection() as db:
+        db.execute(APP_STATE_BUMP_SQL, (key,))
+
+def read_motd_file():
     """Read the Message of the Day from the file if it exists."""
     if os.path.exists(MOTD_PATH):
         try:
             with open(MOTD_PATH, 'r') as f:
                 return f.read().strip()
         except Exception as e:
-            print(f"Error reading MOTD file: {e}", flush=True)
+            logger.error('Error reading MOTD file: %s', e)
     return None
 
+class MotdCache:
+    """The Message of the Day and the homepage rendered with it.
+
+    At most once every MOTD_REVALIDATE_MS the file is stat'ed and the shared
+    motd_version stamp is read; the file is only re-read, and the homepage only
+    re-rendered, when one of them changed. save_motd/delete_motd bump the stamp,
+    which reaches every worker by its next check. The text is kept in the cache
+    tier ('motd' namespace) under that token, so only one worker reads the file
+    after a change.
+    """
+
+    def __init__(self, revalidate_ms=MOTD_REVALIDATE_MS):
+        self.revalidate_interval = revalidate_ms / 1000.0
+        self._state = (None, None)  # (token, text); the token is (version, file mtime/inode/size)
+        self._rendered_index = (None, None)  # (token, html)
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _file_key(self):
+        try:
+            st = os.stat(MOTD_PATH)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def _revalidate(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._state
+        with self._lock:
+            if now >= self._next_check:
+                token = (get_app_state('motd_version'), self._file_key())
+                if token != self._state[0]:
+                    self._state = (token, self._load(token))
+                self._next_check = now + self.revalidate_interval
+            return self._state
+
+    def _load(self, token):
+        if token[1] is None:
+            return None
+        key = '{}:{}:{}:{}'.format(token[0], *token[1])
+        motd = cache_tier.get('motd', key)
+        if motd is None:
+            motd = read_motd_file()
+            if motd is not None:
+                cache_tier.set('motd', key, motd, MOTD_CACHE_TTL)
+        return motd
+
+    def invalidate(self):
+        self._next_check = 0.0
+
+    def get(self):
+        return self._revalidate()[1]
+
+    def render_index(self):
+        """Return the rendered homepage, running Jinja only when the MOTD changed."""
+        token, motd = self._revalidate()
+        rendered_token, html = self._rendered_index
+        if rendered_token != token:
+            html = render_template('index.html', motd=motd)
+            self._rendered_index = (token, html)
+        return html
+
+motd_cache = MotdCache()
+
+def get_motd():
+    """Return the Message of the Day, or None if there isn't one."""
+    return motd_cache.get()
+
 def save_motd(message):
     """Save the Message of the Day to a file."""
     try:
         # Create data directory if it doesn't exist
         os.makedirs(os.path.dirname(MOTD_PATH), exist_ok=True)
         
-        with open(MOTD_PATH, 'w') as f:
+        # Write a temporary file and rename it so readers never see a partial message
+        temp_path = f"{MOTD_PATH}.tmp{os.getpid()}"
+        with open(temp_path, 'w') as f:
             f.write(message)
+        os.replace(temp_path, MOTD_PATH)
+        bump_app_state('motd_version')
+        motd_cache.invalidate()
         return True
     except Exception as e:
-        print(f"Error saving MOTD file: {e}", flush=True)
+        logger.error('Error saving MOTD file: %s', e)
         return False
 
 def delete_motd():
@@ -150,9 +3290,11 @@ def delete_motd():
     if os.path.exists(MOTD_PATH):
         try:
             os.remove(MOTD_PATH)
+            bump_app_state('motd_version')
+            motd_cache.invalidate()
             return True
         except Exception as e:
-            print(f"Error deleting MOTD file: {e}", flush=True)
+            logger.error('Error deleting MOTD file: %s', e)
     return False
 
 def login_required(f):
@@ -164,6 +3306,8 @@ def login_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+# get_user_by_username and get_photo_request run on every login and moderation
+# action; keeping their SQL constant lets pooled connections reuse the prepared statements.
 def get_user_by_username(username):
     return query_db('SELECT * FROM users WHERE username = ?', [username], one=True)
 
@@ -174,22 +3318,86 @@ def create_user(username, password):
     password_hash = generate_password_hash(password)
     insert_db('INSERT INTO users (username, password_hash) VALUES (?, ?)', [username, password_hash])
 
-def get_pending_requests():
-    return query_db('SELECT * FROM photo_requests WHERE status = "pending" ORDER BY submission_date DESC')
+PHOTO_REQUEST_COLUMNS = 'id, user_name, description, filename, pending_path, approved_path, status, submission_date, approval_date, content_hash, phash'
+
+# Pending requests are listed by submission date, approved and rejected ones by the date they were handled
+PHOTO_REQUEST_SORT_COLUMNS = {
+    'pending': 'submission_date',
+    'approved': 'approval_date',
+    'rejected': 'approval_date',
+}
+
+def parse_page_cursor(cursor):
+    """Return (date, id) from a page cursor, or None for a missing or malformed one (the first page)."""
+    cursor_date, separator, cursor_id = (cursor or '').rpartition('|')
+    if not separator:
+        return None
+    try:
+        return cursor_date, int(cursor_id)
+    except ValueError:
+        return None
+
+def photo_requests_page_query(status, cursor=None, page_size=DASHBOARD_PAGE_SIZE):
+    """Return (query, args) for one newest-first page of requests with a status.
+
+    Pages are keyset-paginated on (date, id). The row-value comparison lets
+    SQLite seek the (status, date) index, whose entries end in the rowid, to
+    the cursor, so each page is an index range scan no matter how deep it is.
+    """
+    date_column = PHOTO_REQUEST_SORT_COLUMNS[status]
+    query = f'SELECT {PHOTO_REQUEST_COLUMNS} FROM photo_requests WHERE status = ?'
+    args = [status]
+    position = parse_page_cursor(cursor)
+    if position is not None:
+        query += f' AND ({date_column}, id) < (?, ?)'
+        args += list(position)
+    query += f' ORDER BY {date_column} DESC, id DESC LIMIT ?'
+    args.append(page_size + 1)
+    return query, args
+
+def get_photo_requests_page(status, cursor=None, page_size=DASHBOARD_PAGE_SIZE):
+    """Return (rows, next_cursor) for one newest-first page of requests with a status.
 
-def get_approved_requests():
-    return query_db('SELECT * FROM photo_requests WHERE status = "approved" ORDER BY approval_date DESC')
+    `cursor` is the next_cursor of the previous page.
+    """
+    date_column = PHOTO_REQUEST_SORT_COLUMNS[status]
+    rows = query_db(*photo_requests_page_query(status, cursor, page_size))
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = f"{rows[-1][date_column]}|{rows[-1]['id']}"
+    return rows, next_cursor
 
-def get_rejected_requests():
-    return query_db('SELECT * FROM photo_requests WHERE status = "rejected" ORDER BY approval_date DESC')
+def get_photo_request_counts():
+    """Return the number of requests per status from a single aggregate query."""
+    counts = dict.fromkeys(PHOTO_REQUEST_SORT_COLUMNS, 0)
+    for row in query_db('SELECT status, COUNT(*) AS count FROM photo_requests GROUP BY status'):
+        counts[row['status']] = row['count']
+    return counts
 
 def get_photo_request(id):
-    return query_db('SELECT * FROM photo_requests WHERE id = ?', [id], one=True)
+    return query_db(f'SELECT {PHOTO_REQUEST_COLUMNS} FROM photo_requests WHERE id = ?', [id], one=True)
 
-def create_photo_request(user_name, description, filename, pending_path):
+def remove_unrecorded_upload(pending_path):
+    """Delete an upload in the pending folder unless a photo request points at it."""
+    try:
+        if query_db('SELECT 1 FROM photo_requests WHERE pending_path = ?', [pending_path], one=True) is None:
+            os.remove(pending_path)
+            content_hashes.discard(pending_path)
+    except (OSError, sqlite3.Error) as e:
+        logger.error('Could not remove unrecorded upload %s: %s', pending_path, e)
+
+def create_photo_request(user_name, description, filename, pending_path, content_hash=None):
     return insert_db(
-        'INSERT INTO photo_requests (user_name, description, filename, pending_path, status) VALUES (?, ?, ?, ?, ?)',
-        [user_name, description, filename, pending_path, 'pending']
+        'INSERT INTO photo_requests (user_name, description, filename, pending_path, status, content_hash) VALUES (?, ?, ?, ?, ?, ?)',
+        [user_name, description, filename, pending_path, 'pending', content_hash]
+    )
+
+def find_live_photo_request_by_hash(content_hash):
+    """Return the pending or approved request with this content, if any."""
+    return query_db(
+        "SELECT id, status FROM photo_requests WHERE content_hash = ? AND status IN ('pending', 'approved')",
+        [content_hash], one=True
     )
 
 def update_photo_request_approved(id, approved_path, filename):
@@ -204,35 +3412,66 @@ def update_photo_request_rejected(id):
         ['rejected', id]
     )
 
-# Initialize the database with app context
+# One-time startup initialization. Under gunicorn this runs in the master from
+# the on_starting hook in gunicorn.conf.py, before any worker is forked.
+_app_initialized = False
+_app_init_lock = threading.Lock()
+
 def init_app():
-    # Create tables if they don't exist
-    create_tables()
-    
-    # Get admin credentials from environment variables or use defaults
-    admin_username = os.environ.get('ADMIN_USERNAME', 'admin')
-    admin_password = os.environ.get('ADMIN_PASSWORD', 'adminpass')
-    
-    # Create a default admin user if none exists
-    if not get_user_by_username(admin_username):
-        create_user(admin_username, admin_password)
-        print(f"\nDefault admin user '{admin_username}' created with the provided password.\n!!! CHANGE THIS PASSWORD IMMEDIATELY IN PRODUCTION !!!\n", flush=True)
-    
-    # Add a default announcement if none exists
-    if not query_db('SELECT * FROM announcements LIMIT 1'):
-        insert_db(
-            'INSERT INTO announcements (text) VALUES (?)',
-            ["Welcome to the Admin Dashboard! Please update this announcement through the 'Announcements' section."]
-        )
-        print("Default announcement added.", flush=True)
+    """Migrate the schema and create the default admin user and announcement."""
+    global _app_initialized
+    with _app_init_lock:
+        if _app_initialized:
+            return
+        migrate_db()
+
+        with app.app_context():
+            # Get admin credentials from environment variables or use defaults
+            admin_username = os.environ.get('ADMIN_USERNAME', 'admin')
+            admin_password = os.environ.get('ADMIN_PASSWORD', 'adminpass')
+            
+            # Create a default admin user if none exists
+            if not get_user_by_username(admin_username):
+                create_user(admin_username, admin_password)
+                logger.warning("Default admin user '%s' created with the provided password. CHANGE THIS PASSWORD IMMEDIATELY IN PRODUCTION.", admin_username)
+            
+            # Add a default announcement if none exists
+            if not query_db('SELECT * FROM announcements LIMIT 1'):
+                insert_db(
+                    'INSERT INTO announcements (text) VALUES (?)',
+                    ["Welcome to the Admin Dashboard! Please update this announcement through the 'Announcements' section."]
+                )
+                logger.info('Default announcement added.')
+        _app_initialized = True
 
-# Call init_app with app context for each request
 @app.before_request
 def before_request():
-    if not hasattr(g, 'initialized'):
-        with app.app_context():
-            init_app()
-        g.initialized = True
+    # Only does work on the first request of a process that skipped the startup hook (dev server, test client)
+    if not _app_initialized:
+        init_app()
+    start_source_prefetcher()
+    metrics.ensure_worker()
+    g.request_started = time.perf_counter()
+    if SQL_STATEMENT_COUNTER:
+        g.sql_statement_count = 0
+
+@app.after_request
+def add_sql_statement_count(response):
+    if SQL_STATEMENT_COUNTER:
+        response.headers['X-SQL-Statement-Count'] = str(g.get('sql_statement_count', 0))
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        record_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method,
+                       response.status_code, time.perf_counter() - started)
+    return response
+
+def record_request(route, method, status, seconds):
+    metrics.inc('http_requests_total', (('route', route), ('method', method), ('status', str(status))))
+    metrics.observe('http_request_duration_seconds', (('route', route),), seconds, LatencyHistogram.REQUEST_BUCKETS)
 
 # --- Main App Routes ---
 
@@ -249,15 +3488,17 @@ def resource_verification():
 # Serve the main HTML page
 @app.route('/')
 def index():
-    # Get the Message of the Day if it exists
-    motd = get_motd()
-    return render_template('index.html', motd=motd)
+    # The page only changes with the Message of the Day, so it is rendered once per MOTD version
+    return motd_cache.render_index()
 
 # Serve images
 @app.route('/images/<filename>')
 def serve_image(filename):
     try:
-        return send_from_directory(IMAGES_FOLDER_INTERNAL, filename)
+        image_path = resolve_image_path(filename, must_exist=False)
+        if image_path is None:
+            return jsonify({"error": "Image not found."}), 404
+        return send_media(image_path)
     except FileNotFoundError:
         return jsonify({"error": "Image not found."}), 404
 
@@ -265,194 +3506,429 @@ def serve_image(filename):
 @app.route('/image-count')
 def get_image_count():
     try:
-        # Check if the directory exists
-        if not os.path.exists(IMAGES_FOLDER_INTERNAL):
-            return jsonify({"error": "Images folder not found on the server."}), 500
+        # Return the count of image files from the catalog
+        return jsonify({"count": image_catalog.count()})
+
+    except FileNotFoundError:
+        return jsonify({"error": "Images folder not found on the server."}), 500
+    except Exception as e:
+        logger.exception('An unexpected error occurred in get_image_count: %s', e)
+        return jsonify({"error": f"An internal server error occurred: {e}"}), 500
 
-        # Get a list of all files in the images folder
-        files = os.listdir(IMAGES_FOLDER_INTERNAL)
+def next_random_filename():
+    """Next pick from the session's shuffle bag, or an independent weighted draw; None if there is no media."""
+    if RANDOM_SELECTION_MODE == 'shuffle' and has_request_context():
+        filename, session['shuffle_bag'] = selection_engine.next_for_session(session.get('shuffle_bag'))
+        return filename
+    return selection_engine.choice()
 
-        # Filter to include only common image and video extensions and exclude directories
-        image_files = [f for f in files if os.path.isfile(os.path.join(IMAGES_FOLDER_INTERNAL, f)) and f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webm', '.mp4'))]
+def pick_random_image():
+    """Pick a random file from the catalog. Returns its URL and filename, or None if there are no images."""
+    random_image_file = next_random_filename()
+    if random_image_file is None:
+        return None
+    image_path = resolve_image_path(random_image_file)
+    if image_path is None:
+        return None
 
-        # Return the count of image files
-        return jsonify({"count": len(image_files)})
+    # The URL is versioned by content, so the browser may cache the media itself;
+    # a fresh pick comes from this JSON response, which is never cached.
+    return {
+        "imageUrl": media_url(random_image_file, image_path),
+        "filename": random_image_file
+    }
 
-    except Exception as e:
-        print(f"An unexpected error occurred in get_image_count: {e}", flush=True)
-        return jsonify({"error": f"An internal server error occurred: {e}"}), 500
+def no_store(response):
+    """Keep browsers and proxies from caching a response that must differ on every call."""
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 # Endpoint to get just a random image URL (fast response)
 @app.route('/random-image')
 def get_random_image():
     try:
-        # Check if the directory exists
-        if not os.path.exists(IMAGES_FOLDER_INTERNAL):
-            print(f"Images folder not found at expected path: {IMAGES_FOLDER_INTERNAL}", flush=True)
-            return jsonify({"error": f"Images folder not found on the server."}), 500
+        image_data = pick_random_image()
 
-        # Get a list of all files and directories in the images folder
-        files = os.listdir(IMAGES_FOLDER_INTERNAL)
-
-        # Filter to include only common image and video extensions and exclude directories
-        image_files = [f for f in files if os.path.isfile(os.path.join(IMAGES_FOLDER_INTERNAL, f)) and f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webm', '.mp4'))]
-
-        if not image_files:
-            print(f"No image files found in {IMAGES_FOLDER_INTERNAL}", flush=True)
+        if image_data is None:
+            logger.warning('No image files found in %s', IMAGES_FOLDER_INTERNAL)
             return jsonify({"error": "No images found in the folder."}), 404
-
-        # Select a random image file
-        random_image_file = random.choice(image_files)
-        
-        # Add a random cachebuster to the URL to prevent browser caching of the image itself.
-        cachebuster = random.randint(100000, 999999)
-        image_url = f'/images/{random_image_file}?cb={cachebuster}'
         
         # Return just the image URL and filename for quick response
-        return jsonify({
-            "imageUrl": image_url,
-            "filename": random_image_file
+        return no_store(jsonify(image_data))
+
+    except FileNotFoundError:
+        logger.error('Images folder not found at expected path: %s', IMAGES_FOLDER_INTERNAL)
+        return jsonify({"error": f"Images folder not found on the server."}), 500
+    except Exception as e:
+        logger.exception('An unexpected error occurred in get_random_image: %s', e)
+        return jsonify({"error": f"An internal server error occurred: {e}"}), 500
+
+def media_dimensions(path, content_hash, known):
+    """(width, height) of a still image: recorded with its variants, else read from the file header."""
+    if content_hash in known:
+        return known[content_hash]
+    if Image is None or path.lower().endswith(VIDEO_EXTENSIONS):
+        return None, None
+    try:
+        # Image.open only parses the header; the pixels are never decoded
+        with Image.open(path) as img:
+            return img.size
+    except Exception:
+        return None, None
+
+def pick_random_images(count):
+    """Pick up to `count` distinct images with everything a client needs to show them without another request.
+
+    That is the versioned URL, media type, dimensions when known, and the
+    SauceNao results if they are cached. A source that isn't cached yet is
+    queued for the background prefetcher and reported as pending.
+
+    Files are never hashed here. A legacy-folder file whose digest this
+    worker doesn't have yet is hashed on the thread pool, and until then its
+    entry has no source and isn't pending, so the client asks /image-source.
+    """
+    filenames = []
+    for _ in range(count * 3):
+        filename = next_random_filename()
+        if filename is None or len(filenames) == count or len(filenames) == image_catalog.count():
+            break
+        if filename not in filenames:
+            filenames.append(filename)
+
+    picks = []
+    for filename in filenames:
+        path = resolve_image_path(filename)
+        if path is None:
+            continue
+        if image_store.is_blob(path):
+            content_hash = image_store.content_hash_for(path)
+        else:
+            try:
+                content_hash = content_hashes.peek(path)
+            except OSError:
+                continue
+            if content_hash is None:
+                content_hashes.warm(path, thread_pool)
+        picks.append((filename, path, content_hash))
+
+    hashes = [content_hash for _, _, content_hash in picks if content_hash is not None]
+    known = {}
+    if hashes:
+        with db_pool.connection() as db:
+            for content_hash, width, height in db.execute(
+                    f'SELECT content_hash, width, height FROM image_variants WHERE content_hash IN ({_in_clause(hashes)})',
+                    hashes):
+                known[content_hash] = (width, height)
+
+    images = []
+    for filename, path, content_hash in picks:
+        width, height = media_dimensions(path, content_hash, known)
+        source_results = source_cache.get(content_hash) if content_hash is not None else None
+        pending = source_results is None and content_hash is not None and SOURCE_PREFETCH_ENABLED
+        if pending:
+            enqueue_source_lookup(filename, priority=1)
+        images.append({
+            "filename": filename,
+            "imageUrl": media_url(filename, path),
+            "mediaType": 'video' if filename.lower().endswith(VIDEO_EXTENSIONS) else 'image',
+            "mimetype": mimetypes.guess_type(filename)[0],
+            "width": width,
+            "height": height,
+            "source_results": source_results,
+            "pending": pending,
         })
+    return images
+
+# Endpoint to get several random images at once, for clients that keep a prefetch queue
+@app.route('/random-images')
+def get_random_images():
+    try:
+        count = min(max(request.args.get('n', 5, type=int), 1), RANDOM_BATCH_MAX)
+        images = pick_random_images(count)
+        if not images:
+            return jsonify({"error": "No images found in the folder."}), 404
+        # The page sends the token back with reports; other sites can't read this response
+        return no_store(jsonify({"images": images, "csrfToken": csrf_token()}))
 
     except Exception as e:
-        print(f"An unexpected error occurred in get_random_image: {e}", flush=True)
+        logger.exception('An unexpected error occurred in get_random_images: %s', e)
         return jsonify({"error": f"An internal server error occurred: {e}"}), 500
 
+def fetch_saucenao_results(image_full_path, filename):
+    """Look an image up on SauceNao. Returns the filtered results, or None if the lookup failed."""
+    # Initialize response outside the try block so it's accessible in except blocks
+    response = None
+    saucenao_results = []
+    try:
+        with open(image_full_path, 'rb') as img_file:
+            # Prepare data for the SauceNao API request; read once so retries can resend it
+            files_payload = {'file': (filename, img_file.read())}
+            data_payload = {
+                'api_key': SAUCENAO_API_KEY,
+                'output_type': 2, # 2 for JSON output
+                'db': [5, 34] # Add this to search all databases
+            }
+
+            # Make the POST request to the SauceNao API
+            response = saucenao_client.post(data=data_payload, files=files_payload)
+            logger.debug('SauceNao API request for %s returned HTTP %d', filename, response.status_code)
+
+            # Attempt to decode JSON
+            saucenao_response_data = response.json()
+            # The full response is large; it is only formatted for the sampled share of DEBUG records
+            logger.debug('SauceNao API response for %s: %s', filename, saucenao_response_data, extra=SAMPLED)
+
+            # Process the results
+            if saucenao_response_data and 'results' in saucenao_response_data:
+                # Filter for results with a reasonable similarity score
+                min_similarity = 70 # You can adjust this threshold (0 to 100)
+                filtered_results = [
+                    r for r in saucenao_response_data['results']
+                    if r.get('header', {}).get('similarity') is not None and float(r['header']['similarity']) >= min_similarity
+                ]
+
+                # Sort results by similarity descending
+                sorted_results = sorted(filtered_results, key=lambda x: float(x.get('header', {}).get('similarity', 0)), reverse=True)
+
+                for result in sorted_results:
+                    header = result.get('header', {})
+                    data = result.get('data', {})
+
+                    similarity = header.get('similarity')
+                    # Try to find a source URL from external URLs, handle if list is empty
+                    source_url = 'N/A'
+                    if data.get('ext_urls'):
+                        # Prioritize certain sources if needed, or just take the first one
+                        source_url = data['ext_urls'][0] # Take the first URL in the list
+
+                    # Try to find artist/creator information from various possible keys
+                    artist = data.get('creator') or data.get('artist') or data.get('author_name') or 'N/A'
+                    title = data.get('title') or data.get('source') or 'N/A' # Title might be in different keys
+                    thumbnail = header.get('thumbnail') # Thumbnail URL
+
+                    saucenao_results.append({
+                        'similarity': similarity,
+                        'source_url': source_url,
+                        'artist': artist,
+                        'title': title,
+                        'thumbnail': thumbnail
+                    })
+            elif saucenao_response_data and 'results' not in saucenao_response_data:
+                logger.warning("SauceNao JSON response for %s is missing the 'results' key: %.500s", filename, saucenao_response_data)
+            else:
+                logger.warning('SauceNao API response JSON for %s is empty or invalid.', filename)
+
+        return saucenao_results
+
+    except requests.exceptions.RequestException as e:
+        logger.warning('Requests error during SauceNao API request for %s: %s', filename, e)
+        if e.response is not None:
+            logger.debug('SauceNao error response for %s: HTTP %d %.500s', filename, e.response.status_code, e.response.text)
+    except json.JSONDecodeError:
+        logger.warning('Error decoding JSON from SauceNao API response for %s.', filename)
+        if response is not None:
+            logger.debug('Raw SauceNao response for %s: %.500s', filename, response.text)
+    except Exception as e:
+        logger.exception('An unexpected error occurred during SauceNao lookup for %s: %s', filename, e)
+    return None
+
+def get_source_results(image_full_path, filename):
+    """Return SauceNao results for an image, from the source cache when possible.
+
+    With background prefetching enabled this never calls SauceNao; a cache miss
+    queues a lookup and returns None.
+    """
+    content_hash = file_content_hash(image_full_path)
+    saucenao_results = source_cache.get(content_hash)
+    if saucenao_results is None:
+        if SOURCE_PREFETCH_ENABLED:
+            enqueue_source_lookup(filename, priority=1)
+            return None
+        saucenao_results = source_lookups.run(content_hash, lambda: fetch_saucenao_results(image_full_path, filename))
+        if saucenao_results is None:
+            # Failed lookups are not cached so the next view tries again
+            return []
+    return saucenao_results
+
+def lookup_image_source(filename):
+    """get_source_results for a public filename; an image that has gone away has no sources."""
+    image_full_path = resolve_image_path(filename)
+    if image_full_path is None:
+        return []
+    return get_source_results(image_full_path, filename)
+
 # Endpoint to get source information for a specific image
 @app.route('/image-source/<filename>')
 def get_image_source(filename):
-    # Initialize response outside the try block so it's accessible in except blocks
-    response = None
     try:
-        image_full_path = os.path.join(IMAGES_FOLDER_INTERNAL, filename)
+        image_full_path = resolve_image_path(filename)
         
         # Check if the image exists
-        if not os.path.exists(image_full_path):
+        if image_full_path is None:
             return jsonify({"error": "Image not found."}), 404
             
-        # --- Perform SauceNao Lookup ---
-        saucenao_results = []
-        try:
-            with open(image_full_path, 'rb') as img_file:
-                # Prepare data for the SauceNao API request
-                files_payload = {'file': img_file}
-                data_payload = {
-                    'api_key': SAUCENAO_API_KEY,
-                    'output_type': 2, # 2 for JSON output
-                    'db': [5, 34] # Add this to search all databases
-                }
-
-                # Make the POST request to the SauceNao API
-                response = requests.post(SAUCENAO_API_URL, data=data_payload, files=files_payload)
-                print(f"SauceNao API response status code: {response.status_code}", flush=True)
-                response.raise_for_status()
-                print("SauceNao API request successful (HTTP 2xx).", flush=True)
-
-                # Attempt to decode JSON
-                saucenao_response_data = response.json()
-                print("SauceNao API response JSON (if successful):", saucenao_response_data, flush=True)
-
-                # Process the results
-                if saucenao_response_data and 'results' in saucenao_response_data:
-                    # Filter for results with a reasonable similarity score
-                    min_similarity = 70 # You can adjust this threshold (0 to 100)
-                    filtered_results = [
-                        r for r in saucenao_response_data['results']
-                        if r.get('header', {}).get('similarity') is not None and float(r['header']['similarity']) >= min_similarity
-                    ]
-
-                    # Sort results by similarity descending
-                    sorted_results = sorted(filtered_results, key=lambda x: float(x.get('header', {}).get('similarity', 0)), reverse=True)
-
-                    for result in sorted_results:
-                        header = result.get('header', {})
-                        data = result.get('data', {})
-
-                        similarity = header.get('similarity')
-                        # Try to find a source URL from external URLs, handle if list is empty
-                        source_url = 'N/A'
-                        if data.get('ext_urls'):
-                            # Prioritize certain sources if needed, or just take the first one
-                            source_url = data['ext_urls'][0] # Take the first URL in the list
-
-                        # Try to find artist/creator information from various possible keys
-                        artist = data.get('creator') or data.get('artist') or data.get('author_name') or 'N/A'
-                        title = data.get('title') or data.get('source') or 'N/A' # Title might be in different keys
-                        thumbnail = header.get('thumbnail') # Thumbnail URL
-
-                        saucenao_results.append({
-                            'similarity': similarity,
-                            'source_url': source_url,
-                            'artist': artist,
-                            'title': title,
-                            'thumbnail': thumbnail
-                        })
-                elif saucenao_response_data and 'results' not in saucenao_response_data:
-                    print(f"SauceNao JSON response missing 'results' key (response data): {saucenao_response_data}", flush=True)
-                else:
-                    print("SauceNao API response JSON is empty or invalid (after successful request and JSON decode).", flush=True)
-
-        except requests.exceptions.RequestException as e:
-            print(f"Requests error during SauceNao API request for {filename}: {e}", flush=True)
-            if e.response is not None:
-                print(f"SauceNao error response status code (if available): {e.response.status_code}", flush=True)
-                print(f"SauceNao error response text (if available): {e.response.text}", flush=True)
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON from SauceNao API response for {filename}.", flush=True)
-            if 'response' in locals() and response is not None:
-                print(f"Raw SauceNao response text that caused JSONDecodeError: {response.text}", flush=True)
-        except Exception as e:
-            print(f"An unexpected error occurred during SauceNao lookup for {filename}: {e}", flush=True)
+        # --- Perform SauceNao Lookup (cached by image content) ---
+        saucenao_results = get_source_results(image_full_path, filename)
+        if saucenao_results is None:
+            return jsonify({"source_results": [], "pending": True})
 
         # Return the source information
         return jsonify({"source_results": saucenao_results})
 
     except Exception as e:
-        print(f"An unexpected error occurred in get_image_source: {e}", flush=True)
+        logger.exception('An unexpected error occurred in get_image_source: %s', e)
         return jsonify({"error": f"An internal server error occurred: {e}"}), 500
 
+# Let visitors flag an image; each report lowers how often it is picked
+@app.route('/report-image/<filename>', methods=['POST'])
+def report_image_route(filename):
+    if not csrf_token_valid():
+        return jsonify({"error": "Missing or invalid CSRF token."}), 403
+    if not selection_engine.contains(filename):
+        return jsonify({"error": "Image not found."}), 404
+    # Count one report per image per client address, and only so many per hour
+    outcome = report_image(filename, client_address())
+    metrics.inc('image_reports_total', (('outcome', outcome),))
+    if outcome == 'rate_limited':
+        return jsonify({"error": "Too many reports; try again later."}), 429
+    return jsonify({"reported": True})
+
+# Source cache statistics
+@app.route('/source-cache-stats')
+@login_required
+def source_cache_stats():
+    return jsonify(source_cache.stats())
+
+# --- Metrics Endpoint ---
+METRIC_HELP = {
+    'http_requests_total': ('counter', 'Requests answered, by route, method and status code.'),
+    'http_request_duration_seconds': ('histogram', 'Time to produce a response, by route.'),
+    'directory_scans_total': ('counter', 'Scans of a media folder for the image catalog.'),
+    'sqlite_statements_total': ('counter', 'SQLite statements executed, by leading keyword.'),
+    'saucenao_request_duration_seconds': ('histogram', 'SauceNao API calls, by outcome.'),
+    'cache_requests_total': ('counter', 'Cache tier lookups, by namespace and result.'),
+    'cache_errors_total': ('counter', 'Cache tier backend failures, by namespace.'),
+    'cache_hit_ratio': ('gauge', 'Share of cache tier lookups that hit, by namespace.'),
+    'source_cache_lookups_total': ('counter', 'SauceNao result lookups, by where they were answered.'),
+    'source_lookups_total': ('counter', 'Source lookups that called SauceNao or shared a call in flight.'),
+    'moderation_bulk_requests_total': ('counter', 'Photo requests handled by bulk actions, by action and outcome.'),
+    'image_reports_total': ('counter', 'Visitor reports of images, by outcome.'),
+}
+
+def _collect_component_stats():
+    counters, histograms = [], []
+    for outcome, snapshot in saucenao_client.stats()['latency'].items():
+        histograms.append(['saucenao_request_duration_seconds', [['outcome', outcome]], snapshot])
+    for namespace, stats in cache_tier.stats()['namespaces'].items():
+        for result, label in (('hits', 'hit'), ('misses', 'miss')):
+            counters.append(['cache_requests_total', [['namespace', namespace], ['result', label]], stats[result]])
+        counters.append(['cache_errors_total', [['namespace', namespace]], stats['errors']])
+    stats = source_cache.stats()
+    for result in ('tier_hits', 'db_hits', 'misses'):
+        counters.append(['source_cache_lookups_total', [['result', result]], stats[result]])
+    stats = source_lookups.stats()
+    for kind in ('lookups', 'coalesced_local', 'coalesced_remote'):
+        counters.append(['source_lookups_total', [['kind', kind]], stats[kind]])
+    return counters, histograms
+
+metrics.add_collector(_collect_component_stats)
+
+def _metric_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def render_metrics():
+    """All workers' metrics in the Prometheus text exposition format."""
+    counters, histograms = metrics.aggregate()
+    # Hit ratios are derived from the summed counters, so they cover every worker
+    lookups = {}
+    for (name, labels), value in counters.items():
+        if name == 'cache_requests_total':
+            labels = dict(labels)
+            entry = lookups.setdefault(labels['namespace'], [0, 0])
+            entry[0 if labels['result'] == 'hit' else 1] += value
+    gauges = {('cache_hit_ratio', (('namespace', namespace),)): hits / (hits + misses) if hits + misses else 0.0
+              for namespace, (hits, misses) in lookups.items()}
+
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (metric, labels), value in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in value['buckets'].items():
+                    lines.append(f"{name}_bucket{_metric_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_sum{_metric_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{_metric_labels(labels)} {value['count']}")
+        else:
+            for (metric, labels), value in sorted((counters if kind == 'counter' else gauges).items()):
+                if metric == name:
+                    lines.append(f'{name}{_metric_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+# Prometheus scrape endpoint, summed over every gunicorn worker
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({"error": "Unauthorized."}), 401
+    response = app.response_class(render_metrics(), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return no_store(response)
+
+# Hit rates of the cache tier by namespace (source, catalog, motd)
+@app.route('/cache-stats')
+@login_required
+def cache_stats():
+    return jsonify(cache_tier.stats())
+
+# Single-flight lookup counters: how many lookups shared another request's SauceNao call
+@app.route('/source-lookup-stats')
+@login_required
+def source_lookup_stats():
+    return jsonify(source_lookups.stats())
+
+# SauceNao client latency and circuit breaker state
+@app.route('/saucenao-stats')
+@login_required
+def saucenao_stats():
+    return jsonify(saucenao_client.stats())
+
 # Keep the original endpoint for backward compatibility
 @app.route('/random-image-with-source')
 def get_random_image_and_source():
     try:
-        # Get a random image first
-        image_response = get_random_image()
-        
-        # If there was an error getting the random image, return that error
-        if image_response.status_code != 200:
-            return image_response
-            
-        # Extract the image data from the response
-        image_data = json.loads(image_response.get_data(as_text=True))
-        
-        if 'error' in image_data:
-            return jsonify(image_data), 500
-            
-        # Get the filename from the image URL
-        filename = image_data.get('filename')
-        
-        # Get the source information for this image
-        source_response = get_image_source(filename)
-        
-        # If there was an error getting the source information, still return the image
-        # but with empty source results
-        if source_response.status_code != 200:
-            return jsonify({
-                "imageUrl": image_data.get('imageUrl'),
-                "source_results": []
-            })
-            
-        # Extract the source data from the response
-        source_data = json.loads(source_response.get_data(as_text=True))
-        
-        # Combine the image URL and source results
-        return jsonify({
-            "imageUrl": image_data.get('imageUrl'),
-            "source_results": source_data.get('source_results', [])
-        })
-        
+        image_data = pick_random_image()
+        if image_data is None:
+            return jsonify({"error": "No images found in the folder."}), 404
+
+        # Look the source up on the request pool so a slow lookup can't hold the response past the deadline
+        source_future = request_pool.submit(lookup_image_source, image_data['filename'])
+
+        response_data = {"imageUrl": image_data['imageUrl'], "source_results": []}
+        try:
+            saucenao_results = source_future.result(timeout=SOURCE_LOOKUP_DEADLINE)
+        except FutureTimeoutError:
+            # The lookup keeps running and fills the source cache for the next viewer
+            saucenao_results = None
+        except FileNotFoundError:
+            # The image was removed after it was picked; still return it with empty source results
+            saucenao_results = []
+
+        if saucenao_results is None:
+            response_data["pending"] = True
+        else:
+            response_data["source_results"] = saucenao_results
+        return no_store(jsonify(response_data))
+
+    except FileNotFoundError:
+        return jsonify({"error": "Images folder not found on the server."}), 500
     except Exception as e:
-        print(f"An unexpected error occurred in get_random_image_and_source: {e}", flush=True)
+        logger.exception('An unexpected error occurred in get_random_image_and_source: %s', e)
         return jsonify({"error": f"An internal server error occurred: {e}"}), 500
 
 # --- Admin Routes ---
@@ -490,21 +3966,56 @@ def logout():
 @app.route('/admin')
 @login_required
 def admin_dashboard():
-    # Get pending photo requests
-    pending_requests = get_pending_requests()
-    # Get approved photo requests
-    approved_requests = get_approved_requests()
-    # Get rejected photo requests
-    rejected_requests = get_rejected_requests()
+    # The open tab and where its page starts; the other tabs show their newest page
+    active_tab = request.args.get('tab', 'pending')
+    if active_tab not in PHOTO_REQUEST_SORT_COLUMNS and active_tab != 'profiles':
+        active_tab = 'pending'
+    cursor = request.args.get('cursor')
+    if parse_page_cursor(cursor) is None:
+        cursor = None
+
+    # Get one page of pending, approved and rejected photo requests
+    pages = {}
+    next_cursors = {}
+    for status in PHOTO_REQUEST_SORT_COLUMNS:
+        pages[status], next_cursors[status] = get_photo_requests_page(status, cursor if status == active_tab else None)
+    # Get library images that look like the pending uploads on this page
+    near_duplicates = get_near_duplicate_matches([r['id'] for r in pages['pending']])
+    # Get the selection weights of the approved images on this page
+    image_weights = get_image_weights([r['filename'] for r in pages['approved']])
+    # Get the totals for the tab badges
+    counts = get_photo_request_counts()
     # Get current MOTD
     current_motd = get_motd() or ""
     
     return render_template('admin_templates/admin_dashboard.html', 
-                          pending_requests=pending_requests, 
-                          approved_requests=approved_requests, 
-                          rejected_requests=rejected_requests,
+                          pending_requests=pages['pending'], 
+                          approved_requests=pages['approved'], 
+                          rejected_requests=pages['rejected'],
+                          counts=counts,
+                          near_duplicates=near_duplicates,
+                          image_weights=image_weights,
+                          next_cursors=next_cursors,
+                          active_tab=active_tab,
+                          paged=bool(cursor),
+                          thumbnail_width=THUMBNAIL_WIDTH,
+                          profiles=list_profiles(),
                           current_motd=current_motd)
 
+# Download a captured profile; ?format=text shows a cProfile capture as a pstats summary
+@app.route('/admin/profiles/<name>')
+@login_required
+def download_profile(name):
+    path = safe_join(PROFILE_DIR, name)
+    if path is None or not name.endswith(PROFILE_EXTENSIONS) or not os.path.isfile(path):
+        flash('Profile not found.', 'danger')
+        return redirect(url_for('admin_dashboard', tab='profiles'))
+    if request.args.get('format') == 'text' and name.endswith('.prof'):
+        output = io.StringIO()
+        pstats.Stats(path, stream=output).sort_stats('cumulative').print_stats(60)
+        return app.response_class(output.getvalue(), mimetype='text/plain')
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=name)
+
 # Update MOTD
 @app.route('/update_motd', methods=['POST'])
 @login_required
@@ -543,21 +4054,22 @@ def delete_motd_route():
 def approve_photo(id):
     photo_request = get_photo_request(id)
     if photo_request and photo_request['status'] == 'pending' and photo_request['pending_path'] and os.path.exists(photo_request['pending_path']):
-        approved_filename = photo_request['filename']
-        destination_path = os.path.join(IMAGES_FOLDER_INTERNAL, approved_filename)
-
-        # Handle potential filename collisions
-        counter = 1
-        original_filename_no_ext, file_extension = os.path.splitext(approved_filename)
-        while os.path.exists(destination_path):
-            approved_filename = f"{original_filename_no_ext}_{counter}{file_extension}"
-            destination_path = os.path.join(IMAGES_FOLDER_INTERNAL, approved_filename)
-            counter += 1
-
         try:
-            shutil.move(photo_request['pending_path'], destination_path)
-            update_photo_request_approved(id, destination_path, approved_filename)
-            flash(f'Photo request {id} approved and moved to images folder as {approved_filename}!', 'success')
+            content_hash = photo_request['content_hash'] or file_content_hash(photo_request['pending_path'])
+            approved_filename, blob_path, existed = image_store.add(photo_request['pending_path'], photo_request['filename'], content_hash)
+            update_photo_request_approved(id, blob_path, approved_filename)
+            if not existed:
+                image_catalog.add(approved_filename)
+                boost_new_image(approved_filename)
+                phash = _from_sqlite_int(photo_request['phash']) if photo_request['phash'] is not None else None
+                thread_pool.submit(index_library_image, content_hash, approved_filename, blob_path, phash)
+                schedule_image_variants(blob_path, content_hash)
+                if SOURCE_PREFETCH_ENABLED:
+                    enqueue_source_lookup(approved_filename, priority=1)
+            if existed:
+                flash(f'Photo request {id} approved as {approved_filename}; the same image was already stored, so no second copy was kept.', 'success')
+            else:
+                flash(f'Photo request {id} approved and added to the image library as {approved_filename}!', 'success')
         except Exception as e:
             flash(f'Error approving photo request {id}: {e}', 'danger')
     else:
@@ -565,6 +4077,56 @@ def approve_photo(id):
 
     return redirect(url_for('admin_dashboard'))
 
+# Approve, reject or delete the selected requests in one transaction
+@app.route('/admin/bulk', methods=['POST'])
+@login_required
+def bulk_moderate():
+    action = request.form.get('action')
+    tab = request.form.get('tab', 'pending')
+    if tab not in PHOTO_REQUEST_SORT_COLUMNS:
+        tab = 'pending'
+    if action not in BULK_ACTIONS:
+        flash('Unknown bulk action.', 'danger')
+        return redirect(url_for('admin_dashboard', tab=tab))
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.form.getlist('ids')))
+    except ValueError:
+        flash('Invalid photo request id.', 'danger')
+        return redirect(url_for('admin_dashboard', tab=tab))
+    if not ids:
+        flash('Select at least one photo request.', 'warning')
+        return redirect(url_for('admin_dashboard', tab=tab))
+    if len(ids) > BULK_MAX_IDS:
+        flash(f'At most {BULK_MAX_IDS} photo requests can be handled at once.', 'warning')
+        return redirect(url_for('admin_dashboard', tab=tab))
+
+    handler, verb = BULK_ACTIONS[action]
+    try:
+        result = handler(ids)
+    except Exception as e:
+        logger.error('Bulk %s of %d photo requests failed: %s', action, len(ids), e)
+        metrics.inc('moderation_bulk_requests_total', (('action', action), ('outcome', 'error')), len(ids))
+        flash(f'Bulk {action} failed and was rolled back: {e}', 'danger')
+        return redirect(url_for('admin_dashboard', tab=tab))
+    for outcome, count in (('done', len(result.done)), ('skipped', len(result.skipped)), ('failed', len(result.failed))):
+        if count:
+            metrics.inc('moderation_bulk_requests_total', (('action', action), ('outcome', outcome)), count)
+    flash(f'Photo requests: {result.summary(verb)}.', 'warning' if result.failed else 'success')
+    return redirect(url_for('admin_dashboard', tab=tab))
+
+# Set how often an approved image is picked
+@app.route('/image-weight/<filename>', methods=['POST'])
+@login_required
+def update_image_weight(filename):
+    try:
+        weight = min(max(float(request.form.get('weight', '1')), 0.0), 100.0)
+    except ValueError:
+        flash('The weight must be a number.', 'danger')
+        return redirect(url_for('admin_dashboard', tab='approved'))
+    set_image_weight(filename, weight)
+    flash(f'Weight of {filename} set to {weight:g}; its reports were cleared.', 'success')
+    return redirect(url_for('admin_dashboard', tab='approved'))
+
 # Reject Photo
 @app.route('/reject/<int:id>')
 @login_required
@@ -574,6 +4136,9 @@ def reject_photo(id):
         if photo_request['pending_path'] and os.path.exists(photo_request['pending_path']):
             try:
                 os.remove(photo_request['pending_path'])
+                content_hashes.discard(photo_request['pending_path'])
+                if photo_request['content_hash']:
+                    remove_image_variants(photo_request['content_hash'])
                 flash(f'Pending file for request {id} deleted.', 'info')
             except Exception as e:
                 flash(f'Error deleting pending file for request {id}: {e}', 'danger')
@@ -585,12 +4150,19 @@ def reject_photo(id):
 
     return redirect(url_for('admin_dashboard'))
 
+@app.template_filter('basename')
+def basename_filter(path):
+    return os.path.basename(path)
+
 # Serve Pending Image
 @app.route('/pending_uploads/<path:filename>')
 @login_required
 def serve_pending_image(filename):
     try:
-        return send_from_directory(PENDING_UPLOADS_FOLDER, filename)
+        pending_path = safe_join(PENDING_UPLOADS_FOLDER, filename)
+        if pending_path is None:
+            return "Pending image not found for preview.", 404
+        return send_media(pending_path)
     except FileNotFoundError:
         return "Pending image not found for preview.", 404
 
@@ -599,7 +4171,10 @@ def serve_pending_image(filename):
 @login_required
 def serve_approved_image(filename):
     try:
-        return send_from_directory(IMAGES_FOLDER_INTERNAL, filename)
+        image_path = resolve_image_path(filename, must_exist=False)
+        if image_path is None:
+            return "Approved image not found for preview.", 404
+        return send_media(image_path)
     except FileNotFoundError:
         return "Approved image not found for preview.", 404
 
@@ -626,23 +4201,41 @@ def submit_photo():
 
         if file and allowed_file(file.filename):
             filename_secured = secure_filename(file.filename)
-            file_path = os.path.join(PENDING_UPLOADS_FOLDER, filename_secured)
-
-            # Handle potential filename collisions in pending_uploads
-            counter = 1
-            original_filename_no_ext, file_extension = os.path.splitext(filename_secured)
-            while os.path.exists(file_path):
-                filename_secured = f"{original_filename_no_ext}_{counter}{file_extension}"
-                file_path = os.path.join(PENDING_UPLOADS_FOLDER, filename_secured)
-                counter += 1
+            file_extension = os.path.splitext(filename_secured)[1].lower()
 
             try:
-                file.save(file_path)
-                create_photo_request(user_name, description, filename_secured, file_path)
+                # The upload was hashed while it streamed to disk; see IngestRequest
+                upload = file.stream
+                content_hash = upload.hexdigest()
+
+                if find_live_photo_request_by_hash(content_hash):
+                    flash('This image has already been submitted.', 'warning')
+                    return redirect(url_for('submit_photo'))
+                if library_has_content(content_hash, upload.size):
+                    flash('This image is already in the library.', 'warning')
+                    return redirect(url_for('submit_photo'))
+
+                # Content-addressed name: no collision search, and a rename never exposes a partial file
+                file_path = os.path.join(PENDING_UPLOADS_FOLDER, f"{content_hash}{file_extension}")
+                upload.commit(file_path)
+                try:
+                    request_id = create_photo_request(user_name, description, filename_secured, file_path, content_hash)
+                except sqlite3.IntegrityError:
+                    # An identical upload was recorded between the check and the insert; the file is its file now
+                    remove_unrecorded_upload(file_path)
+                    flash('This image has already been submitted.', 'warning')
+                    return redirect(url_for('submit_photo'))
+                except Exception:
+                    remove_unrecorded_upload(file_path)
+                    raise
+                # Flag near-duplicates of library images for the moderators without holding up the response
+                thread_pool.submit(check_upload_for_near_duplicates, request_id, file_path)
+                # Pre-generate the dashboard thumbnail; the variants are reused if the upload is approved
+                schedule_image_variants(file_path, content_hash)
                 flash('Your photo request has been submitted successfully! We will review it soon.', 'success')
                 return redirect(url_for('submit_photo'))
             except Exception as e:
-                print(f"Error saving file: {e}")
+                logger.exception('Error saving file: %s', e)
                 flash('An error occurred during file upload. Please try again.', 'danger')
         else:
             flash('File type not allowed. Please upload an image (png, jpg, jpeg, gif).', 'danger')
@@ -654,6 +4247,376 @@ def submit_photo():
 def admin_home():
     return render_template('admin_templates/admin_home.html')
 
+# --- Request Profiling ---
+def _profile_slug(environ):
+    path = environ.get('PATH_INFO', '/').strip('/') or 'index'
+    return re.sub(r'[^A-Za-z0-9]+', '-', path)[:60].strip('-')
+
+def prune_profiles(folder=PROFILE_DIR, keep=PROFILE_MAX_FILES):
+    """Delete the oldest captures beyond the newest `keep`."""
+    names = sorted((name for name in os.listdir(folder) if name.endswith(PROFILE_EXTENSIONS)),
+                   key=lambda name: os.path.getmtime(os.path.join(folder, name)))
+    for name in names[:max(0, len(names) - keep)]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+
+def list_profiles(folder=PROFILE_DIR):
+    """Captured profiles, newest first, as dicts with name, kind, size and captured_at."""
+    profiles = []
+    if not os.path.isdir(folder):
+        return profiles
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith(PROFILE_EXTENSIONS):
+                continue
+            st = entry.stat()
+            profiles.append({
+                'name': entry.name,
+                'kind': 'cProfile' if entry.name.endswith('.prof') else 'stacks',
+                'size': st.st_size,
+                'captured_at': datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+                'mtime': st.st_mtime,
+            })
+    profiles.sort(key=lambda profile: profile['mtime'], reverse=True)
+    return profiles
+
+class _ProfiledBody:
+    """Response iterable that keeps the profiler on while each chunk is produced."""
+
+    def __init__(self, iterable, profile, finish):
+        self.iterable = iterable
+        self.profile = profile
+        self.finish = finish
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        while True:
+            self.profile.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.profile.disable()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.finish()
+
+class StackSampler:
+    """Wall-clock sampling profiler for the threads that are serving a request.
+
+    Every PROFILE_STACK_INTERVAL_MS a background thread records the stack of
+    each thread the middleware has marked busy, and every
+    PROFILE_STACK_FLUSH_SECONDS writes the counts as collapsed stacks
+    ("frame;frame;frame count" lines, the input of flamegraph.pl and
+    speedscope). Nothing runs in the request threads themselves.
+    """
+
+    def __init__(self, interval_ms=PROFILE_STACK_INTERVAL_MS, flush_seconds=PROFILE_STACK_FLUSH_SECONDS, folder=PROFILE_DIR):
+        self.interval = interval_ms / 1000.0
+        self.flush_seconds = flush_seconds
+        self.folder = folder
+        self.busy = set()
+        self._counts = {}
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            # A forked worker starts its own thread and counts
+            self._pid = os.getpid()
+            self.busy = set()
+            self._counts = {}
+            threading.Thread(target=self._run, name='stack-sampler', daemon=True).start()
+
+    @staticmethod
+    def _collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_seconds
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident in tuple(self.busy):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = self._collapse(frame)
+                    self._counts[stack] = self._counts.get(stack, 0) + 1
+            del frames
+            if time.monotonic() >= next_flush:
+                next_flush = time.monotonic() + self.flush_seconds
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Error writing sampled stacks')
+
+    def flush(self):
+        counts, self._counts = self._counts, {}
+        if not counts:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-stacks.folded"
+        with open(os.path.join(self.folder, name), 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write(f'{stack} {count}\n')
+        prune_profiles(self.folder)
+
+class ProfilerMiddleware:
+    """WSGI middleware that runs selected requests under cProfile.
+
+    A request is profiled when it carries an X-Profile header and comes from a
+    logged-in admin session (or the header holds PROFILE_TOKEN), or at random
+    for PROFILE_SAMPLE_RATE of requests. Each profile, including the time spent
+    producing the response body, is written to PROFILE_DIR as a .prof file for
+    pstats or snakeviz. With PROFILE_STACK_INTERVAL_MS set, every request is
+    also covered by the stack sampler. Other requests pay a couple of checks.
+    """
+
+    def __init__(self, wsgi_app, sample_rate=PROFILE_SAMPLE_RATE, folder=PROFILE_DIR):
+        self.wsgi_app = wsgi_app
+        self.sample_rate = sample_rate
+        self.folder = folder
+        self.sampler = StackSampler(folder=folder) if PROFILE_STACK_INTERVAL_MS > 0 else None
+
+    def _requested(self, environ):
+        value = environ.get(PROFILE_HEADER_ENVIRON)
+        if not value:
+            return False
+        if PROFILE_TOKEN and value == PROFILE_TOKEN:
+            return True
+        # Only decode the session cookie for requests that ask to be profiled
+        admin_session = app.session_interface.open_session(app, app.request_class(environ))
+        return bool(admin_session and admin_session.get('logged_in'))
+
+    def __call__(self, environ, start_response):
+        if self.sampler is None:
+            return self._call(environ, start_response)
+        self.sampler.ensure_started()
+        # Only the view is sampled; streaming a file body is sendfile's or the proxy's work
+        ident = threading.get_ident()
+        self.sampler.busy.add(ident)
+        try:
+            return self._call(environ, start_response)
+        finally:
+            self.sampler.busy.discard(ident)
+
+    def _call(self, environ, start_response):
+        if not (self._requested(environ) or (self.sample_rate and random.random() < self.sample_rate)):
+            return self.wsgi_app(environ, start_response)
+
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        status = []
+
+        def profiled_start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            elapsed_ms = int((time.perf_counter() - started) * 1000)
+            name = (f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{environ.get('REQUEST_METHOD', 'GET')}-"
+                    f"{_profile_slug(environ)}-{status[0] if status else 'error'}-{elapsed_ms}ms.prof")
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                profile.dump_stats(os.path.join(self.folder, name))
+                prune_profiles(self.folder)
+            except Exception:
+                logger.exception('Error writing request profile')
+
+        profile.enable()
+        try:
+            body = self.wsgi_app(environ, profiled_start_response)
+        except BaseException:
+            profile.disable()
+            finish()
+            raise
+        profile.disable()
+        return _ProfiledBody(body, profile, finish)
+
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app)
+
+# --- ASGI Serving Mode ---
+# Threads for the blocking work of ASGI requests: SQLite, file reads and the Flask views
+ASGI_IO_THREADS = int(os.environ.get('ASGI_IO_THREADS', '32'))
+asgi_io_pool = ThreadPoolExecutor(max_workers=ASGI_IO_THREADS)
+
+async def run_blocking(func, *args):
+    """Run a blocking call on the ASGI I/O pool without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(asgi_io_pool, func, *args)
+
+def _json_body(data):
+    # Same encoding as jsonify
+    return (json.dumps(data, separators=(',', ':'), sort_keys=True) + '\n').encode('utf-8')
+
+async def _send_json(send, data, status=200, headers=()):
+    body = _json_body(data)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('ascii'))] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def image_source_async(send, filename):
+    """/image-source/<filename> as a coroutine.
+
+    Each step that touches SQLite or the disk runs on the I/O pool, and so does
+    a SauceNao lookup. Concurrent lookups of one image share a single request
+    through source_lookups, so however many clients are waiting, the waiting
+    itself costs a socket and a coroutine.
+    """
+    try:
+        image_full_path = await run_blocking(resolve_image_path, filename)
+        if image_full_path is None:
+            return await _send_json(send, {"error": "Image not found."}, 404)
+        content_hash = await run_blocking(file_content_hash, image_full_path)
+        saucenao_results = await run_blocking(source_cache.get, content_hash)
+        if saucenao_results is None:
+            if SOURCE_PREFETCH_ENABLED:
+                await run_blocking(enqueue_source_lookup, filename, 1)
+                return await _send_json(send, {"source_results": [], "pending": True})
+            saucenao_results = await asyncio.wrap_future(source_lookups.submit(
+                content_hash, lambda: fetch_saucenao_results(image_full_path, filename), asgi_io_pool))
+            if saucenao_results is None:
+                # Failed lookups are not cached so the next view tries again
+                saucenao_results = []
+        return await _send_json(send, {"source_results": saucenao_results})
+    except Exception as e:
+        logger.exception('An unexpected error occurred in image_source_async: %s', e)
+        return await _send_json(send, {"error": f"An internal server error occurred: {e}"}, 500)
+
+# Routes served by coroutines; everything else goes through the Flask app
+ASYNC_ROUTES = [
+    (re.compile(r'^/image-source/([^/]+)$'), '/image-source/<filename>', image_source_async),
+]
+
+_BODY_DONE = object()
+
+class AsgiApp:
+    """ASGI entry point with the same routes as the WSGI app.
+
+    The I/O-bound lookup endpoints are coroutines (ASYNC_ROUTES). Every other
+    request is handed to the Flask app on the I/O pool, and its response body
+    is read there chunk by chunk, so a large file download never blocks the
+    event loop either. Request bodies are buffered up to MAX_CONTENT_LENGTH.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if scope['method'] in ('GET', 'HEAD'):
+            for pattern, rule, handler in ASYNC_ROUTES:
+                match = pattern.match(scope['path'])
+                if match:
+                    return await self._call_async(handler, rule, scope, send, match.groups())
+        await self._call_wsgi(scope, receive, send)
+
+    async def _call_async(self, handler, rule, scope, send, args):
+        metrics.ensure_worker()
+        started = time.perf_counter()
+        status = []
+
+        async def send_and_record(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            await send(message)
+
+        await handler(send_and_record, *args)
+        record_request(rule, scope['method'], status[0] if status else 500, time.perf_counter() - started)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await run_blocking(init_app)
+                start_source_prefetcher()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+                environ[name] = value
+                continue
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    async def _call_wsgi(self, scope, receive, send):
+        limit = app.config['MAX_CONTENT_LENGTH']
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if limit and len(body) > limit:
+                return await _send_json(send, {"error": "Upload too large."}, 413)
+
+        started = {}
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        iterable = await run_blocking(self.wsgi_app, self._environ(scope, bytes(body)), start_response)
+        try:
+            iterator = iter(iterable)
+            # werkzeug calls start_response lazily for some responses; the first chunk forces it
+            first = await run_blocking(next, iterator, _BODY_DONE)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            chunk = first
+            while chunk is not _BODY_DONE:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+                chunk = await run_blocking(next, iterator, _BODY_DONE)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                await run_blocking(iterable.close)
+
+asgi_app = AsgiApp(app.wsgi_app)
+
 if __name__ == '__main__':
     # Ensure the data directories exist
     os.makedirs(IMAGES_FOLDER_INTERNAL, exist_ok=True)
@@ -661,25 +4624,7 @@ if __name__ == '__main__':
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
     
     # Initialize the database
-    with app.app_context():
-        create_tables()
-        
-        # Get admin credentials from environment variables or use defaults
-        admin_username = os.environ.get('ADMIN_USERNAME', 'admin')
-        admin_password = os.environ.get('ADMIN_PASSWORD', 'adminpass')
-        
-        # Create a default admin user if none exists
-        if not get_user_by_username(admin_username):
-            create_user(admin_username, admin_password)
-            print(f"\nDefault admin user '{admin_username}' created with the provided password.\n!!! CHANGE THIS PASSWORD IMMEDIATELY IN PRODUCTION !!!\n", flush=True)
-        
-        # Add a default announcement if none exists
-        if not query_db('SELECT * FROM announcements LIMIT 1'):
-            insert_db(
-                'INSERT INTO announcements (text) VALUES (?)',
-                ["Welcome to the Admin Dashboard! Please update this announcement through the 'Announcements' section."]
-            )
-            print("Default announcement added.", flush=True)
+    init_app()
     
-    print("Running Flask development server...", flush=True)
+    logger.info('Running Flask development server...')
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,86 @@
+"""Compare /random-image latency using the image catalog against the old listdir scan.
+
+Usage:
+    python benchmarks/catalog_benchmark.py --sizes 1000 100000 1000000 --requests 200
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+EXTENSIONS = ['.png', '.jpg', '.gif', '.webm', '.mp4']
+
+
+def populate(folder, count):
+    for i in range(count):
+        open(os.path.join(folder, f'image_{i}{EXTENSIONS[i % len(EXTENSIONS)]}'), 'wb').close()
+
+
+def listdir_random_image(folder, extensions):
+    # The per-request scan /random-image did before the catalog existed
+    files = os.listdir(folder)
+    image_files = [f for f in files if os.path.isfile(os.path.join(folder, f)) and f.lower().endswith(extensions)]
+    return random.choice(image_files)
+
+
+def time_calls(func, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    # The app keeps its data under ./data; run it in a scratch directory
+    workdir = tempfile.mkdtemp(prefix='catalog-bench-')
+    os.chdir(workdir)
+    os.environ['SOURCE_PREFETCH_ENABLED'] = '0'
+
+    import app as app_module
+    app_module.init_app()
+    folder = app_module.IMAGES_FOLDER_INTERNAL
+    client = app_module.app.test_client()
+
+    def endpoint():
+        response = client.get('/random-image')
+        assert response.status_code == 200 and response.get_json()['filename'].startswith('image_'), response.data
+
+    print(f"{'files':>10} {'listdir p50/p95 ms':>22} {'catalog p50/p95 ms':>22} {'endpoint p50/p95 ms':>22}")
+    try:
+        for size in args.sizes:
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+            populate(folder, size)
+            # /random-image picks through the selection engine, so it gets the catalog under test too
+            catalog = app_module.ImageCatalog(folder)
+            app_module.image_catalog = catalog
+            app_module.selection_engine = app_module.SelectionEngine(catalog)
+            catalog.refresh(force=True)
+
+            # The old path is too slow to run the full request count at large sizes
+            listdir = time_calls(lambda: listdir_random_image(folder, app_module.MEDIA_EXTENSIONS),
+                                 max(3, args.requests // max(1, size // 1000)))
+            direct = time_calls(catalog.random_choice, args.requests)
+            through_endpoint = time_calls(endpoint, args.requests)
+            print(f"{size:>10} {listdir[0]:>10.3f}/{listdir[1]:<11.3f} {direct[0]:>10.4f}/{direct[1]:<11.4f} "
+                  f"{through_endpoint[0]:>10.3f}/{through_endpoint[1]:<11.3f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
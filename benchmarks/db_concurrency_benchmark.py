@@ -0,0 +1,100 @@
+"""Concurrent SQLite read/write throughput: a connection per request vs the pooled WAL connections.
+
+Each worker process mimics a gunicorn worker running the hot queries
+(get_user_by_username, get_photo_request) with a share of photo request inserts.
+
+Usage:
+    python benchmarks/db_concurrency_benchmark.py --workers 4 --seconds 5 --write-ratio 0.1
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+USER_QUERY = 'SELECT * FROM users WHERE username = ?'
+PHOTO_QUERY = 'SELECT * FROM photo_requests WHERE id = ?'
+INSERT_QUERY = 'INSERT INTO photo_requests (user_name, description, filename, pending_path, status) VALUES (?, ?, ?, ?, ?)'
+
+
+def setup_database(path):
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL)')
+    db.execute('''CREATE TABLE photo_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_name TEXT NOT NULL, description TEXT, filename TEXT NOT NULL,
+        pending_path TEXT, approved_path TEXT, status TEXT DEFAULT 'pending' NOT NULL,
+        submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, approval_date TIMESTAMP)''')
+    db.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)', [(f'user{i}', 'x') for i in range(100)])
+    db.executemany(INSERT_QUERY, [('bench', '', f'f{i}.png', f'p/f{i}.png', 'pending') for i in range(10000)])
+    db.commit()
+    db.close()
+
+
+def run_worker(mode, path, seconds, write_ratio, results):
+    import app as app_module
+
+    if mode == 'pool':
+        pool = app_module.ConnectionPool(path)
+
+        def execute(query, args, write):
+            with pool.connection() as db:
+                db.execute(query, args).fetchall()
+    else:
+        def execute(query, args, write):
+            # What get_db/insert_db did before: open per request, commit immediately, close in teardown
+            db = sqlite3.connect(path)
+            try:
+                db.execute(query, args).fetchall()
+                if write:
+                    db.commit()
+            finally:
+                db.close()
+
+    ops = errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        roll = random.random()
+        try:
+            if roll < write_ratio:
+                execute(INSERT_QUERY, ('bench', '', 'new.png', 'p/new.png', 'pending'), True)
+            elif roll < (1 + write_ratio) / 2:
+                execute(USER_QUERY, (f'user{random.randrange(100)}',), False)
+            else:
+                execute(PHOTO_QUERY, (random.randrange(1, 10000),), False)
+            ops += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    results.put((ops, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='randomimage-bench-'))
+    for mode in ('per-request', 'pool'):
+        path = os.path.abspath(f'{mode}.db')
+        setup_database(path)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_worker, args=(mode, path, args.seconds, args.write_ratio, results))
+                   for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        totals = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        ops = sum(t[0] for t in totals)
+        errors = sum(t[1] for t in totals)
+        print(f"{mode:>12}: {ops / args.seconds:10.0f} ops/s   {errors} 'database is locked' errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""Load-test the public endpoints of the app running under gunicorn.
+
+Builds a synthetic library in a temporary data directory, starts gunicorn on it
+with SauceNao replaced by benchmarks/saucenao_stub.py, then drives each
+endpoint in turn with concurrent keep-alive clients:
+
+    random-image    GET /random-image
+    image-count     GET /image-count
+    images          GET /images/<f> for a random library file, body read in full
+    image-source    GET /image-source/<f> for a random library file
+
+The library and the request sequence are derived from --seed, so two runs with
+the same arguments on the same machine are comparable. Results (p50/p95/p99
+latency, throughput, status codes) are written as JSON; --compare prints the
+change against an earlier result file.
+
+Usage:
+    python benchmarks/load_test.py --images 2000 --workers 4 --threads 4 --concurrency 16 \\
+        --duration 10 --latency 0.3 --output before.json
+    python benchmarks/load_test.py ... --output after.json --compare before.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import saucenao_stub
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ENDPOINTS = ('random-image', 'image-count', 'images', 'image-source')
+DEFAULT_MIX = 'png=35,jpg=35,gif=10,webm=10,mp4=10'
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        extension, weight = part.split('=')
+        mix[extension.strip().lstrip('.')] = float(weight)
+    return mix
+
+
+def write_still(path, extension, rng, width):
+    """A random-noise image of the given format, or random bytes when Pillow is missing."""
+    height = width * 3 // 4
+    if Image is None:
+        with open(path, 'wb') as f:
+            f.write(rng.randbytes(width * height // 4))
+        return
+    image = Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3))
+    if extension == 'gif':
+        image = image.convert('P')
+    image.save(path, {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'gif': 'GIF'}[extension])
+
+
+def build_library(folder, count, mix, video_kb, image_width, seed):
+    """Write count files with extensions drawn from mix; returns their names."""
+    rng = random.Random(seed)
+    extensions = list(mix)
+    weights = [mix[e] for e in extensions]
+    names = []
+    for i in range(count):
+        extension = rng.choices(extensions, weights)[0]
+        name = f'image_{i:06d}.{extension}'
+        path = os.path.join(folder, name)
+        if extension in ('webm', 'mp4'):
+            with open(path, 'wb') as f:
+                f.write(rng.randbytes(video_kb * 1024))
+        else:
+            write_still(path, extension, rng, image_width)
+        names.append(name)
+    return names
+
+
+def start_server(workdir, port, args, stub_port):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': REPO_DIR + os.pathsep + env.get('PYTHONPATH', ''),
+        'GUNICORN_BIND': f'127.0.0.1:{port}',
+        'GUNICORN_WORKERS': str(args.workers),
+        'GUNICORN_THREADS': str(args.threads),
+        'SERVER_MODE': args.server_mode,
+        'SAUCENAO_API_URL': f'http://127.0.0.1:{stub_port}/search.php',
+        'SOURCE_PREFETCH_ENABLED': '1' if args.prefetch else '0',
+        'LOG_LEVEL': 'WARNING',
+        'CACHE_SHARED_DIR': os.path.join(workdir, 'cache'),
+    })
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'wb')
+    process = subprocess.Popen(
+        ['gunicorn', '--config', os.path.join(REPO_DIR, 'gunicorn.conf.py'), '--chdir', workdir],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with {process.returncode}; see {log.name}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/image-count')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'gunicorn did not answer within 60 seconds; see {log.name}')
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of sorted samples."""
+    if not samples:
+        return None
+    return samples[max(0, math.ceil(fraction * len(samples)) - 1)]
+
+
+def run_endpoint(port, endpoint, names, concurrency, duration, seed):
+    """Drive one endpoint for duration seconds; returns its result record."""
+    def make_path(rng):
+        if endpoint == 'random-image':
+            return '/random-image'
+        if endpoint == 'image-count':
+            return '/image-count'
+        return f'/{endpoint}/{quote(rng.choice(names))}'
+
+    stop_at = time.monotonic() + duration
+
+    def client(index):
+        rng = random.Random(f'{seed}-{endpoint}-{index}')
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        samples, statuses, errors, received = [], {}, 0, 0
+        while time.monotonic() < stop_at:
+            path = make_path(rng)
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                received += len(response.read())
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                continue
+            samples.append((time.perf_counter() - start) * 1000)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+        conn.close()
+        return samples, statuses, errors, received
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    samples = sorted(s for result in results for s in result[0])
+    statuses = {}
+    for result in results:
+        for status, count in result[1].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    received = sum(result[3] for result in results)
+    return {
+        'requests': len(samples),
+        'errors': sum(result[2] for result in results),
+        'status_codes': statuses,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(samples) / elapsed, 2),
+        'bytes_per_second': round(received / elapsed),
+        'latency_ms': {
+            'p50': percentile(samples, 0.50),
+            'p95': percentile(samples, 0.95),
+            'p99': percentile(samples, 0.99),
+            'max': samples[-1] if samples else None,
+            'mean': sum(samples) / len(samples) if samples else None,
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(report, baseline):
+    print(f"{'endpoint':>13}  {'metric':>14}  {'baseline':>10}  {'this run':>10}  {'change':>8}")
+    for endpoint, result in report['results'].items():
+        old = baseline['results'].get(endpoint)
+        if old is None:
+            continue
+        rows = [('throughput_rps', old['throughput_rps'], result['throughput_rps'])]
+        rows += [(f'{p} ms', old['latency_ms'][p], result['latency_ms'][p]) for p in ('p50', 'p95', 'p99')]
+        for metric, before, after in rows:
+            if before is None or after is None:
+                continue
+            change = f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
+            print(f'{endpoint:>13}  {metric:>14}  {before:10.2f}  {after:10.2f}  {change:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=1000, help='files in the synthetic library')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='extension=weight pairs for the library')
+    parser.add_argument('--image-width', type=int, default=640, help='width of the generated stills')
+    parser.add_argument('--video-kb', type=int, default=512, help='size of each generated video')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--server-mode', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--prefetch', action='store_true', help='keep background SauceNao prefetching on')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent keep-alive clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint')
+    parser.add_argument('--latency', type=float, default=0.3, help='stub SauceNao latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds around --latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503s from the stub')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--stub-port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare this run against')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary data directory')
+    args = parser.parse_args()
+
+    stub = saucenao_stub.serve(args.stub_port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    workdir = tempfile.mkdtemp(prefix='load-test-')
+    images_folder = os.path.join(workdir, 'data', 'images')
+    os.makedirs(images_folder)
+    print(f'Generating {args.images} files in {images_folder}', file=sys.stderr, flush=True)
+    names = build_library(images_folder, args.images, parse_mix(args.mix), args.video_kb, args.image_width, args.seed)
+
+    process = start_server(workdir, args.port, args, args.stub_port)
+    try:
+        results = {}
+        for endpoint in args.endpoints:
+            print(f'Running {endpoint} for {args.duration:g}s', file=sys.stderr, flush=True)
+            results[endpoint] = run_endpoint(args.port, endpoint, names, args.concurrency, args.duration, args.seed)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        stub.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'keep')},
+        'environment': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
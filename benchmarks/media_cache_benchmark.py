@@ -0,0 +1,94 @@
+"""Bytes and time spent fetching media for a viewer clicking through random images.
+
+Simulates one browser with an HTTP cache viewing random picks from a small
+library, under three URL schemes:
+
+    cachebuster  the old /images/<f>?cb=<random> URLs: every view downloads the file
+    revalidate   unversioned /images/<f>: cached copies are revalidated with If-None-Match
+    immutable    the versioned /images/<f>?v=<hash> URLs from /random-image: cached
+                 copies are reused without a request
+
+Usage:
+    python benchmarks/media_cache_benchmark.py --images 50 --size 500000 --views 500
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+
+class BrowserCache:
+    """Just enough of an HTTP cache: immutable entries are reused, others revalidated."""
+
+    def __init__(self, client):
+        self.client = client
+        self.entries = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def fetch(self, url):
+        cached = self.entries.get(url)
+        if cached and 'immutable' in cached['cache_control']:
+            return
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+        start = time.perf_counter()
+        response = self.client.get(url, headers=headers)
+        body = response.get_data()
+        self.seconds += time.perf_counter() - start
+        self.requests += 1
+        self.bytes += len(body)
+        if response.status_code == 304:
+            self.not_modified += 1
+        else:
+            self.entries[url] = {
+                'etag': response.headers.get('ETag'),
+                'cache_control': response.headers.get('Cache-Control', ''),
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--size', type=int, default=500000, help='bytes per image')
+    parser.add_argument('--views', type=int, default=500)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='media-cache-bench-')
+    os.chdir(workdir)
+    os.environ['SOURCE_PREFETCH_ENABLED'] = '0'
+
+    import app as app_module
+    app_module.app.root_path = workdir
+
+    for i in range(args.images):
+        with open(os.path.join(app_module.IMAGES_FOLDER_INTERNAL, f'image_{i}.png'), 'wb') as f:
+            f.write(os.urandom(args.size))
+    app_module.init_app()
+    app_module.image_catalog.refresh(force=True)
+    client = app_module.app.test_client()
+
+    schemes = {
+        'cachebuster': lambda url, filename: f'/images/{filename}?cb={random.randint(100000, 999999)}',
+        'revalidate': lambda url, filename: f'/images/{filename}',
+        'immutable': lambda url, filename: url,
+    }
+    print(f"images={args.images} size={args.size} bytes views={args.views}")
+    for name, make_url in schemes.items():
+        random.seed(1)
+        browser = BrowserCache(client)
+        for _ in range(args.views):
+            pick = client.get('/random-image').get_json()
+            browser.fetch(make_url(pick['imageUrl'], pick['filename']))
+        print(f"{name:>11}: {browser.requests:5d} media requests ({browser.not_modified:4d} x 304)   "
+              f"{browser.bytes / 1e6:9.1f} MB   {browser.seconds * 1000:9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compare /random-image-with-source against the old serial view-calling implementation.
+
+SauceNao is replaced by benchmarks/saucenao_stub.py and background prefetching is
+turned off, so every cache miss pays the stub's latency.
+
+Usage:
+    python benchmarks/random_with_source_benchmark.py --images 500 --requests 100 --latency 0.3 --deadline 0.1
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import saucenao_stub
+
+
+def legacy_random_image_and_source(app_module):
+    # The implementation before the endpoint was rebuilt: call both views and re-parse their JSON
+    image_response = app_module.get_random_image()
+    image_data = json.loads(image_response.get_data(as_text=True))
+    source_response = app_module.get_image_source(image_data['filename'])
+    if isinstance(source_response, tuple) or source_response.status_code != 200:
+        return app_module.jsonify({"imageUrl": image_data.get('imageUrl'), "source_results": []})
+    source_data = json.loads(source_response.get_data(as_text=True))
+    return app_module.jsonify({
+        "imageUrl": image_data.get('imageUrl'),
+        "source_results": source_data.get('source_results', [])
+    })
+
+
+def measure(func, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1], max(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.3, help='stub SauceNao latency in seconds')
+    parser.add_argument('--deadline', type=float, default=0.1, help='SOURCE_LOOKUP_DEADLINE for the new endpoint')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    server = saucenao_stub.serve(args.port, latency=args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    workdir = tempfile.mkdtemp(prefix='randomimage-bench-')
+    os.chdir(workdir)
+    os.environ['SAUCENAO_API_URL'] = f'http://127.0.0.1:{args.port}/search.php'
+    os.environ['SOURCE_PREFETCH_ENABLED'] = '0'
+    os.environ['SOURCE_LOOKUP_DEADLINE'] = str(args.deadline)
+
+    import app as app_module
+
+    for i in range(args.images):
+        with open(os.path.join(app_module.IMAGES_FOLDER_INTERNAL, f'image_{i}.png'), 'wb') as f:
+            f.write(os.urandom(2048))
+    app_module.init_app()
+    app_module.image_catalog.refresh(force=True)
+    client = app_module.app.test_client()
+
+    def before():
+        with app_module.app.test_request_context('/random-image-with-source'):
+            legacy_random_image_and_source(app_module)
+
+    results = {
+        'before': measure(before, args.requests),
+        'after': measure(lambda: client.get('/random-image-with-source'), args.requests),
+    }
+    print(f"images={args.images} stub_latency={args.latency}s deadline={args.deadline}s requests={args.requests}")
+    for name, (p50, p95, worst) in results.items():
+        print(f"{name:>7}: p50 {p50:8.2f} ms   p95 {p95:8.2f} ms   max {worst:8.2f} ms")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Simulate video players seeking through a large clip with HTTP Range requests.
+
+Each player thread jumps to random offsets in a 100 MB .mp4 and reads a window
+from there, the way a <video> element does when seeking. Compared:
+
+    refetch      no Range support: every seek streams the clip from byte 0
+    send_file    the previous werkzeug send_file path (open, seek and read per request)
+    mmap         serve_image's Range handling with shared memory maps
+    multirange   serve_image answering several ranges per request as multipart/byteranges
+
+Usage:
+    python benchmarks/range_seek_benchmark.py --size-mb 100 --players 8 --seeks 50 --window-kb 512
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+
+def run_players(client, players, seeks, make_request):
+    """Run the players concurrently; returns (per-seek latencies in ms, bytes read, seconds)."""
+    def player(seed):
+        rng = random.Random(seed)
+        samples, read = [], 0
+        for _ in range(seeks):
+            start = time.perf_counter()
+            read += make_request(client, rng)
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples, read
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=players) as pool:
+        results = list(pool.map(player, range(players)))
+    elapsed = time.perf_counter() - started
+    samples = sorted(s for result in results for s in result[0])
+    return samples, sum(result[1] for result in results), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=100)
+    parser.add_argument('--players', type=int, default=8)
+    parser.add_argument('--seeks', type=int, default=50, help='seeks per player')
+    parser.add_argument('--refetch-seeks', type=int, default=3, help='seeks per player without Range support')
+    parser.add_argument('--window-kb', type=int, default=512, help='bytes read after each seek')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='range-bench-')
+    os.chdir(workdir)
+    os.environ['SOURCE_PREFETCH_ENABLED'] = '0'
+
+    import app as app_module
+    from flask import send_file
+    app_module.app.root_path = workdir
+    app_module.init_app()
+
+    size = args.size_mb * 1024 * 1024
+    window = args.window_kb * 1024
+    clip_path = os.path.join(app_module.IMAGES_FOLDER_INTERNAL, 'clip.mp4')
+    with open(clip_path, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    @app_module.app.route('/bench/send-file/<filename>')
+    def bench_send_file(filename):
+        return send_file(os.path.join(app_module.IMAGES_FOLDER_INTERNAL, filename))
+
+    client = app_module.app.test_client()
+
+    def refetch(client, rng):
+        # Stream from byte 0 until the seek target plus the window has arrived
+        target = rng.randrange(0, size - window) + window
+        response = client.get('/images/clip.mp4', buffered=False)
+        read = 0
+        for chunk in response.response:
+            read += len(chunk)
+            if read >= target:
+                break
+        response.close()
+        return read
+
+    def ranged(url):
+        def request(client, rng):
+            start = rng.randrange(0, size - window)
+            response = client.get(url, headers={'Range': f'bytes={start}-{start + window - 1}'})
+            assert response.status_code == 206, response.status_code
+            return len(response.get_data())
+        return request
+
+    def multirange(client, rng):
+        # Four windows a quarter of the size each, e.g. a player fetching index and keyframes together
+        quarter = window // 4
+        starts = sorted(rng.sample(range(0, size - quarter, quarter), 4))
+        spec = ','.join(f'{s}-{s + quarter - 1}' for s in starts)
+        response = client.get('/images/clip.mp4', headers={'Range': f'bytes={spec}'})
+        assert response.status_code == 206, response.status_code
+        return len(response.get_data())
+
+    modes = [
+        ('refetch', refetch, args.refetch_seeks),
+        ('send_file', ranged('/bench/send-file/clip.mp4'), args.seeks),
+        ('mmap', ranged('/images/clip.mp4'), args.seeks),
+        ('multirange', multirange, args.seeks),
+    ]
+    print(f"clip={args.size_mb} MB players={args.players} window={args.window_kb} KB")
+    for name, make_request, seeks in modes:
+        samples, read, elapsed = run_players(client, args.players, seeks, make_request)
+        p95 = samples[max(int(len(samples) * 0.95) - 1, 0)]
+        print(f"{name:>10}: {len(samples):5d} seeks   p50 {statistics.median(samples):8.2f} ms   p95 {p95:8.2f} ms   "
+              f"{read / 1e6:9.1f} MB read   {len(samples) / elapsed:8.1f} seeks/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Local stand-in for a Redis server, for the cache tier's redis backend.
+
+Speaks enough of the Redis protocol (RESP) for the app: PING, GET, SET with
+EX/PX, DEL, DBSIZE, FLUSHDB, SELECT and AUTH. Everything is kept in memory.
+Point the app at it with CACHE_BACKEND=redis CACHE_REDIS_URL=redis://127.0.0.1:6380/0.
+
+Usage:
+    python benchmarks/redis_stub.py --port 6380 --latency 0.001
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class Store:
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.time():
+                del self.data[key]
+                return None
+            return entry[0]
+
+
+def read_command(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Inline command, as typed into telnet
+        return line.split()
+    args = []
+    for _ in range(int(line[1:-2])):
+        length = int(reader.readline()[1:-2])
+        args.append(reader.read(length + 2)[:-2])
+    return args
+
+
+def bulk(value):
+    return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def make_handler(store, latency):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            while True:
+                args = read_command(self.rfile)
+                if args is None:
+                    return
+                if latency:
+                    time.sleep(latency)
+                self.wfile.write(self.execute([args[0].upper()] + args[1:]))
+
+        def execute(self, args):
+            name = args[0]
+            if name == b'PING':
+                return b'+PONG\r\n'
+            if name in (b'SELECT', b'AUTH'):
+                return b'+OK\r\n'
+            if name == b'GET':
+                return bulk(store.get(args[1]))
+            if name == b'SET':
+                expires_at = None
+                options = [a.upper() for a in args[3:]]
+                if b'EX' in options:
+                    expires_at = time.time() + int(args[3 + options.index(b'EX') + 1])
+                elif b'PX' in options:
+                    expires_at = time.time() + int(args[3 + options.index(b'PX') + 1]) / 1000
+                with store.lock:
+                    store.data[args[1]] = (args[2], expires_at)
+                return b'+OK\r\n'
+            if name == b'DEL':
+                with store.lock:
+                    removed = sum(store.data.pop(key, None) is not None for key in args[1:])
+                return b':%d\r\n' % removed
+            if name == b'DBSIZE':
+                with store.lock:
+                    return b':%d\r\n' % len(store.data)
+            if name == b'FLUSHDB':
+                with store.lock:
+                    store.data.clear()
+                return b'+OK\r\n'
+            return b'-ERR unknown command \'%s\'\r\n' % name
+
+    return Handler
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(port=6380, latency=0.0):
+    """Create the stub server; call serve_forever() on the result (e.g. from a thread)."""
+    return Server(('127.0.0.1', port), make_handler(Store(), latency))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=6380)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every command')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency)
+    print(f'Redis stub listening on redis://127.0.0.1:{args.port}/0', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Local stand-in for the SauceNao search API.
+
+Point the app at it with SAUCENAO_API_URL=http://127.0.0.1:8765/search.php.
+
+Usage:
+    python benchmarks/saucenao_stub.py --port 8765 --latency 0.5 --error-rate 0.1
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPONSE = {
+    'header': {'status': 0, 'short_remaining': 3, 'long_remaining': 99},
+    'results': [{
+        'header': {'similarity': '93.12', 'thumbnail': 'https://example.invalid/thumb.jpg'},
+        'data': {'ext_urls': ['https://example.invalid/post/1'], 'creator': 'stub artist', 'title': 'stub title'},
+    }],
+}
+
+
+def make_handler(latency, jitter, error_rate, rate_limit_rate):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            # Drain the multipart upload so keep-alive connections stay usable
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+            roll = random.random()
+            if roll < rate_limit_rate:
+                self._reply(429, {'header': {'status': -2, 'message': 'Search rate limit exceeded.'}}, {'Retry-After': '1'})
+            elif roll < rate_limit_rate + error_rate:
+                self._reply(503, {'header': {'status': -1}})
+            else:
+                self._reply(200, RESPONSE)
+
+        def _reply(self, status, body, headers=None):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=8765, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0):
+    """Create the stub server; call serve_forever() on the result (e.g. from a thread)."""
+    return ThreadingHTTPServer(('127.0.0.1', port), make_handler(latency, jitter, error_rate, rate_limit_rate))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds around --latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of 429 responses')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency, args.jitter, args.error_rate, args.rate_limit_rate)
+    print(f'SauceNao stub listening on http://127.0.0.1:{args.port}/search.php', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
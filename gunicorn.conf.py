@@ -0,0 +1,33 @@
+# Gunicorn configuration for the random image app
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# SERVER_MODE=asgi runs app:asgi_app on uvicorn workers: /image-source/ waits on SauceNao
+# as a coroutine instead of holding a thread, and every other route goes through Flask
+if os.environ.get('SERVER_MODE', 'wsgi') == 'asgi':
+    wsgi_app = 'app:asgi_app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'app:app'
+
+# Several workers with a few threads each (gthread), so one slow client downloading
+# a video can't block the whole site; threads are ignored by uvicorn workers
+workers = int(os.environ.get('GUNICORN_WORKERS', '4'))
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+
+# Send whole media files with os.sendfile() instead of copying them through Python;
+# only used when MEDIA_OFFLOAD doesn't hand them to nginx
+sendfile = True
+
+def on_starting(server):
+    # Run migrations and create the default admin once, in the master, before workers fork
+    from app import init_app, metrics
+    init_app()
+    # /metrics sums the snapshots of this server's workers; drop the previous run's
+    metrics.clear()
+
+def post_worker_init(worker):
+    # Start this worker's background SauceNao lookup thread without waiting for a request
+    from app import start_source_prefetcher
+    start_source_prefetcher()
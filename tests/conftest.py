@@ -0,0 +1,177 @@
+"""Shared fixtures: the app module running in a throwaway data directory.
+
+app.py keeps its data under the relative path 'data' and reads its settings
+when it is imported, so the session fixture changes into a temporary directory
+and sets the environment first. Every test starts from an empty library and
+empty request tables; users and the announcement are kept.
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+
+import pytest
+from jinja2 import ChoiceLoader, FileSystemLoader
+from werkzeug.datastructures import Headers
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_DIR)
+# The stub servers in benchmarks/ stand in for Redis and SauceNao
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+# Tables holding library and moderation state, emptied before each test
+DATA_TABLES = (
+    'photo_requests', 'photo_request_matches', 'image_files', 'image_blobs', 'image_phashes', 'image_variants',
+    'image_weights', 'source_cache', 'source_lookup_jobs', 'source_leases', 'rate_limits', 'image_reports',
+)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    workdir = str(tmp_path_factory.mktemp('app'))
+    os.chdir(workdir)
+    os.environ.update({
+        'SOURCE_PREFETCH_ENABLED': '0',
+        'CACHE_BACKEND': 'local',
+        'CACHE_SHARED_DIR': os.path.join(workdir, 'cache'),
+        'SAUCENAO_API_URL': 'http://127.0.0.1:9/search.php',
+        'LOG_LEVEL': 'WARNING',
+    })
+    import app as app_module
+
+    app_module.app.config['TESTING'] = True
+    # The Dockerfile links admin_templates/ into templates/; look there directly instead
+    app_module.app.jinja_env.loader = ChoiceLoader([app_module.app.jinja_env.loader, FileSystemLoader(REPO_DIR)])
+    app_module.init_app()
+    return app_module
+
+
+def reset_data(m):
+    with m.db_pool.connection() as db:
+        tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table in DATA_TABLES:
+            if table in tables:
+                db.execute(f'DELETE FROM {table}')
+    for folder in (m.IMAGES_FOLDER_INTERNAL, m.IMAGE_STORE_FOLDER, m.PENDING_UPLOADS_FOLDER):
+        for root, dirs, files in os.walk(folder, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+    m.bump_app_state('image_store_version')
+    m.bump_app_state('image_weights_version')
+    m.cache_tier.backend = m.make_cache_backend('local')
+    m.image_catalog.invalidate()
+    m.selection_engine._next_check = 0.0
+
+
+@pytest.fixture(autouse=True)
+def clean_data(request):
+    if 'app_module' in request.fixturenames:
+        reset_data(request.getfixturevalue('app_module'))
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def admin_client(app_module):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    return client
+
+
+def png_bytes(color=(200, 40, 40), size=(64, 48)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def add_image(app_module):
+    """Write a file into the legacy library folder and make the catalog see it."""
+    def add(filename, data=None):
+        path = os.path.join(app_module.IMAGES_FOLDER_INTERNAL, filename)
+        with open(path, 'wb') as f:
+            f.write(png_bytes() if data is None else data)
+        app_module.image_catalog.invalidate()
+        return path
+    return add
+
+
+class AsgiResponse:
+    """The parts of a werkzeug test response the tests use."""
+
+    def __init__(self, status, headers, data):
+        self.status_code = status
+        self.headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in headers])
+        self.data = data
+
+    def get_json(self):
+        return json.loads(self.data)
+
+
+class AsgiClient:
+    """Calls an ASGI app directly, without a server, the way uvicorn would."""
+
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    def scope(self, method, url, headers):
+        path, _, query = url.partition('?')
+        return {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in (headers or {}).items()],
+            'client': ('127.0.0.1', 50000),
+            'server': ('localhost', 80),
+        }
+
+    async def call(self, method, url, headers=None, body=b''):
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.asgi_app(self.scope(method, url, headers), receive, send)
+        start = sent[0]
+        assert start['type'] == 'http.response.start'
+        return AsgiResponse(start['status'], start['headers'], b''.join(m.get('body', b'') for m in sent[1:]))
+
+    def get(self, url, headers=None):
+        return asyncio.run(self.call('GET', url, headers))
+
+    def get_many(self, urls, headers=None):
+        """Send the requests concurrently on one event loop."""
+        async def gather():
+            return await asyncio.gather(*(self.call('GET', url, headers) for url in urls))
+        return asyncio.run(gather())
+
+
+@pytest.fixture
+def asgi_client(app_module):
+    return AsgiClient(app_module.asgi_app)
+
+
+@pytest.fixture(params=['wsgi', 'asgi'])
+def any_client(request, app_module):
+    """The same requests through the Flask test client and through the ASGI adapter."""
+    if request.param == 'wsgi':
+        return app_module.app.test_client()
+    return AsgiClient(app_module.asgi_app)
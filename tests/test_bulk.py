@@ -0,0 +1,38 @@
+"""Bulk moderation from the dashboard."""
+import threading
+
+from .conftest import png_bytes
+from .test_uploads import submit
+
+
+def pending_ids(app_module, count):
+    client = app_module.app.test_client()
+    for i in range(count):
+        submit(client, png_bytes((i, 1, 1)), f'upload{i}.png')
+    with app_module.db_pool.connection() as db:
+        return [row[0] for row in db.execute("SELECT id FROM photo_requests WHERE status = 'pending'")]
+
+
+def test_bulk_approve_does_not_wait_for_the_request_pool(app_module):
+    ids = pending_ids(app_module, 3)
+    # Every request pool thread is stuck on a slow SauceNao lookup
+    release = threading.Event()
+    stuck = [app_module.request_pool.submit(release.wait, 10) for _ in range(app_module.request_pool._max_workers)]
+    results = []
+
+    def approve():
+        with app_module.app.test_request_context():
+            results.append(app_module.bulk_approve(ids))
+
+    worker = threading.Thread(target=approve)
+    worker.start()
+    worker.join(5)
+    finished_while_stuck = not worker.is_alive()
+    release.set()
+    for future in stuck:
+        future.result()
+    worker.join()
+    assert finished_while_stuck
+    assert len(results) == 1
+    assert sorted(results[0].done) == sorted(ids)
+    assert len(app_module.image_catalog.files()) == 3
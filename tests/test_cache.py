@@ -0,0 +1,101 @@
+"""The cache tier's local backend bounds, the catalog snapshots kept in it, and the file digest cache."""
+import threading
+
+import pytest
+import redis_stub
+
+from .conftest import png_bytes
+
+
+def test_local_backend_evicts_by_size(app_module):
+    backend = app_module.LocalCacheBackend(max_entries=100, max_bytes=20000)
+    for i in range(10):
+        backend.set(f'k{i}', ['x' * 1000] * 3)
+    info = backend.info()
+    assert info['bytes'] <= 20000
+    assert info['entries'] < 10
+    assert backend.get('k9') is not None
+    assert backend.get('k0') is None
+
+
+def test_local_backend_skips_values_over_budget(app_module):
+    backend = app_module.LocalCacheBackend(max_entries=100, max_bytes=1000)
+    backend.set('small', 'x')
+    backend.set('big', 'x' * 5000)
+    assert backend.get('big') is None
+    assert backend.get('small') == 'x'
+    backend.delete('small')
+    assert backend.info() == {'entries': 0, 'bytes': 0}
+
+
+def test_catalog_keeps_one_snapshot_per_listing(app_module, add_image):
+    add_image('a.png')
+    catalog = app_module.image_catalog
+    for _ in range(20):
+        app_module.bump_app_state('image_store_version')
+        catalog.invalidate()
+        assert catalog.files() == ('a.png',)
+    keys = [key for key in app_module.cache_tier.backend._entries if ':catalog:' in key]
+    assert sorted(key.split(':catalog:')[1].split(':')[0] for key in keys) == ['folder', 'store']
+
+
+def test_content_hash_cache_is_bounded(app_module, tmp_path):
+    cache = app_module.ContentHashCache(size=2)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'{i}.bin'
+        path.write_bytes(bytes([i]) * 10)
+        paths.append(str(path))
+        cache.get(str(path))
+    assert cache.peek(paths[0]) is None
+    assert cache.peek(paths[2]) == app_module.hashlib.sha256(bytes([2]) * 10).hexdigest()
+
+    # A changed file is hashed again rather than answered from the cache
+    (tmp_path / '2.bin').write_bytes(b'changed!')
+    assert cache.peek(paths[2]) is None
+    assert cache.get(paths[2]) == app_module.hashlib.sha256(b'changed!').hexdigest()
+
+
+def test_moderation_drops_digests_of_moved_files(app_module, admin_client):
+    from .test_uploads import submit
+    submit(app_module.app.test_client(), png_bytes((9, 9, 9)))
+    with app_module.db_pool.connection() as db:
+        request_id, pending_path = db.execute('SELECT id, pending_path FROM photo_requests').fetchone()
+    app_module.file_content_hash(pending_path)
+    assert pending_path in app_module.content_hashes._digests
+
+    assert admin_client.get(f'/reject/{request_id}').status_code == 302
+    assert pending_path not in app_module.content_hashes._digests
+
+
+@pytest.fixture
+def redis_backend(app_module):
+    server = redis_stub.serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    backend = app_module.RedisCacheBackend(f'redis://127.0.0.1:{server.server_address[1]}/0', timeout=2)
+    yield backend
+    server.shutdown()
+    server.server_close()
+
+
+def test_redis_error_reply_keeps_the_connection(app_module, redis_backend):
+    redis_backend.set('k', [1, 2])
+    with pytest.raises(app_module.RedisError):
+        redis_backend.command('NOSUCHCOMMAND')
+    assert redis_backend._pool.qsize() == 1
+    assert redis_backend.get('k') == [1, 2]
+    assert redis_backend._pool.qsize() == 1
+
+
+def test_redis_broken_connection_is_closed(app_module, redis_backend, monkeypatch):
+    redis_backend.set('k', 'v')
+    sock, reader = redis_backend._pool.queue[0]
+
+    def read_reply(reader):
+        raise ConnectionError('Connection closed by the Redis server')
+
+    monkeypatch.setattr(redis_backend, '_read_reply', read_reply)
+    with pytest.raises(ConnectionError):
+        redis_backend.get('k')
+    assert redis_backend._pool.qsize() == 0
+    assert sock.fileno() == -1 and reader.closed
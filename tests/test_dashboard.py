@@ -0,0 +1,46 @@
+"""Keyset pagination of the moderation dashboard."""
+import pytest
+
+
+@pytest.fixture
+def many_requests(app_module):
+    # Every third pair of requests shares a submission date, so pages must break ties on id
+    with app_module.db_pool.connection() as db:
+        db.execute('BEGIN')
+        db.executemany(
+            "INSERT INTO photo_requests (user_name, filename, status, submission_date) VALUES ('u', ?, 'pending', ?)",
+            [(f'p{i}.png', f'2024-01-01 00:{(i // 2) // 60:02d}:{(i // 2) % 60:02d}') for i in range(250)]
+        )
+        db.execute('COMMIT')
+
+
+def test_pages_cover_every_request_once(app_module, many_requests):
+    seen, cursor = [], None
+    with app_module.app.test_request_context():
+        while True:
+            rows, cursor = app_module.get_photo_requests_page('pending', cursor, page_size=40)
+            seen += [(row['submission_date'], row['id']) for row in rows]
+            if cursor is None:
+                break
+    assert len(seen) == 250
+    assert seen == sorted(seen, reverse=True)
+
+
+@pytest.mark.parametrize('status, index', [
+    ('pending', 'idx_photo_requests_status_submission'),
+    ('approved', 'idx_photo_requests_status_approval'),
+])
+def test_deep_pages_seek_the_index(app_module, many_requests, status, index):
+    query, args = app_module.photo_requests_page_query(status, '2024-01-01 00:01:00|120')
+    with app_module.db_pool.connection() as db:
+        plan = ' '.join(row[3] for row in db.execute(f'EXPLAIN QUERY PLAN {query}', args))
+    date_column = app_module.PHOTO_REQUEST_SORT_COLUMNS[status]
+    assert f'SEARCH photo_requests USING INDEX {index} (status=? AND {date_column}<?)' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+@pytest.mark.parametrize('cursor', ['garbage', '2024-01-01 00:01:00|x', '|', '%7C12abc'])
+def test_malformed_cursor_shows_the_first_page(app_module, admin_client, many_requests, cursor):
+    response = admin_client.get(f'/admin?tab=pending&cursor={cursor}')
+    assert response.status_code == 200
+    assert b'p249.png' in response.data
@@ -0,0 +1,46 @@
+"""Cache headers of /images/ responses for versioned URLs and ?w= variants."""
+from .conftest import png_bytes
+
+
+def versioned_url(client, filename):
+    pick = client.get('/random-image').get_json()
+    assert pick['filename'] == filename
+    return pick['imageUrl']
+
+
+def test_versioned_original_is_immutable(client, add_image):
+    add_image('big.png', png_bytes(size=(800, 600)))
+    response = client.get(versioned_url(client, 'big.png'))
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 365 * 24 * 3600
+
+
+def test_variant_fallback_is_not_cached(app_module, client, add_image, monkeypatch):
+    path = add_image('big.png', png_bytes(size=(800, 600)))
+    scheduled = []
+    monkeypatch.setattr(app_module, 'schedule_image_variants', lambda *args: scheduled.append(args))
+
+    url = versioned_url(client, 'big.png') + '&w=320'
+    response = client.get(url, headers={'Accept': 'image/webp,*/*'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.cache_control.no_cache
+    assert not response.cache_control.immutable
+    assert scheduled == [(path, app_module.file_content_hash(path))]
+
+    # Once the variants exist the same URL serves one, and that may be cached for good
+    app_module.generate_image_variants(path, app_module.file_content_hash(path))
+    response = client.get(url, headers={'Accept': 'image/webp,*/*'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    assert response.cache_control.immutable
+    assert 'Accept' in response.vary
+
+
+def test_original_narrower_than_variants_is_immutable(app_module, client, add_image):
+    path = add_image('small.png', png_bytes(size=(64, 48)))
+    app_module.generate_image_variants(path, app_module.file_content_hash(path))
+    response = client.get(versioned_url(client, 'small.png') + '&w=320')
+    assert response.mimetype == 'image/png'
+    assert response.cache_control.immutable
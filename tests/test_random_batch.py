@@ -0,0 +1,38 @@
+"""/random-images, the frontend's prefetch batch."""
+import pytest
+
+
+class DeferredExecutor:
+    """Keeps submitted work until the test runs it."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append((fn, args))
+
+    def run_all(self):
+        jobs, self.jobs = self.jobs, []
+        for fn, args in jobs:
+            fn(*args)
+
+
+def test_legacy_files_are_not_hashed_in_the_request(app_module, client, add_image, monkeypatch):
+    path = add_image('a.png')
+    executor = DeferredExecutor()
+    monkeypatch.setattr(app_module, 'thread_pool', executor)
+    get = app_module.content_hashes.get
+    monkeypatch.setattr(app_module.content_hashes, 'get', lambda path: pytest.fail('a file was hashed while answering the request'))
+
+    entry = client.get('/random-images?n=1').get_json()['images'][0]
+    assert entry['filename'] == 'a.png'
+    assert entry['width'] == 64
+    assert entry['source_results'] is None
+    assert not entry['pending']  # The client falls back to /image-source
+
+    # The digest is worked out in the background, and later batches use it
+    monkeypatch.setattr(app_module.content_hashes, 'get', get)
+    executor.run_all()
+    app_module.source_cache.put(app_module.content_hashes.peek(path), [{'title': 'cached'}], wait=True)
+    entry = client.get('/random-images?n=1').get_json()['images'][0]
+    assert entry['source_results'] == [{'title': 'cached'}]
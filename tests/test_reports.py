@@ -0,0 +1,82 @@
+"""Visitor reports: CSRF token, one report per client address, and the hourly limit."""
+import pytest
+
+
+def page_token(client):
+    return client.get('/random-images?n=1').get_json()['csrfToken']
+
+
+def report(client, filename, token, address='203.0.113.7'):
+    return client.post(f'/report-image/{filename}', headers={'X-CSRF-Token': token},
+                       environ_base={'REMOTE_ADDR': address})
+
+
+def reports(app_module, filename):
+    with app_module.db_pool.connection() as db:
+        row = db.execute('SELECT reports FROM image_weights WHERE filename = ?', (filename,)).fetchone()
+    return row[0] if row else 0
+
+
+def test_report_needs_the_session_token(app_module, add_image):
+    add_image('a.png')
+    client = app_module.app.test_client()
+    assert client.post('/report-image/a.png').status_code == 403
+    page_token(client)
+    assert report(client, 'a.png', 'forged').status_code == 403
+
+    # A token from another session doesn't work either
+    other_token = page_token(app_module.app.test_client())
+    assert report(client, 'a.png', other_token).status_code == 403
+    assert reports(app_module, 'a.png') == 0
+
+
+def test_one_report_per_address(app_module, add_image):
+    add_image('a.png')
+    for _ in range(3):
+        # A fresh session each time, as a script dropping its cookies would have
+        client = app_module.app.test_client()
+        assert report(client, 'a.png', page_token(client)).status_code == 200
+    assert reports(app_module, 'a.png') == 1
+
+    client = app_module.app.test_client()
+    assert report(client, 'a.png', page_token(client), address='198.51.100.2').status_code == 200
+    assert reports(app_module, 'a.png') == 2
+    app_module.selection_engine._next_check = 0.0
+    app_module.selection_engine.refresh()
+    assert app_module.selection_engine.weight('a.png') == app_module.REPORT_DEMOTION ** 2
+
+
+def test_reports_are_rate_limited_per_address(app_module, add_image, monkeypatch):
+    monkeypatch.setattr(app_module, 'REPORT_RATE_LIMIT', 2)
+    for name in ('a.png', 'b.png', 'c.png'):
+        add_image(name)
+    client = app_module.app.test_client()
+    token = page_token(client)
+    assert [report(client, name, token).status_code for name in ('a.png', 'b.png', 'c.png')] == [200, 200, 429]
+    assert reports(app_module, 'c.png') == 0
+    assert report(client, 'c.png', token, address='198.51.100.2').status_code == 200
+
+
+def test_weight_reset_lets_an_address_report_again(app_module, add_image):
+    add_image('a.png')
+    client = app_module.app.test_client()
+    token = page_token(client)
+    report(client, 'a.png', token)
+    app_module.set_image_weight('a.png', 1)
+    assert reports(app_module, 'a.png') == 0
+    report(client, 'a.png', token)
+    assert reports(app_module, 'a.png') == 1
+
+
+@pytest.mark.parametrize('trusted, forwarded, expected', [
+    (0, '192.0.2.1', '203.0.113.7'),
+    (1, '192.0.2.1', '192.0.2.1'),
+    (1, '192.0.2.9, 192.0.2.1', '192.0.2.1'),
+    (2, '192.0.2.9, 192.0.2.1', '192.0.2.9'),
+    (2, '192.0.2.1', '203.0.113.7'),
+])
+def test_client_address(app_module, monkeypatch, trusted, forwarded, expected):
+    monkeypatch.setattr(app_module, 'TRUSTED_PROXIES', trusted)
+    with app_module.app.test_request_context(headers={'X-Forwarded-For': forwarded},
+                                             environ_base={'REMOTE_ADDR': '203.0.113.7'}):
+        assert app_module.client_address() == expected
@@ -0,0 +1,101 @@
+"""SauceNaoClient retries and circuit breaker, against benchmarks/saucenao_stub.py."""
+import threading
+import time
+
+import pytest
+import requests
+import saucenao_stub
+
+
+class Stub:
+    """The stub server, answering 503 to the first `failures` requests (or to all of them)."""
+
+    def __init__(self):
+        self.hits = 0
+        self.failures = 0
+        stub = self
+        base = saucenao_stub.make_handler(0.0, 0.0, 0.0, 0.0)
+
+        class Handler(base):
+            def do_POST(self):
+                stub.hits += 1
+                if stub.failures is None or stub.hits <= stub.failures:
+                    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    self._reply(503, {'header': {'status': -1}})
+                else:
+                    super().do_POST()
+
+        self.server = saucenao_stub.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/search.php'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    stub = Stub()
+    yield stub
+    stub.close()
+
+
+def make_client(app_module, stub, monkeypatch, **kwargs):
+    client = app_module.SauceNaoClient(stub.url, connect_timeout=2, read_timeout=2, **kwargs)
+    monkeypatch.setattr(client, '_backoff', lambda attempt, response: 0.0)
+    return client
+
+
+def post(client):
+    return client.post({'output_type': 2}, {'file': ('a.png', b'png')})
+
+
+def test_transient_errors_are_retried(app_module, stub, monkeypatch):
+    client = make_client(app_module, stub, monkeypatch, max_retries=2)
+    stub.failures = 2
+    assert post(client).json()['results'][0]['data']['title'] == 'stub title'
+    assert stub.hits == 3
+    assert client.stats()['consecutive_failures'] == 0
+
+
+def test_retries_give_up_after_max_retries(app_module, stub, monkeypatch):
+    client = make_client(app_module, stub, monkeypatch, max_retries=2)
+    stub.failures = None
+    with pytest.raises(requests.exceptions.HTTPError):
+        post(client)
+    assert stub.hits == 3
+    assert client.stats()['consecutive_failures'] == 1
+
+
+def test_breaker_opens_then_half_opens_after_the_cooldown(app_module, stub, monkeypatch):
+    client = make_client(app_module, stub, monkeypatch, max_retries=0, breaker_threshold=2, breaker_cooldown=0.2)
+    stub.failures = None
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            post(client)
+    assert client.stats()['circuit_open']
+
+    # Open: calls fail fast without reaching SauceNao
+    with pytest.raises(app_module.CircuitOpenError):
+        post(client)
+    assert stub.hits == 2
+
+    # Half-open after the cooldown: one probe goes through, and while SauceNao still fails it opens again
+    time.sleep(0.25)
+    with pytest.raises(requests.exceptions.HTTPError):
+        post(client)
+    assert stub.hits == 3
+    with pytest.raises(app_module.CircuitOpenError):
+        post(client)
+    assert stub.hits == 3
+
+    # A probe that succeeds closes the breaker
+    time.sleep(0.25)
+    stub.failures = 0
+    assert post(client).status_code == 200
+    assert stub.hits == 4
+    stats = client.stats()
+    assert not stats['circuit_open']
+    assert stats['consecutive_failures'] == 0
+    assert post(client).status_code == 200
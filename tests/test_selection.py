@@ -0,0 +1,47 @@
+"""Image weights in the shuffle bag."""
+from collections import Counter
+
+
+def picks(engine, count):
+    state, seen = None, []
+    for _ in range(count):
+        filename, state = engine.next_for_session(state)
+        seen.append(filename)
+    return seen
+
+
+def test_bag_shows_each_image_once_per_pass(app_module, add_image):
+    for name in ('a.png', 'b.png', 'c.png'):
+        add_image(name)
+    seen = picks(app_module.selection_engine, 30)
+    for start in range(0, 30, 3):
+        assert sorted(seen[start:start + 3]) == ['a.png', 'b.png', 'c.png']
+
+
+def test_weight_above_one_gets_more_turns_per_pass(app_module, add_image):
+    for name in ('a.png', 'b.png', 'c.png'):
+        add_image(name)
+    app_module.set_image_weight('a.png', 3)
+    seen = picks(app_module.selection_engine, 50)
+    for start in range(0, 50, 5):
+        assert Counter(seen[start:start + 5]) == {'a.png': 3, 'b.png': 1, 'c.png': 1}
+
+
+def test_fractional_weight_above_one_averages_out(app_module, add_image):
+    add_image('a.png')
+    add_image('b.png')
+    app_module.set_image_weight('a.png', 1.5)
+    counts = Counter(picks(app_module.selection_engine, 1000))
+    # 1.5 turns of a.png for every turn of b.png, so 600 and 400
+    assert 540 < counts['a.png'] < 660
+
+
+def test_boosted_image_turns_come_from_the_bag(app_module, add_image, monkeypatch):
+    monkeypatch.setattr(app_module, 'NEW_IMAGE_BOOST', 2)
+    for name in ('a.png', 'b.png', 'c.png', 'new.png'):
+        add_image(name)
+    app_module.boost_new_image('new.png')
+    seen = picks(app_module.selection_engine, 50)
+    # Two turns of the new image and one of every other image in each pass of five
+    for start in range(0, 50, 5):
+        assert Counter(seen[start:start + 5]) == {'new.png': 2, 'a.png': 1, 'b.png': 1, 'c.png': 1}
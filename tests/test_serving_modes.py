@@ -0,0 +1,133 @@
+"""The same endpoint checks through the WSGI app and through the ASGI adapter (SERVER_MODE=asgi)."""
+import asyncio
+import os
+import threading
+import time
+
+
+def test_json_routes(any_client, add_image):
+    add_image('a.png')
+    add_image('b.png')
+
+    response = any_client.get('/image-count')
+    assert response.status_code == 200
+    assert response.get_json()['count'] == 2
+
+    response = any_client.get('/random-image')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-store'
+    pick = response.get_json()
+    assert pick['filename'] in ('a.png', 'b.png')
+    assert pick['imageUrl'].startswith(f"/images/{pick['filename']}?v=")
+
+
+def test_json_routes_without_media(any_client):
+    assert any_client.get('/random-image').status_code == 404
+    response = any_client.get('/image-source/missing.png')
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'Image not found.'}
+
+
+def test_full_file(any_client, add_image):
+    data = os.urandom(5000)
+    add_image('clip.mp4', data)
+    response = any_client.get('/images/clip.mp4')
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.data == data
+
+
+def test_single_range(any_client, add_image):
+    data = os.urandom(5000)
+    add_image('clip.mp4', data)
+    response = any_client.get('/images/clip.mp4', headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 100-199/5000'
+    assert response.data == data[100:200]
+
+
+def test_multiple_ranges(any_client, add_image):
+    data = os.urandom(5000)
+    add_image('clip.mp4', data)
+    response = any_client.get('/images/clip.mp4', headers={'Range': 'bytes=0-9,4990-4999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Type'].startswith('multipart/byteranges')
+    assert data[:10] in response.data and data[-10:] in response.data
+
+
+def test_unsatisfiable_range(any_client, add_image):
+    add_image('clip.mp4', os.urandom(5000))
+    response = any_client.get('/images/clip.mp4', headers={'Range': 'bytes=6000-7000'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */5000'
+
+
+def test_lifespan_startup(app_module, monkeypatch):
+    calls = []
+    init_app = app_module.init_app
+    monkeypatch.setattr(app_module, 'init_app', lambda: calls.append(1) or init_app())
+
+    async def run():
+        incoming = asyncio.Queue()
+        sent = []
+        await incoming.put({'type': 'lifespan.startup'})
+        await incoming.put({'type': 'lifespan.shutdown'})
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await app_module.asgi_app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, incoming.get, send)
+        return sent
+
+    assert asyncio.run(run()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert calls == [1]
+
+
+def fake_saucenao(monkeypatch, app_module, delay=0.3):
+    """Replace the SauceNao call with a slow fake; returns the list its calls are recorded in."""
+    calls = []
+
+    def fetch(image_full_path, filename):
+        calls.append(filename)
+        time.sleep(delay)
+        return [{'similarity': '90.0', 'title': 'fake'}]
+
+    monkeypatch.setattr(app_module, 'fetch_saucenao_results', fetch)
+    return calls
+
+
+def test_image_source_coalesced_wsgi(app_module, add_image, monkeypatch):
+    add_image('a.png')
+    calls = fake_saucenao(monkeypatch, app_module)
+    barrier = threading.Barrier(8)
+    responses = []
+
+    def view():
+        client = app_module.app.test_client()
+        barrier.wait()
+        responses.append(client.get('/image-source/a.png'))
+
+    threads = [threading.Thread(target=view) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ['a.png']
+    assert [r.status_code for r in responses] == [200] * 8
+    assert all(r.get_json()['source_results'][0]['title'] == 'fake' for r in responses)
+
+
+def test_image_source_coalesced_asgi(app_module, asgi_client, add_image, monkeypatch):
+    add_image('a.png')
+    calls = fake_saucenao(monkeypatch, app_module)
+    responses = asgi_client.get_many(['/image-source/a.png'] * 20)
+
+    assert calls == ['a.png']
+    assert [r.status_code for r in responses] == [200] * 20
+    assert all(r.get_json()['source_results'][0]['title'] == 'fake' for r in responses)
+
+    # Later views are answered from the source cache
+    response = asgi_client.get('/image-source/a.png')
+    assert response.get_json()['source_results'][0]['title'] == 'fake'
+    assert calls == ['a.png']
@@ -0,0 +1,54 @@
+"""Background SauceNao lookups waiting for a rate-limit token."""
+import pytest
+
+
+@pytest.fixture
+def claimed_job(app_module, add_image, monkeypatch):
+    add_image('a.png')
+    monkeypatch.setattr(app_module, 'SOURCE_TOKEN_POLL_INTERVAL', 0)
+    app_module.enqueue_source_lookup('a.png')
+    job = app_module._claim_source_lookup()
+    assert job[0] == 'a.png'
+    return job
+
+
+def job_row(app_module):
+    with app_module.db_pool.connection() as db:
+        return db.execute("SELECT status, claimed_at FROM source_lookup_jobs WHERE filename = 'a.png'").fetchone()
+
+
+def test_waiting_job_keeps_its_claim(app_module, claimed_job, monkeypatch):
+    fetched, waits = [], [900, 900, 0]
+
+    def acquire():
+        if len(waits) < 3:
+            # Another worker's prefetcher looks for work while this job waits
+            assert app_module._claim_source_lookup() is None
+        return waits.pop(0)
+
+    monkeypatch.setattr(app_module, 'acquire_saucenao_token', acquire)
+    monkeypatch.setattr(app_module, 'fetch_saucenao_results', lambda path, filename: fetched.append(filename) or [])
+    # The claim is as old as a long token wait makes it
+    with app_module.db_pool.connection() as db:
+        db.execute("UPDATE source_lookup_jobs SET claimed_at = claimed_at - 1000 WHERE filename = 'a.png'")
+
+    app_module.process_source_lookup(*claimed_job)
+    assert fetched == ['a.png']
+    assert job_row(app_module)[0] == 'done'
+
+
+def test_cached_result_ends_the_wait_without_a_token(app_module, claimed_job, monkeypatch):
+    path = app_module.resolve_image_path('a.png')
+    calls = []
+
+    def acquire():
+        # A visitor's lookup fills the cache while the job waits
+        calls.append(1)
+        app_module.source_cache.put(app_module.file_content_hash(path), [{'title': 'cached'}], wait=True)
+        return 900
+
+    monkeypatch.setattr(app_module, 'acquire_saucenao_token', acquire)
+    monkeypatch.setattr(app_module, 'fetch_saucenao_results', lambda path, filename: pytest.fail('SauceNao was called'))
+    app_module.process_source_lookup(*claimed_job)
+    assert calls == [1]
+    assert job_row(app_module)[0] == 'done'
@@ -0,0 +1,82 @@
+"""SQL statements per request, so an N+1 query on a hot route fails the tests.
+
+Counts come from the X-SQL-Statement-Count header (SQL_STATEMENT_COUNTER)
+and must not grow with the size of the library or of the moderation queue.
+"""
+import pytest
+
+from .conftest import png_bytes
+
+
+@pytest.fixture(autouse=True)
+def counted(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'SQL_STATEMENT_COUNTER', True)
+
+
+def statements(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return int(response.headers['X-SQL-Statement-Count'])
+
+
+def add_library(add_image, size):
+    for i in range(size):
+        add_image(f'img{i}.png', png_bytes((i, 0, 0)))
+
+
+@pytest.mark.parametrize('size', [3, 40])
+def test_random_image(client, add_image, size):
+    add_library(add_image, size)
+    statements(client, '/random-image')  # Loads the catalog and the weights
+    assert [statements(client, '/random-image') for _ in range(10)] == [1] * 10
+
+
+@pytest.mark.parametrize('size', [3, 40])
+def test_random_image_with_source(app_module, client, add_image, monkeypatch, size):
+    add_library(add_image, size)
+    monkeypatch.setattr(app_module, 'fetch_saucenao_results', lambda path, filename: [{'title': 'fake'}])
+    for filename in app_module.image_catalog.files():
+        app_module.lookup_image_source(filename)
+
+    # The source lookup runs on the request pool, outside the header's count, so count every thread too
+    all_threads = []
+    inc = app_module.metrics.inc
+
+    def counting_inc(name, labels=(), amount=1):
+        if name == 'sqlite_statements_total':
+            all_threads.append(labels)
+        return inc(name, labels, amount)
+
+    monkeypatch.setattr(app_module.metrics, 'inc', counting_inc)
+    statements(client, '/random-image-with-source')
+    for _ in range(10):
+        del all_threads[:]
+        assert statements(client, '/random-image-with-source') == 1
+        assert len(all_threads) == 2  # The pick, and the cached source
+
+
+def add_requests(app_module, count):
+    """Add `count` requests of every status, with near-duplicate matches and weights for them."""
+    with app_module.db_pool.connection() as db:
+        db.execute('BEGIN')
+        for status in ('pending', 'approved', 'rejected'):
+            db.executemany(
+                "INSERT INTO photo_requests (user_name, filename, status, approval_date) VALUES ('u', ?, ?, ?)",
+                [(f'{status}-{count}-{i}.png', status, '2024-01-01 00:00:00' if status == 'approved' else None) for i in range(count)]
+            )
+        pending = [row[0] for row in db.execute("SELECT id FROM photo_requests WHERE status = 'pending'")]
+        db.executemany('INSERT OR IGNORE INTO photo_request_matches (request_id, filename, distance) VALUES (?, ?, 3)',
+                       [(request_id, 'img0.png') for request_id in pending])
+        db.executemany('INSERT INTO image_weights (filename, weight, reports) VALUES (?, 2, 1)',
+                       [(f'approved-{count}-{i}.png',) for i in range(count)])
+        db.execute('COMMIT')
+
+
+@pytest.mark.parametrize('tab', ['pending', 'approved', 'rejected'])
+def test_dashboard(app_module, admin_client, tab):
+    counts = []
+    for count in (2, 60):
+        add_requests(app_module, count)
+        statements(admin_client, f'/admin?tab={tab}')
+        counts.append(statements(admin_client, f'/admin?tab={tab}'))
+    assert counts == [6, 6]
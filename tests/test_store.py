@@ -0,0 +1,21 @@
+"""The content-addressed image store."""
+import os
+import sqlite3
+
+import pytest
+
+from .conftest import png_bytes
+
+
+def test_failed_lookup_leaves_the_source_in_place(app_module, tmp_path):
+    source = tmp_path / 'a.png'
+    source.write_bytes(png_bytes())
+    with app_module.db_pool.connection() as db:
+        db.execute('ALTER TABLE image_blobs RENAME TO image_blobs_away')
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            app_module.image_store.add(str(source), 'a.png', app_module.file_content_hash(str(source)))
+    finally:
+        with app_module.db_pool.connection() as db:
+            db.execute('ALTER TABLE image_blobs_away RENAME TO image_blobs')
+    assert os.path.exists(source)
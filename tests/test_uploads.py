@@ -0,0 +1,69 @@
+"""Duplicate checks on photo submissions."""
+import io
+import os
+import sqlite3
+
+from .conftest import png_bytes
+
+
+def submit(client, data, filename='upload.png'):
+    response = client.post('/submit_photo', data={
+        'user_name': 'tester',
+        'photo_file': (io.BytesIO(data), filename),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        return [message for _, message in session.pop('_flashes', [])]
+
+
+def request_count(app_module):
+    with app_module.db_pool.connection() as db:
+        return db.execute('SELECT COUNT(*) FROM photo_requests').fetchone()[0]
+
+
+def test_new_upload_is_accepted(app_module, client):
+    assert 'submitted successfully' in submit(client, png_bytes((1, 2, 3)))[0]
+    assert request_count(app_module) == 1
+
+
+def test_pending_duplicate_is_rejected(app_module, client):
+    submit(client, png_bytes((1, 2, 3)))
+    assert submit(client, png_bytes((1, 2, 3)), 'again.png') == ['This image has already been submitted.']
+    assert request_count(app_module) == 1
+
+
+def test_copy_of_legacy_library_file_is_rejected(app_module, client, add_image):
+    add_image('old.png', png_bytes((4, 5, 6)))
+    assert submit(client, png_bytes((4, 5, 6))) == ['This image is already in the library.']
+    assert request_count(app_module) == 0
+
+
+def test_copy_of_stored_image_is_rejected(app_module, client, add_image):
+    add_image('old.png', png_bytes((7, 8, 9)))
+    app_module.migrate_library_to_store()
+    assert app_module.image_catalog.folder_files() == ()
+    assert submit(client, png_bytes((7, 8, 9))) == ['This image is already in the library.']
+    assert request_count(app_module) == 0
+
+
+def test_failed_insert_leaves_no_file_behind(app_module, client, monkeypatch):
+    def fail(*args):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(app_module, 'create_photo_request', fail)
+    response = client.post('/submit_photo', data={
+        'user_name': 'tester',
+        'photo_file': (io.BytesIO(png_bytes((1, 2, 3))), 'upload.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert os.listdir(app_module.PENDING_UPLOADS_FOLDER) == []
+
+
+def test_losing_a_duplicate_race_keeps_the_winners_file(app_module, client, monkeypatch):
+    submit(client, png_bytes((1, 2, 3)))
+    # The second upload passes the duplicate check, as if both had checked at the same time
+    monkeypatch.setattr(app_module, 'find_live_photo_request_by_hash', lambda content_hash: None)
+    assert submit(client, png_bytes((1, 2, 3)), 'again.png') == ['This image has already been submitted.']
+    with app_module.db_pool.connection() as db:
+        pending_path = db.execute('SELECT pending_path FROM photo_requests').fetchone()[0]
+    assert os.path.exists(pending_path)